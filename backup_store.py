@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+# backup_store.py
+
+"""Keeps every pulled config once, by content, with a manifest per night.
+
+Under the backup root, each distinct file content is stored once as a
+read-only blob named by its checksum, and each night gets a manifest per host
+listing what was pulled.  The familiar <backup_root>/<make>/<file> paths are
+hard links to the current blobs, so they read just as they always did:
+
+    <backup_root>/<make>/<file>
+    <backup_root>/.store/objects/<first two of checksum>/<checksum>
+    <backup_root>/.store/manifests/<YYYY-MM-DD>/<hostname>
+    <backup_root>/.store/fingerprints/<hostname>
+
+A config that has not changed since last night costs one checksum and one
+manifest line; nothing new is written to the blob area.  Better yet, drivers
+can remember a cheap fingerprint of each file as it was on the device (its
+md5sum there, or its size and date), and skip pulling it altogether when the
+fingerprint has not changed.
+"""
+
+from __future__ import with_statement
+import os
+import sys
+import time
+import errno
+import shutil
+import tempfile
+from crawler_util import file_checksum
+
+STORE_DIR        = '.store'
+OBJECTS_DIR      = 'objects'
+MANIFESTS_DIR    = 'manifests'
+FINGERPRINTS_DIR = 'fingerprints'
+NIGHT_FORMAT     = '%Y-%m-%d'
+
+def make_dirs(path):
+    """os.makedirs that doesn't mind if someone else made them first"""
+    try:
+        os.makedirs(path)
+    except OSError, err:
+        if err.errno != errno.EEXIST:
+            raise
+
+def copy_file(src, dst):
+    """Hard link src to dst if they are on one filesystem, else copy it;
+    dst is made whole under a temporary name"""
+    (fd, tmp) = tempfile.mkstemp(prefix='.', dir=os.path.dirname(dst))
+    os.close(fd)
+    os.unlink(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError, err:
+        if err.errno != errno.EXDEV:
+            raise
+        shutil.copy2(src, tmp)
+    os.rename(tmp, dst)
+
+class BackupStore(object):
+    """Content-addressed store of config backups under one backup root"""
+
+    def __init__(self, backup_root, night=None):
+        self.backup_root = os.path.abspath(backup_root)
+        self.store_root  = os.path.join(self.backup_root, STORE_DIR)
+        if night is None:
+            night = time.strftime(NIGHT_FORMAT)
+        self.night = night
+
+    def blob_path(self, checksum):
+        """Where the blob with this checksum lives"""
+        return os.path.join(self.store_root, OBJECTS_DIR,
+                            checksum[:2], checksum)
+
+    def manifest_path(self, hostname, night=None):
+        """Where the manifest of one host for one night lives"""
+        if night is None:
+            night = self.night
+        return os.path.join(self.store_root, MANIFESTS_DIR, night, hostname)
+
+    def add(self, staging, hostname, dst_path, checksum=None):
+        """Take a freshly pulled file (which must be on the same filesystem,
+        and is used up), store its content, point dst_path at it and record
+        it in tonight's manifest.  Returns the checksum."""
+        if checksum is None:
+            checksum = file_checksum(staging)
+        blob = self.blob_path(checksum)
+        if os.path.exists(blob):
+            # seen this content before: nothing more to keep
+            os.unlink(staging)
+        else:
+            make_dirs(os.path.dirname(blob))
+            os.chmod(staging, 0444)
+            os.rename(staging, blob)
+        self._link(blob, dst_path)
+        self._record(hostname, checksum, dst_path, os.path.getsize(blob))
+        return checksum
+
+    def _link(self, blob, dst_path):
+        """Atomically make dst_path a hard link to blob"""
+        if os.path.exists(dst_path) and os.path.samefile(blob, dst_path):
+            # already is (and rename() would do nothing to tmp below)
+            return
+        (dst_dir, dst_file) = os.path.split(dst_path)
+        (fd, tmp) = tempfile.mkstemp(prefix='.%s.' % dst_file, dir=dst_dir)
+        os.close(fd)
+        os.unlink(tmp)
+        os.link(blob, tmp)
+        try:
+            os.rename(tmp, dst_path)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def _record(self, hostname, checksum, dst_path, size):
+        """Add a line to the host's manifest for tonight, unless it is there
+        already (the host was visited twice tonight, or retried)"""
+        manifest = self.manifest_path(hostname)
+        make_dirs(os.path.dirname(manifest))
+        rel_path = os.path.relpath(dst_path, self.backup_root)
+        line = '%s\t%s\t%d\n' % (checksum, rel_path, size)
+        if os.path.exists(manifest):
+            with open(manifest) as infile:
+                if line in infile:
+                    return
+        with open(manifest, 'a') as outfile:
+            outfile.write(line)
+
+    def fingerprint_path(self, hostname):
+        """Where the fingerprints of a host's files live"""
+        return os.path.join(self.store_root, FINGERPRINTS_DIR, hostname)
+
+    def fingerprints(self, hostname):
+        """{relative path: (fingerprint, checksum)} of a host's files"""
+        path = self.fingerprint_path(hostname)
+        entries = {}
+        if not os.path.exists(path):
+            return entries
+        with open(path) as infile:
+            for line in infile:
+                (rel_path, fingerprint, checksum) = \
+                    line.rstrip('\n').split('\t')
+                entries[rel_path] = (fingerprint, checksum)
+        return entries
+
+    def set_fingerprint(self, hostname, dst_path, fingerprint, checksum):
+        """Remember the fingerprint of the file just pulled to dst_path"""
+        entries = self.fingerprints(hostname)
+        entries[os.path.relpath(dst_path, self.backup_root)] = (fingerprint,
+                                                                checksum)
+        path = self.fingerprint_path(hostname)
+        make_dirs(os.path.dirname(path))
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as outfile:
+            for (rel_path, (fingerprint, checksum)) in sorted(entries.items()):
+                outfile.write('%s\t%s\t%s\n' % (rel_path, fingerprint,
+                                                 checksum))
+        os.rename(tmp, path)
+
+    def unchanged(self, hostname, dst_path, fingerprint):
+        """If the file was last pulled to dst_path with this fingerprint,
+        and we still have it, record it again for tonight (no transfer needed)
+        and return its checksum.  Otherwise return None: go pull it."""
+        rel_path = os.path.relpath(dst_path, self.backup_root)
+        entry = self.fingerprints(hostname).get(rel_path)
+        if entry is None or entry[0] != fingerprint:
+            return None
+        return self.reuse(hostname, dst_path, entry[1])
+
+    def has(self, checksum):
+        """True if the content with this checksum is still in the store"""
+        return os.path.exists(self.blob_path(checksum))
+
+    def reuse(self, hostname, dst_path, checksum):
+        """Point dst_path at content already in the store, and record it in
+        tonight's manifest.  Returns the checksum, or None if we don't have
+        that content after all."""
+        blob = self.blob_path(checksum)
+        if not os.path.exists(blob):
+            return None
+        self._link(blob, dst_path)
+        self._record(hostname, checksum, dst_path, os.path.getsize(blob))
+        return checksum
+
+    def nights(self):
+        """Nights that have manifests, oldest first"""
+        path = os.path.join(self.store_root, MANIFESTS_DIR)
+        if not os.path.isdir(path):
+            return []
+        return sorted(os.listdir(path))
+
+    def manifest(self, hostname, night=None):
+        """[(checksum, relative path, size)] pulled from a host on a night"""
+        path = self.manifest_path(hostname, night)
+        entries = []
+        if not os.path.exists(path):
+            return entries
+        with open(path) as infile:
+            for line in infile:
+                (checksum, rel_path, size) = line.rstrip('\n').split('\t')
+                entries.append((checksum, rel_path, int(size)))
+        return entries
+
+    def hostnames(self, night):
+        """Hosts that have a manifest for a night"""
+        path = os.path.join(self.store_root, MANIFESTS_DIR, night)
+        if not os.path.isdir(path):
+            return []
+        return sorted(os.listdir(path))
+
+    def take_in(self, other, hostname, night):
+        """Copy a host's manifest for a night, and the content it lists,
+        from another BackupStore (another crawler node's), and point the
+        usual paths at that content.  Take nights in order, so that the
+        paths end up at the latest.  Returns the number of files."""
+        entries = other.manifest(hostname, night)
+        for (checksum, rel_path, size) in entries:
+            blob = self.blob_path(checksum)
+            if not os.path.exists(blob):
+                make_dirs(os.path.dirname(blob))
+                copy_file(other.blob_path(checksum), blob)
+            dst_path = os.path.join(self.backup_root, rel_path)
+            make_dirs(os.path.dirname(dst_path))
+            self._link(blob, dst_path)
+        manifest = self.manifest_path(hostname, night)
+        make_dirs(os.path.dirname(manifest))
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(manifest))
+        with os.fdopen(fd, 'w') as outfile:
+            for entry in entries:
+                outfile.write('%s\t%s\t%d\n' % entry)
+        os.rename(tmp, manifest)
+        return len(entries)
+
+    def history(self, hostname):
+        """[(night, checksum, relative path, size)] for a host, oldest first"""
+        entries = []
+        for night in self.nights():
+            for entry in self.manifest(hostname, night):
+                entries.append((night,) + entry)
+        return entries
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 3:
+        sys.exit('usage: %s backup_root hostname' % sys.argv[0])
+
+    store = BackupStore(sys.argv[1])
+    for (night, checksum, rel_path, size) in store.history(sys.argv[2]):
+        print '%s %s %8d %s' % (night, checksum, size, rel_path)
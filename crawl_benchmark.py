@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+# crawl_benchmark.py
+
+"""Times the crawler end to end against a simulated fleet.
+
+For each fleet size asked for (10, 100 and 1000 devices unless told
+otherwise) this builds a fleet for device_simulator.py on loopback addresses
+127.1.x.y (eight in ten Ubiquiti radios, one Mikrotik router, one H3C switch),
+the OpenNMS import files that list it, and a bin directory of simulated ssh,
+scp and sftp.  It then runs host_visitor.py over the fleet, with that bin
+directory first on the PATH, and reports:
+
+  * hosts visited per minute, and how the visits went
+  * each make's phases at the median and 90th percentile (from --metrics)
+  * CPU time and peak memory of the crawler and everything it ran
+
+Run it as root, as the ping sweep needs an ICMP socket (else the crawler
+pings one host at a time, which is part of what gets measured).
+"""
+
+from __future__ import with_statement
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import resource
+import tempfile
+import subprocess
+import crawler_util
+import device_simulator
+from optparse import OptionParser
+
+SIZES = (10, 100, 1000)
+
+# one in ten of each of these; the rest are Ubiquiti radios
+MAKE_EVERY = {0 : crawler_util.HOST_MAKE_MIKROTIK,
+              1 : crawler_util.HOST_MAKE_H3C}
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def fleet_address(index):
+    """The loopback address of the index'th simulated device"""
+    return '127.1.%d.%d' % (index / 250, index % 250 + 1)
+
+def make_fleet(size, latency=0.0, loss=0.0, auth_failures=0.0, seed=None):
+    """{IP: device settings} for device_simulator.py"""
+    rand = random.Random(seed)
+    fleet = {}
+    for index in range(size):
+        make = MAKE_EVERY.get(index % 10, crawler_util.HOST_MAKE_UBIQUITI)
+        fleet[fleet_address(index)] = \
+            {'make'         : make,
+             'hostname'     : '%s-%04d' % (make, index),
+             'latency'      : latency,
+             'loss'         : loss,
+             'auth_failure' : rand.random() < auth_failures,
+             'uptime'       : rand.randint(60, 6 * 24 * 60 * 60)}
+    return fleet
+
+def write_inventory(path, foreign_source, fleet):
+    """An OpenNMS import file of the devices of one make"""
+    with open(path, 'w') as outfile:
+        outfile.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                      '<model-import xmlns="http://xmlns.opennms.org/xsd/'
+                      'config/model-import" foreign-source="%s">\n' %
+                      foreign_source)
+        for ip in sorted(fleet, key=crawler_util.ip_to_int):
+            device = fleet[ip]
+            if device['make'] != foreign_source:
+                continue
+            outfile.write('  <node node-label="%s" foreign-id="%s">\n'
+                          '    <interface ip-addr="%s" status="1" '
+                          'snmp-primary="P"/>\n'
+                          '  </node>\n' % (device['hostname'],
+                                           crawler_util.ip_to_int(ip), ip))
+        outfile.write('</model-import>\n')
+
+def build(work_dir, fleet):
+    """Lay out a fleet under work_dir; returns the OpenNMS files"""
+    device_simulator.install(os.path.join(work_dir, 'bin'))
+    device_simulator.write_json(os.path.join(work_dir, 'fleet.json'), fleet)
+    root = os.path.join(work_dir, 'devices')
+    for (ip, settings) in fleet.items():
+        device_simulator.make_device(ip, settings, root).build()
+    xml_files = []
+    for make in sorted(set([device['make'] for device in fleet.values()])):
+        xml_file = os.path.join(work_dir, '%s.xml' % make)
+        write_inventory(xml_file, make, fleet)
+        xml_files.append(xml_file)
+    return xml_files
+
+def crawl(work_dir, xml_files, workers, night, record=None):
+    """Run host_visitor.py over the fleet once; returns (wall seconds,
+    resource usage of it and its children, path of the metrics JSON)"""
+    env = dict(os.environ)
+    env['PATH'] = '%s:%s' % (os.path.join(work_dir, 'bin'),
+                             env.get('PATH', ''))
+    env[device_simulator.FLEET_ENV] = os.path.join(work_dir, 'fleet.json')
+    env[device_simulator.ROOT_ENV] = os.path.join(work_dir, 'devices')
+    metrics = os.path.join(work_dir, 'metrics-%d' % night)
+    argv = [sys.executable, os.path.join(HERE, 'host_visitor.py'),
+            '--workers', str(workers),
+            '--history', os.path.join(work_dir, 'history.db'),
+            '--metrics', metrics,
+            os.path.join(work_dir, 'last-visited'),
+            os.path.join(work_dir, 'backups')] + xml_files
+    if record:
+        argv[2:2] = ['--record', os.path.abspath(record)]
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.time()
+    with open(os.path.join(work_dir, 'report-%d.txt' % night), 'w') as report:
+        subprocess.call(argv, env=env, cwd=work_dir, stdout=report,
+                        stderr=subprocess.STDOUT)
+    wall = time.time() - started
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    usage = {'user'   : after.ru_utime - before.ru_utime,
+             'system' : after.ru_stime - before.ru_stime,
+             'maxrss' : after.ru_maxrss} # KiB, the largest of any child
+    return (wall, usage, '%s.json' % metrics)
+
+def report(size, night, wall, usage, metrics_file):
+    """Print what one crawl of the fleet came to"""
+    with open(metrics_file) as infile:
+        metrics = json.load(infile)
+    print '%d devices, night %d: %.1f seconds, %.1f hosts/minute (%s)' % \
+          (size, night, wall, metrics['hosts_per_minute'],
+           ', '.join(['%d %s' % (number, result) for (result, number)
+                      in sorted(metrics['visits'].items()) if number]))
+    print '  CPU %.1f user + %.1f system seconds, peak RSS %d KiB' % \
+          (usage['user'], usage['system'], usage['maxrss'])
+    for (make, timings) in sorted(metrics['makes'].items()):
+        for (phase, summary) in sorted(timings.get('phases', {}).items()):
+            print '  %-9s %-7s median %6.2f  90%% %6.2f  seconds' % \
+                  (make, phase, summary['0.5'], summary['0.9'])
+        for (kind, steps) in sorted(timings.get('steps', {}).items()):
+            for (what, summary) in sorted(steps.items()):
+                print '  %-9s %-8s %-28s median %6.2f  x%d' % \
+                      (make, kind, what[:28], summary['0.5'],
+                       summary['count'])
+
+if __name__ == '__main__':
+
+    parser = OptionParser(usage='usage: %prog [options] [fleet_size ...]')
+    parser.add_option('-w', '--workers', type='int', default=8,
+                      help='hosts to visit at once [default: %default]')
+    parser.add_option('-n', '--nights', type='int', default=1,
+                      help='crawls of each fleet (after the first, most '
+                           'configs are unchanged) [default: %default]')
+    parser.add_option('-l', '--latency', type='float', default=0.0,
+                      help='seconds per round trip to each device '
+                           '[default: %default]')
+    parser.add_option('-L', '--loss', type='float', default=0.0,
+                      help='chance that a connection times out '
+                           '[default: %default]')
+    parser.add_option('-a', '--auth-failures', type='float', default=0.0,
+                      help='share of devices that refuse the password '
+                           '[default: %default]')
+    parser.add_option('-s', '--seed', type='int', default=0,
+                      help='for the random parts of the fleet')
+    parser.add_option('-r', '--record', metavar='DIR',
+                      help='record every visit under DIR (see '
+                           'session_replay.py)')
+    parser.add_option('-d', '--work-dir', metavar='DIR',
+                      help='build fleets here, and keep them '
+                           '[default: a temporary directory, removed after]')
+    (options, args) = parser.parse_args()
+    sizes = [int(arg) for arg in args] or SIZES
+    if max(sizes) > 250 * 256:
+        parser.error('at most %d devices' % (250 * 256))
+
+    base_dir = options.work_dir or tempfile.mkdtemp(prefix='crawl-bench-')
+    try:
+        for size in sizes:
+            work_dir = os.path.join(os.path.abspath(base_dir),
+                                    'fleet-%d' % size)
+            if os.path.exists(work_dir):
+                shutil.rmtree(work_dir)
+            os.makedirs(work_dir)
+            fleet = make_fleet(size, options.latency, options.loss,
+                               options.auth_failures, options.seed)
+            xml_files = build(work_dir, fleet)
+            for night in range(1, options.nights + 1):
+                (wall, usage, metrics_file) = crawl(work_dir, xml_files,
+                                                    options.workers, night,
+                                                    options.record)
+                report(size, night, wall, usage, metrics_file)
+    finally:
+        if not options.work_dir:
+            shutil.rmtree(base_dir, True)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+# crawl_shard.py
+
+"""Splits the host inventory between crawler nodes.
+
+With --shard i/N, node i of N visits only the hosts that hash to it.  The
+hashing is rendezvous (highest random weight) hashing on the host's IP: each
+host goes to the node that gives it the highest weight, the weight being an
+md5 of the node number and the address.  Every node works this out on its
+own, from nothing but i and N, and they all agree.
+
+Going from N nodes to N+1 moves only the hosts the new node now wins, about
+1/(N+1) of them, all to the new node; no host moves between the old nodes.
+A node's round-robin resume point is an address, so it carries on from the
+next of its hosts after it even if that one host has moved.
+"""
+
+import sys
+import struct
+import hashlib
+import crawler_util
+
+class Shard(object):
+    """Node number of count (from 1), and which hosts are its own"""
+
+    def __init__(self, number, count):
+        if count < 1 or not 1 <= number <= count:
+            raise ValueError('no shard %d of %d' % (number, count))
+        self.number = number
+        self.count  = count
+
+    @classmethod
+    def parse(cls, text):
+        """A Shard from 'i/N'; ValueError if it makes no sense"""
+        try:
+            (number, count) = [int(part) for part in text.split('/')]
+        except ValueError:
+            raise ValueError('shard should be i/N, not %s' % text)
+        return cls(number, count)
+
+    def owns(self, ip):
+        """True if the host at ip (IPv4Address or 32-bit integer) is ours"""
+        return owner(ip, self.count) == self.number
+
+    def __str__(self):
+        return '%d/%d' % (self.number, self.count)
+
+def weight(node, ip):
+    """How much node wants the host at ip, as a 64-bit integer"""
+    digest = hashlib.md5('%d:%d' % (node, ip)).digest()
+    return struct.unpack('>Q', digest[:8])[0]
+
+def owner(ip, count):
+    """Which of count nodes (from 1) visits the host at ip"""
+    if not isinstance(ip, (int, long)):
+        ip = crawler_util.ip_to_int(ip)
+    best = None
+    for node in range(1, count + 1):
+        node_weight = weight(node, ip)
+        if best is None or node_weight > best[0]:
+            best = (node_weight, node)
+    return best[1]
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 3:
+        sys.exit('usage: %s node_count opennms_file ...' % sys.argv[0])
+
+    # how the inventory splits, and what adding a node would move
+    import host_walker
+    count = int(sys.argv[1])
+    walker = host_walker.HostWalker(sys.argv[2:])
+    shares = {}
+    moved = 0
+    for host in walker:
+        node = owner(host.ip, count)
+        shares[node] = shares.get(node, 0) + 1
+        if owner(host.ip, count + 1) != node:
+            moved += 1
+    for node in range(1, count + 1):
+        print 'Shard %d/%d: %d units' % (node, count, shares.get(node, 0))
+    print 'A node more would move %d of %d units' % (moved, walker.host_count())
@@ -10,10 +10,29 @@
 BASENAME="/usr/bin/basename"
 TIMEOUT="/usr/bin/timeout"
 
-# helper scripts and config files
-STATE="/var/inveneo/crawler-last-visited"
-BACKUPS="/var/inveneo/pulled-configs"
+# this node's share of the hosts, as I/N (see crawl_shard.py); "" for all
+SHARD=""
+NODE=""
+SHARD_OPTION=""
+if [ -n "${SHARD}" ] ; then
+    # named by the node alone, so they carry over when N changes
+    NODE="-node${SHARD%%/*}"  # e.g. -node2
+    SHARD_OPTION="--shard ${SHARD}"
+fi
+
+# helper scripts and config files (each node keeps its own)
+STATE="/var/inveneo/crawler-last-visited${NODE}"
+INVENTORY="/var/inveneo/crawler-inventory${NODE}.cache"
+HOST_STATE="/var/inveneo/crawler-host-state${NODE}"
+HISTORY="/var/inveneo/crawler-history${NODE}.db"
+FAILURES="/var/inveneo/crawler-failures${NODE}"
+METRICS="/var/inveneo/crawler-metrics${NODE}"  # .prom and .json
+REPORT="/var/inveneo/crawler-report${NODE}.jsonl"
+SUMMARY="${NIGHTLY_SUMMARY:-/var/inveneo/crawler-summary${NODE}}"
+BACKUPS="/var/inveneo/pulled-configs${NODE}"
+TOPOLOGY="/var/inveneo/crawler-topology${NODE}.json"
 VISITOR="/opt/inveneo/crawler/host_visitor.py"
+WORKERS="1"     # number of hosts to visit at once
 
 # database of nodes
 RADIOS="/etc/opennms/imports/ubiquiti.xml"
@@ -59,4 +78,11 @@ set_ttl()
 # visit hosts, with timeout
 set_ttl
 echo "Time To Live is now $TTL seconds"
-${TIMEOUT} -${SIGINT} ${TTL} ${VISITOR} ${STATE} ${BACKUPS} ${XML_FILES} 2>&1
+${TIMEOUT} -${SIGINT} ${TTL} ${VISITOR} --workers ${WORKERS} \
+    --inventory-cache ${INVENTORY} \
+    --schedule priority --host-state ${HOST_STATE} \
+    --history ${HISTORY} --end-time ${SEC_THEN} \
+    --failure-cache ${FAILURES} \
+    --metrics ${METRICS} --topology ${TOPOLOGY} --link-watch \
+    --json-report ${REPORT} --summary ${SUMMARY} ${SHARD_OPTION} \
+    ${STATE} ${BACKUPS} ${XML_FILES} 2>&1
@@ -18,3 +18,20 @@ FOREIGN_SOURCES_UBIQUITI = ['cpes', 'ubiquiti']
 
 # paths on this server
 PATH_SSH_KEYGEN = '/usr/bin/ssh-keygen'
+
+# ICMP reachability sweep
+PING_SWEEP_TIMEOUT   = 2.0 # seconds to wait for each echo reply
+PING_SWEEP_RETRIES   = 2   # extra echo requests before giving up on a host
+PING_SWEEP_IN_FLIGHT = 128 # most echo requests outstanding at once
+PING_SWEEP_MAX_AGE   = 15 * 60 # seconds before the sweep is redone
+
+# deadline budgeting (see visit_budget.py)
+DEADLINE_MARGIN = 2 * 60 # seconds before the end time to be wrapped up by
+
+# dead link detection (see link_watch.py)
+LINK_PREFIX        = 24     # subnet size of a link, without a topology
+LINK_GATEWAY_HOST  = 1      # the gateway's place in its subnet
+LINK_FAILURES      = 3      # unreachable hosts in a row before probing
+LINK_PROBE_RETRIES = 2      # extra echo requests to the gateway
+LINK_RETRIES       = 2      # tries of a down link after the first
+LINK_RETRY_WAIT    = 5 * 60 # seconds between those tries
@@ -7,6 +7,12 @@
 Written by jwiggins@inveneo.org 2011-2012
 """
 
+import os
+import socket
+import struct
+import hashlib
+import tempfile
+
 # time periods
 SEVEN_DAYS = 60 * 60 * 24 * 7
 FOUR_DAYS  = 60 * 60 * 24 * 4
@@ -17,6 +23,10 @@ HOST_MAKE_H3C      = 'h3c'
 HOST_MAKE_MIKROTIK = 'mikrotik'
 HOST_MAKE_UNKNOWN  = 'unknown'
 
+# config file checksums; md5 because md5sum is what the devices have
+CHECKSUM   = hashlib.md5
+CHUNK_SIZE = 64 * 1024
+
 def rough_timespan(seconds):
     """Converts time difference into English string"""
     if seconds < 120: return "%d seconds" % seconds
@@ -29,6 +39,51 @@ def rough_timespan(seconds):
     weeks = int(days / 7)
     return "%d weeks" % weeks
 
+def percentile(values, fraction):
+    """The value that this fraction of the values do not exceed"""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def ip_to_int(ip):
+    """Dotted quad (or anything whose str() is one) into a 32-bit integer"""
+    return struct.unpack('!I', socket.inet_aton(str(ip)))[0]
+
+def int_to_ip(number):
+    """32-bit integer into dotted quad"""
+    return socket.inet_ntoa(struct.pack('!I', number))
+
+def as_text(value):
+    """A bytestring (what devices say, as read) as unicode, any bytes that
+    are not UTF-8 replaced; anything else as it is"""
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+def file_checksum(path):
+    """Hex checksum of a local file"""
+    checksum = CHECKSUM()
+    infile = open(path, 'rb')
+    try:
+        while True:
+            chunk = infile.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            checksum.update(chunk)
+    finally:
+        infile.close()
+    return checksum.hexdigest()
+
+def write_atomically(path, text):
+    """Write a file under a temporary name and rename it into place"""
+    (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    outfile = os.fdopen(fd, 'w')
+    try:
+        outfile.write(text)
+    finally:
+        outfile.close()
+    os.chmod(tmp, 0644)
+    os.rename(tmp, path)
+
 if __name__ == '__main__':
     secs = 400
     print '%d seconds is roughly %s' % (secs, rough_timespan(secs))
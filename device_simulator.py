@@ -0,0 +1,633 @@
+#!/usr/bin/env python
+
+# device_simulator.py
+
+"""Stands in for ssh, scp and sftp, and answers as a fleet of devices would.
+
+Put the wrappers that "device_simulator.py install bin_dir" writes first on
+the PATH, and every ssh, scp and sftp the crawler runs is this script instead.
+It looks the host up in the fleet (a JSON file named by $CRAWLER_SIM_FLEET,
+of IP address -> device), and plays that device from its files under
+$CRAWLER_SIM_ROOT/<IP>: the same password prompts, the same output and the
+same confirmations the drivers expect of a real one.
+
+  * a Ubiquiti radio runs remote commands under sh, with /etc, /proc and /tmp
+    taken to be under its directory (/etc/version, /etc/board.inc,
+    /proc/uptime and /tmp/system.cfg are what the crawler asks for)
+  * a Mikrotik router answers "system resource print", "export", "system
+    backup save" and "system reboot"; its API port is closed, so the crawler
+    falls back to SSH
+  * an H3C switch gives a Comware command line: <name> and [name] prompts,
+    "display version", "display startup", "dir", "sftp server enable", and
+    "save" and "reboot" with their questions
+
+Each device may also be given a latency (seconds per round trip), a bandwidth
+(bytes per second of file transfer), a loss (the chance that a connection
+hangs until ConnectTimeout and then times out), an auth_failure (its password
+is never right) and a downtime (seconds it refuses connections after a
+reboot).  OpenSSH's ControlMaster is played too: "-f -N -o ControlMaster=yes"
+leaves a file at the ControlPath, and ssh, scp and sftp on that path need no
+password until "-O exit" removes it.
+
+Every simulated device is on a loopback address, so it always answers ping.
+"""
+
+from __future__ import with_statement
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import getpass
+import tempfile
+import subprocess
+import crawler_conf
+
+FLEET_ENV = 'CRAWLER_SIM_FLEET' # JSON file: IP address -> device settings
+ROOT_ENV  = 'CRAWLER_SIM_ROOT'  # under here, a directory of files per device
+TOOLS     = ('ssh', 'scp', 'sftp')
+
+MAX_TRIES    = 3 # passwords asked for before giving up, as OpenSSH does
+CONNECT_RTTS = 4 # round trips to connect: TCP, key exchange, auth
+
+# ssh/scp/sftp options that take an argument
+ARG_OPTIONS = 'bcDEeFIiJLlmOoPpQRSWw'
+
+DEFAULTS = {'password'     : crawler_conf.NODE_PASSWORD,
+            'latency'      : 0.0,
+            'bandwidth'    : None,
+            'loss'         : 0.0,
+            'auth_failure' : False,
+            'downtime'     : 0,
+            'uptime'       : 24 * 60 * 60}
+
+class Disconnect(Exception):
+    """ssh gives up: the message goes to stderr, and it exits 255"""
+
+def parse_command_line(args):
+    """({-o option: value}, {flag: argument or True}, [the rest]) of an
+    ssh/scp/sftp command line"""
+    options = {}
+    flags = {}
+    args = list(args)
+    while args and args[0].startswith('-'):
+        arg = args.pop(0)
+        if arg == '--':
+            break
+        for (i, flag) in enumerate(arg[1:]):
+            if flag not in ARG_OPTIONS:
+                flags[flag] = True
+                continue
+            value = arg[i + 2:] or args.pop(0)
+            if flag == 'o':
+                (name, setting) = (value.split('=', 1) + [''])[:2]
+                options[name] = setting
+            else:
+                flags[flag] = value
+            break
+    return (options, flags, args)
+
+def split_target(target):
+    """(user, host, path or None) of user@host[:path]"""
+    (user, host) = target.split('@', 1)
+    path = None
+    if ':' in host:
+        (host, path) = host.split(':', 1)
+    return (user, host, path)
+
+def load_fleet():
+    with open(os.environ[FLEET_ENV]) as infile:
+        return json.load(infile)
+
+def write_json(path, data):
+    """Write a JSON file atomically, as devices may be visited at once"""
+    (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as outfile:
+        json.dump(data, outfile, indent=1, sort_keys=True)
+    os.rename(tmp, path)
+
+def say(text):
+    """Write to the terminal (or pipe) and make sure it gets there"""
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+class SimulatedDevice(object):
+    """One device of the fleet: its settings and its files"""
+
+    USER = None # set in subclass
+
+    def __init__(self, ip, settings, root):
+        self.ip = ip
+        self.settings = dict(DEFAULTS)
+        self.settings.update(settings)
+        self.root = root
+        self.state_file = os.path.join(root, 'state.json')
+
+    def __getattr__(self, name):
+        try:
+            return self.settings[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    ##### the device's files #####
+
+    def build(self):
+        """Create the device's files, as it is when the simulation starts"""
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        self.save_state({'booted_at' : time.time() - self.uptime,
+                         'down_until' : 0})
+
+    def path(self, *parts):
+        """Where a file of the device is kept"""
+        return os.path.join(self.root, *[part.lstrip('/') for part in parts])
+
+    def state(self):
+        with open(self.state_file) as infile:
+            return json.load(infile)
+
+    def save_state(self, state):
+        write_json(self.state_file, state)
+
+    def seconds_up(self):
+        return time.time() - self.state()['booted_at']
+
+    def reboot(self):
+        now = time.time()
+        self.save_state({'booted_at' : now + self.downtime,
+                         'down_until' : now + self.downtime})
+
+    ##### the network #####
+
+    def round_trip(self, count=1):
+        if self.latency:
+            time.sleep(self.latency * count)
+
+    def transfer(self, size):
+        """Take as long as sending this many bytes would"""
+        self.round_trip()
+        if self.bandwidth:
+            time.sleep(float(size) / self.bandwidth)
+
+    def connect(self, connect_timeout):
+        """Get through to the device, or Disconnect as ssh would"""
+        if random.random() < self.loss:
+            time.sleep(connect_timeout)
+            raise Disconnect('ssh: connect to host %s port 22: '
+                             'Connection timed out' % self.ip)
+        if time.time() < self.state()['down_until']:
+            raise Disconnect('ssh: connect to host %s port 22: '
+                             'Connection refused' % self.ip)
+        self.round_trip(CONNECT_RTTS)
+
+    def login(self, user):
+        """Ask for the password, as OpenSSH does"""
+        for tries in range(MAX_TRIES):
+            pwd = getpass.getpass("%s@%s's password: " % (user, self.ip))
+            self.round_trip()
+            if pwd == self.password and user == self.USER and \
+               not self.auth_failure:
+                return
+            if tries < MAX_TRIES - 1:
+                sys.stderr.write('Permission denied, please try again.\n')
+        raise Disconnect('%s@%s: Permission denied (publickey,password).' %
+                         (user, self.ip))
+
+    ##### what the device does #####
+
+    def run(self, command):
+        """Run a remote command; returns its exit status"""
+        sys.stderr.write('sh: %s: not found\n' % command.split()[0])
+        return 127
+
+    def shell(self):
+        """Talk to an interactive login; returns its exit status"""
+        say('%s$ ' % self.settings['hostname'])
+        return 0
+
+    def sftp_allowed(self):
+        return True
+
+class UbiquitiDevice(SimulatedDevice):
+    """A Ubiquiti radio: a little Linux box with busybox"""
+
+    USER = crawler_conf.USERNAME_UBIQUITI
+    DIRS = re.compile(r'(?<![\w./])/(etc|proc|tmp)\b')
+
+    def build(self):
+        SimulatedDevice.build(self)
+        for directory in ('etc', 'proc', 'tmp'):
+            if not os.path.isdir(self.path(directory)):
+                os.mkdir(self.path(directory))
+        with open(self.path('etc/version'), 'w') as outfile:
+            outfile.write('XM.v%s\n' % self.settings.get('version', '5.5.4'))
+        with open(self.path('etc/board.inc'), 'w') as outfile:
+            outfile.write('$board_id="0xe005";\n$board_name="%s";\n' %
+                          self.settings.get('board', 'NanoStation M5'))
+        with open(self.path('tmp/system.cfg'), 'w') as outfile:
+            outfile.write(self.settings.get('config',
+                              'resolv.host.1.name=%s\n'
+                              'netconf.1.ip=%s\n'
+                              'users.1.name=%s\n' %
+                              (self.hostname, self.ip, self.USER)))
+        self._write_uptime()
+
+    def _write_uptime(self):
+        seconds = max(0, self.seconds_up())
+        with open(self.path('proc/uptime'), 'w') as outfile:
+            outfile.write('%.2f %.2f\n' % (seconds, seconds * 0.9))
+
+    def rewrite(self, command):
+        """The command, with the device's own directories in it"""
+        return self.DIRS.sub(lambda match: self.path(match.group(1)), command)
+
+    def run(self, command):
+        self.round_trip()
+        if command.strip() == 'reboot':
+            self.reboot()
+            return 0
+        self._write_uptime()
+        return subprocess.call(['sh', '-c', self.rewrite(command)],
+                               cwd=self.root)
+
+    def remote_path(self, directory, name):
+        return self.rewrite(os.path.join(directory or '/', name))
+
+class MikrotikDevice(SimulatedDevice):
+    """A Mikrotik router: RouterOS's command line, one line at a time"""
+
+    USER = crawler_conf.USERNAME_MIKROTIK
+
+    def build(self):
+        SimulatedDevice.build(self)
+        with open(self.path('export.rsc'), 'w') as outfile:
+            outfile.write(self.settings.get('config',
+                              '/system identity\nset name=%s\n'
+                              '/ip address\nadd address=%s/24 '
+                              'interface=ether1\n' %
+                              (self.hostname, self.ip)))
+
+    def resources(self):
+        seconds = int(max(0, self.seconds_up()))
+        uptime = ''
+        for (unit, size) in (('w', 7 * 24 * 3600), ('d', 24 * 3600),
+                             ('h', 3600), ('m', 60), ('s', 1)):
+            if seconds >= size or (unit == 's' and not uptime):
+                uptime += '%d%s' % (seconds / size, unit)
+                seconds %= size
+        fields = [('uptime', uptime),
+                  ('version', self.settings.get('version', '5.20')),
+                  ('free-memory', '105020KiB'),
+                  ('total-memory', '128.0MiB'),
+                  ('cpu', 'MIPS 24Kc V7.4'),
+                  ('cpu-count', '1'),
+                  ('cpu-frequency', '400MHz'),
+                  ('cpu-load', '%d%%' % random.randint(0, 30)),
+                  ('board-name', self.settings.get('board', 'RB750')),
+                  ('platform', 'MikroTik')]
+        return ''.join(['%21s: %s\n' % field for field in fields])
+
+    def export(self):
+        with open(self.path('export.rsc')) as infile:
+            config = infile.read()
+        return '# %s by RouterOS %s\n%s' % \
+                    (time.strftime('%b/%d/%Y %H:%M:%S').lower(),
+                     self.settings.get('version', '5.20'), config)
+
+    def run(self, command):
+        status = 0
+        for line in command.split(';'):
+            words = line.split()
+            self.round_trip()
+            if not words or words == ['beep']:
+                continue
+            elif words == ['quit']:
+                break
+            elif words == ['system', 'resource', 'print']:
+                say(self.resources())
+            elif words == ['export']:
+                say(self.export())
+            elif words[:3] == ['system', 'backup', 'save']:
+                name = 'backup'
+                for word in words[3:]:
+                    if word.startswith('name='):
+                        name = word[len('name='):]
+                with open(self.path('%s.backup' % name), 'wb') as outfile:
+                    outfile.write(self.export().split('\n', 1)[1] * 4)
+                say('Configuration backup saved\n')
+            elif words == ['system', 'reboot']:
+                self.reboot()
+                break
+            else:
+                say('bad command name %s (line 1 column 1)\n' % words[0])
+                status = 1
+        return status
+
+    def shell(self):
+        say('[%s@%s] > ' % (self.USER, self.hostname))
+        while True:
+            line = sys.stdin.readline()
+            if not line or line.strip() == 'quit':
+                return 0
+            self.run(line)
+            say('[%s@%s] > ' % (self.USER, self.hostname))
+
+    def remote_path(self, directory, name):
+        return self.path(directory or '/', name)
+
+class H3CDevice(SimulatedDevice):
+    """An H3C switch: a Comware command line"""
+
+    USER = crawler_conf.USERNAME_H3C
+    CONFIG = 'startup.cfg'
+
+    def build(self):
+        SimulatedDevice.build(self)
+        with open(self.path(self.CONFIG), 'w') as outfile:
+            outfile.write(self.settings.get('config',
+                              '#\n sysname %s\n#\ninterface Vlan-interface1\n'
+                              ' ip address %s 255.255.255.0\n#\nreturn\n' %
+                              (self.hostname, self.ip)))
+
+    def reboot(self):
+        SimulatedDevice.reboot(self)
+        self._set_sftp(False)
+
+    def _set_sftp(self, enabled):
+        state = self.state()
+        state['sftp'] = enabled
+        self.save_state(state)
+
+    def sftp_allowed(self):
+        return self.state().get('sftp', False)
+
+    def uptime_line(self):
+        seconds = int(max(0, self.seconds_up()))
+        parts = []
+        for (unit, size) in (('week', 7 * 24 * 3600), ('day', 24 * 3600),
+                             ('hour', 3600), ('minute', 60)):
+            parts.append('%d %s%s' % (seconds / size, unit,
+                                      's' * (seconds / size != 1)))
+            seconds %= size
+        return 'H3C %s uptime is %s' % (self.settings.get('board',
+                                                          'S5120-28C-EI'),
+                                        ', '.join(parts))
+
+    def display_version(self):
+        return ('H3C Comware Platform Software\n'
+                'Comware Software, Version %s, Release %s\n'
+                'Copyright (c) 2004-2010 Hangzhou H3C Tech. Co., Ltd. '
+                'All rights reserved.\n%s\n\n' %
+                (self.settings.get('version', '5.20'),
+                 self.settings.get('release', '2208P01'),
+                 self.uptime_line()))
+
+    def display_startup(self):
+        return (' MainBoard:\n'
+                '  Current startup saved-configuration file: flash:/%s\n'
+                '  Next main startup saved-configuration file: flash:/%s\n'
+                '  Next backup startup saved-configuration file: NULL\n' %
+                (self.CONFIG, self.CONFIG))
+
+    def dir(self, name):
+        name = name.split('/')[-1]
+        lines = ['Directory of flash:/', '']
+        if os.path.exists(self.path(name)):
+            info = os.stat(self.path(name))
+            lines.append('   0     -rw-  %8d  %s   %s' %
+                         (info.st_size,
+                          time.strftime('%b %d %Y %H:%M:%S',
+                                        time.localtime(info.st_mtime)),
+                          name))
+        else:
+            lines.append('File can not be found.')
+        lines.extend(['', '31496 KB total (20884 KB free)', ''])
+        return '\n'.join(lines)
+
+    def ask(self, question):
+        """Ask a question at the command line; the answer, '' at EOF"""
+        say(question)
+        answer = sys.stdin.readline()
+        self.round_trip()
+        return answer.strip()
+
+    def save(self):
+        if self.ask(' The current configuration will be written to the '
+                    'device. Are you sure?[Y/N]:').lower() != 'y':
+            return
+        self.ask(' Please input the file name(*.cfg)[flash:/%s]\n'
+                 '(To leave the existing filename unchanged, press the '
+                 'enter key):' % self.CONFIG)
+        with open(self.path(self.CONFIG), 'rb') as infile:
+            config = infile.read()
+        with open(self.path(self.CONFIG), 'wb') as outfile:
+            outfile.write(config)
+        say(' Validating file. Please wait....\n'
+            ' Saved the current configuration to mainboard device '
+            'successfully.\n')
+
+    def shell(self):
+        name = self.hostname
+        say('******************************************************'
+            '********************\n'
+            '* Copyright (c) 2004-2010 Hangzhou H3C Tech. Co., Ltd. '
+            'All rights reserved. *\n'
+            '******************************************************'
+            '********************\n\n')
+        system_view = False
+        while True:
+            if system_view:
+                say('[%s]' % name)
+            else:
+                say('<%s>' % name)
+            line = sys.stdin.readline()
+            if not line:
+                return 0
+            self.round_trip()
+            words = line.split()
+            if not words:
+                continue
+            elif words == ['quit'] or words == ['return']:
+                if not system_view:
+                    return 0
+                system_view = False
+            elif words == ['system-view']:
+                say(' System View: return to User View with Ctrl+Z.\n')
+                system_view = True
+            elif system_view and words == ['sftp', 'server', 'enable']:
+                self._set_sftp(True)
+                say(' %Start SFTP server\n')
+            elif words == ['display', 'version']:
+                say(self.display_version())
+            elif words == ['display', 'startup']:
+                say(self.display_startup())
+            elif words[0] == 'dir' and len(words) == 2:
+                say(self.dir(words[1]))
+            elif words[0] == 'save':
+                self.save()
+            elif words == ['reboot']:
+                say(' Start to check configuration with next startup '
+                    'configuration file, please wait.........DONE!\n')
+                if self.ask(' This command will reboot the device. '
+                            'Continue? [Y/N]:').lower() == 'y':
+                    say('#%s %s DEVM/1/REBOOT:\n'
+                        ' Reboot device by command.\n' %
+                        (time.strftime('%b %d %H:%M:%S:000 %Y'), name))
+                    self.reboot()
+                    return 0
+            else:
+                say('\n ^\n % Unrecognized command found at \'^\' '
+                    'position.\n')
+
+    def remote_path(self, directory, name):
+        return self.path(directory or '/', name)
+
+MAKES = {'ubiquiti' : UbiquitiDevice,
+         'mikrotik' : MikrotikDevice,
+         'h3c'      : H3CDevice}
+
+def make_device(ip, settings, root=None):
+    """The SimulatedDevice for a fleet entry"""
+    if root is None:
+        root = os.environ[ROOT_ENV]
+    return MAKES[settings['make']](ip, settings, os.path.join(root, ip))
+
+def find_device(host):
+    fleet = load_fleet()
+    if host not in fleet:
+        raise Disconnect('ssh: connect to host %s port 22: '
+                         'Connection refused' % host)
+    return make_device(host, fleet[host])
+
+def on_session(options):
+    """True if riding on a ControlMaster session that is up"""
+    path = options.get('ControlPath')
+    return options.get('ControlMaster', 'no') == 'no' and \
+           path is not None and os.path.exists(path)
+
+def open_connection(user, host, options):
+    """The device, connected to and (unless on a session) logged in to"""
+    device = find_device(host)
+    if on_session(options):
+        return device
+    if options.get('BatchMode') == 'yes':
+        raise Disconnect('%s@%s: Permission denied (publickey,password).' %
+                         (user, host))
+    device.connect(float(options.get('ConnectTimeout', 30)))
+    device.login(user)
+    return device
+
+def control(command, options):
+    """ssh -O check or -O exit on a ControlPath"""
+    path = options.get('ControlPath')
+    if path is None or not os.path.exists(path):
+        raise Disconnect('Control socket connect(%s): '
+                         'No such file or directory' % path)
+    if command == 'exit':
+        os.unlink(path)
+        sys.stderr.write('Exit request sent.\n')
+    return 0
+
+def ssh(args):
+    (options, flags, args) = parse_command_line(args)
+    (user, host, path) = split_target(args[0])
+    command = ' '.join(args[1:])
+    if 'O' in flags:
+        return control(flags['O'], options)
+    device = open_connection(user, host, options)
+    if 'N' in flags:
+        if options.get('ControlMaster') == 'yes':
+            with open(options['ControlPath'], 'w') as outfile:
+                outfile.write('%s\n' % host)
+        return 0
+    if command:
+        return device.run(command)
+    return device.shell()
+
+def copy(device, src, dst):
+    """Copy a device's file to here; False if it has no such file"""
+    if not os.path.isfile(src):
+        return False
+    device.transfer(os.path.getsize(src))
+    shutil.copyfile(src, dst)
+    return True
+
+def scp(args):
+    (options, flags, args) = parse_command_line(args)
+    (user, host, path) = split_target(args[0])
+    device = open_connection(user, host, options)
+    dst = args[1]
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(path))
+    if not copy(device, device.remote_path(None, path), dst):
+        sys.stderr.write('scp: %s: No such file or directory\n' % path)
+        return 1
+    return 0
+
+def sftp(args):
+    (options, flags, args) = parse_command_line(args)
+    (user, host, path) = split_target(args[0])
+    device = open_connection(user, host, options)
+    if not device.sftp_allowed():
+        raise Disconnect('Connection closed')
+    say('Connected to %s.\n' % host)
+    remote_dir = '/'
+    local_dir = os.getcwd()
+    while True:
+        say('sftp> ')
+        line = sys.stdin.readline()
+        if not line:
+            return 0
+        device.round_trip()
+        words = line.split()
+        if not words:
+            continue
+        elif words[0] in ('quit', 'bye', 'exit'):
+            return 0
+        elif words[0] == 'cd' and len(words) == 2:
+            remote_dir = os.path.join(remote_dir, words[1])
+        elif words[0] == 'lcd' and len(words) == 2:
+            local_dir = os.path.join(local_dir, words[1])
+        elif words[0] == 'get' and len(words) in (2, 3):
+            name = os.path.join(remote_dir, words[1])
+            dst = os.path.join(local_dir,
+                               (words + [os.path.basename(words[1])])[2])
+            say('Fetching %s to %s\n' % (name, dst))
+            if not copy(device, device.remote_path(remote_dir, words[1]),
+                        dst):
+                say('File "%s" not found.\n' % name)
+        else:
+            say('Invalid command.\n')
+
+def install(bin_dir):
+    """Write ssh, scp and sftp wrappers that run this script"""
+    if not os.path.isdir(bin_dir):
+        os.makedirs(bin_dir)
+    for tool in TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, 'w') as outfile:
+            outfile.write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n' %
+                          (sys.executable, os.path.abspath(__file__), tool))
+        os.chmod(path, 0755)
+
+if __name__ == '__main__':
+
+    tool = os.path.basename(sys.argv[0])
+    args = sys.argv[1:]
+    if tool not in TOOLS and args:
+        tool = args.pop(0)
+    if tool == 'install' and len(args) == 1:
+        install(args[0])
+        sys.exit(0)
+    if tool not in TOOLS or not args:
+        sys.exit('usage: %s install bin_dir | ssh|scp|sftp [options] '
+                 'user@host ...' % sys.argv[0])
+    try:
+        sys.exit({'ssh' : ssh, 'scp' : scp, 'sftp' : sftp}[tool](args))
+    except Disconnect, err:
+        sys.stderr.write('%s\n' % err)
+        sys.exit(255)
+    except KeyboardInterrupt:
+        sys.exit(255)
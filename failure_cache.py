@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+# failure_cache.py
+
+"""Remembers hosts that keep failing the same way, and rests them a while.
+
+A host that fails a visit the same way night after night (no ping, wrong
+password, changed host key, SSH refused or timing out) is put in backoff: it
+is skipped for one night, then two, then four, and so on up to a limit, and
+given a full visit again only when its backoff runs out.  Until then it costs
+next to nothing:
+
+  * a host that would not ping is let back in as soon as the ping sweep sees
+    it answer
+  * a host whose SSH was refused or timed out is let back in if its SSH port
+    answers with a banner (a quick TCP connect)
+  * a password or host key failure just waits out its backoff
+
+One good visit (or a different kind of failure) starts the count over.  The
+cache is kept in a small tab-separated file between runs.
+"""
+
+from __future__ import with_statement
+import os
+import sys
+import time
+import socket
+import tempfile
+import threading
+import crawler_util
+from host_control import HostControlError
+
+HOUR = 60 * 60
+DAY  = 24 * HOUR
+
+HOST_KEY = 'Host Key Failed' # not a HostControlError code, but chronic too
+
+# failures worth resting a host for
+CACHED_CODES = (HostControlError.NOPING, HostControlError.PASSWD,
+                HostControlError.SSH, HostControlError.TIMEOUT, HOST_KEY)
+# failures a knock on the SSH port can tell us are over
+PROBED_CODES = (HostControlError.SSH, HostControlError.TIMEOUT)
+
+BACKOFF_AFTER      = 2  # failures in a row before a host is skipped at all
+MAX_NIGHTS_SKIPPED = 16 # longest a host is skipped, in nights
+SSH_PORT           = 22
+PROBE_TIMEOUT      = 3  # seconds to wait for an SSH banner
+
+def failure_code(record):
+    """The cacheable kind of failure of a VisitRecord, or None"""
+    if record.error is None:
+        return None
+    (name, msg) = record.error
+    if name == 'no_ping':
+        code = HostControlError.NOPING
+    elif 'Host key verification failed' in msg:
+        code = HOST_KEY
+    elif name == HostControlError.__name__:
+        code = msg.split(':')[0]
+    else:
+        code = None
+    if code in CACHED_CODES:
+        return code
+    return None
+
+def probe_ssh(address, timeout=PROBE_TIMEOUT):
+    """True if something answers on the SSH port with an SSH banner"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        try:
+            sock.connect((str(address), SSH_PORT))
+            return sock.recv(64).startswith('SSH-')
+        except (socket.error, socket.timeout):
+            return False
+    finally:
+        sock.close()
+
+class Failure(object):
+    """How one host has been failing"""
+    __slots__ = ('code', 'count', 'last_failure', 'retry_at')
+
+    def __init__(self, code, count=0, last_failure=0, retry_at=0):
+        self.code         = code
+        self.count        = count        # failures with this code in a row
+        self.last_failure = last_failure # epoch seconds
+        self.retry_at     = retry_at     # skip the host until then
+
+    def nights_skipped(self):
+        """How many nights this many failures in a row earns"""
+        if self.count < BACKOFF_AFTER:
+            return 0
+        return min(2 ** (self.count - BACKOFF_AFTER), MAX_NIGHTS_SKIPPED)
+
+    def __str__(self):
+        if not self.retry_at:
+            return '%s x%d' % (self.code, self.count)
+        return '%s x%d, until %s' % (self.code, self.count,
+                                     time.strftime('%Y-%m-%d',
+                                                   time.localtime(
+                                                       self.retry_at)))
+
+class FailureCache(object):
+    """Chronic failures by host, persisted between runs; thread-safe"""
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.failures   = {} # IP as integer -> Failure
+        self.lock       = threading.Lock()
+        if os.path.exists(cache_file):
+            with open(cache_file) as infile:
+                for line in infile:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) != 5:
+                        continue # damaged line: forget that host's failures
+                    self.failures[crawler_util.ip_to_int(fields[0])] = \
+                        Failure(fields[1], *[int(field)
+                                             for field in fields[2:]])
+
+    def save(self):
+        with self.lock:
+            lines = ['\t'.join([crawler_util.int_to_ip(ip), failure.code,
+                                str(failure.count),
+                                str(failure.last_failure),
+                                str(failure.retry_at)])
+                     for (ip, failure) in sorted(self.failures.items())]
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(self.cache_file))
+        with os.fdopen(fd, 'w') as outfile:
+            for line in lines:
+                outfile.write(line)
+                outfile.write('\n')
+        os.rename(tmp, self.cache_file)
+
+    def answered(self, reachable):
+        """Given a ping sweep's {address: rtt or None}, forget the ping
+        failures of hosts that answered"""
+        with self.lock:
+            for (address, rtt) in reachable.items():
+                if rtt is None:
+                    continue
+                ip = crawler_util.ip_to_int(address)
+                failure = self.failures.get(ip)
+                if failure and failure.code == HostControlError.NOPING:
+                    del self.failures[ip]
+
+    def backing_off(self, host, now=None):
+        """The host's Failure if it should be skipped now, else None"""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            failure = self.failures.get(host.ip)
+        if failure is None or failure.retry_at <= now:
+            return None
+        if failure.code in PROBED_CODES and probe_ssh(host.ip_addr):
+            return None
+        return failure
+
+    def visited(self, host, code, now=None):
+        """Record how a visit went: code is what failure_code() made of it"""
+        if now is None:
+            now = int(time.time())
+        with self.lock:
+            if code is None:
+                self.failures.pop(host.ip, None)
+                return
+            failure = self.failures.get(host.ip)
+            if failure is None or failure.code != code:
+                failure = self.failures[host.ip] = Failure(code)
+            failure.count += 1
+            failure.last_failure = now
+            nights = failure.nights_skipped()
+            if nights:
+                # half a day over, so the same hour n nights on is inside
+                failure.retry_at = now + nights * DAY + DAY / 2
+            else:
+                failure.retry_at = 0
+
+    def backed_off(self, now=None):
+        """How many hosts are in backoff"""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            return len([failure for failure in self.failures.values()
+                        if failure.retry_at > now])
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        sys.exit('usage: %s failure_cache' % sys.argv[0])
+
+    cache = FailureCache(sys.argv[1])
+    for (ip, failure) in sorted(cache.failures.items()):
+        print crawler_util.int_to_ip(ip), failure
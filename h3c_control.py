@@ -19,6 +19,11 @@ from host_control import HostControl, HostControlError
 class H3CSwitch(HostControl):
     """Controls an H3C switch"""
 
+    # the SSH login, the one to start the SFTP server and SFTP's; display
+    # version and startup, dir, and the system-view to enable SFTP (twice
+    # over); the config
+    VISIT_STEPS = (3, 8, 1)
+
     def __init__(self, hostname, ipaddress, pwd,
                        max_uptime=crawler_util.SEVEN_DAYS):
         HostControl.__init__(self, hostname, ipaddress,
@@ -26,6 +31,10 @@ class H3CSwitch(HostControl):
         self.host_make = crawler_util.HOST_MAKE_H3C
         self.version = None
         self.hardware = None
+        self.uptime = None
+        self.config_filename = None    # startup config, as the switch names it
+        self.config_fingerprint = None # size and date of the startup config
+        self.sftp_enabled = False
 
     def _sanitize(self, raw_output):
         '''sanitize ugly H3C output'''
@@ -36,35 +45,100 @@ class H3CSwitch(HostControl):
             if s: output.append(s)
         return output
 
-    def versionCB(self, child):
-        """command line interaction to pull version lines"""
+    def _expect(self, child, pattern, timeout=-1):
+        """child.expect() that turns trouble into HostControlErrors"""
+        try:
+            reply = child.expect([pexpect.TIMEOUT, pattern], timeout=timeout)
+        except pexpect.ExceptionPexpect, err:
+            raise HostControlError(HostControlError.SSH, self.decode_err(err))
+        if reply == 0: # Timeout
+            raise HostControlError(HostControlError.TIMEOUT)
+
+    def _config_unchanged(self):
+        """True if the startup config is the same as when last pulled"""
+        if self.config_fingerprint is None or self.store is None:
+            return False
+        entry = self.store.fingerprints(self.hostname).get(
+                    os.path.join(self.host_make, '%s.cfg' % self.hostname))
+        return entry is not None and entry[0] == self.config_fingerprint
+
+    def visitCB(self, child):
+        """command line interaction for everything a visit wants, in one
+        login: version and uptime (one 'display version'), the startup
+        config's name, size and date, and the SFTP server turned on if the
+        config will need pulling"""
 
         PROMPT = '<[\w-]+>'
-        child.expect(PROMPT)
+        self._expect(child, PROMPT)
 
         child.sendline('display version')
-        child.expect(PROMPT)
-        versions = []
+        self._expect(child, PROMPT)
+        self._parse_version(self._sanitize(child.before))
+
+        child.sendline('display startup')
+        self._expect(child, PROMPT)
+        path = ''
         for line in self._sanitize(child.before):
-            if line.find('Version') >= 0:
-                versions.append(line)
+            if line.startswith('Next main startup saved-configuration file:'):
+                path = line.split()[-1]
+                break
+        self.config_filename = path.split('/')[-1]
+
+        # its size and date tell us if it has changed since we last pulled it
+        self.config_fingerprint = None
+        if path:
+            child.sendline('dir %s' % path)
+            self._expect(child, PROMPT)
+            self._parse_dir(self._sanitize(child.before))
+
+        if path and not self._config_unchanged():
+            child.sendline('system-view')
+            self._expect(child, '\[[\w-]+\]')
+            child.sendline('sftp server enable')
+            self._expect(child, '\[[\w-]+\]')
+            child.sendline('quit')
+            self._expect(child, PROMPT)
+            self.sftp_enabled = True
 
         child.sendline('quit')
         child.expect([pexpect.EOF])
-        return versions
+        return self.version
+
+    def _parse_version(self, lines):
+        """Version, hardware and uptime out of 'display version'"""
+        version_pattern = '^Comware Software, Version (\S+), Release (\S+)$'
+        uptime_pattern = '^H3C (\S+) uptime is '
+        self.uptime = 0
+        for line in lines:
+            match = re.search(version_pattern, line)
+            if match:
+                self.version = match.group(1)
+            match = re.search(uptime_pattern, line)
+            if match:
+                self.hardware = match.group(1)
+                self.uptime = self._computeUptime(line)
+
+    def _parse_dir(self, lines):
+        """The startup config's size and date, out of 'dir <it>'"""
+        for line in lines:
+            # e.g. "0  -rw-  3144  Apr 26 2000 12:05:36  startup.cfg"
+            parts = line.split()
+            if len(parts) > 3 and parts[-1].endswith(self.config_filename) \
+               and parts[2].isdigit():
+                self.config_fingerprint = ' '.join(parts[2:-1])
+                break
+
+    def gather_facts(self):
+        """Do the one-login visit, unless done already"""
+        if self.uptime is None:
+            self.ssh_command(None, self.visitCB)
 
     def get_version(self):
-        if self.version == None:
-            versions = self.ssh_command(None, self.versionCB)
-            pattern = '^Comware Software, Version (\S+), Release (\S+)$'
-            for line in versions:
-                match = re.search(pattern, line)
-                if match:
-                    self.version = match.group(1)
-                    break
+        self.gather_facts()
         return self.version
 
     def get_hardware(self):
+        self.gather_facts()
         if self.hardware == None:
             self.hardware = 'UNDEFINED'
         return self.hardware
@@ -85,62 +159,13 @@ class H3CSwitch(HostControl):
                 uptime += number * 60
         return uptime
 
-    def uptimeCB(self, child):
-        """command line interaction to pull the uptime"""
-
-        # wait for the prompt
-        PROMPT = '<[\w-]+>'
-        child.expect(PROMPT)
-
-        child.sendline('display version')
-        child.expect(PROMPT)
-        uptime = 0
-        pattern = '^H3C (\S+) uptime is '
-        for line in self._sanitize(child.before):
-            if re.search(pattern, line):
-                uptime = self._computeUptime(line)
-                break
-
-        child.sendline('quit')
-        child.expect([pexpect.EOF])
-        return uptime
-
     def get_uptime(self):
-        return self.ssh_command(None, self.uptimeCB)
-
-    def configFilenameCB(self, child):
-        """command line interaction to pull the config filename"""
-
-        # wait for the prompt
-        PROMPT = '<[\w-]+>'
-        try:
-            reply = child.expect([pexpect.TIMEOUT, PROMPT])
-        except pexpect.ExceptionPexpect, err:
-            raise HostControlError(HostControlError.SSH, self.decode_err(err))
-        if reply == 0: # Timeout
-            raise HostControlError(HostControlError.TIMEOUT)
-
-        child.sendline('display startup')
-        try:
-            reply = child.expect([pexpect.TIMEOUT, PROMPT])
-        except pexpect.ExceptionPexpect, err:
-            raise HostControlError(HostControlError.SSH, self.decode_err(err))
-        if reply == 0: # Timeout
-            raise HostControlError(HostControlError.TIMEOUT)
-
-        filename = ''
-        for line in self._sanitize(child.before):
-            if line.startswith('Next main startup saved-configuration file:'):
-                parts = line.split()
-                filename = parts[-1].split('/')[-1]
-                break
-
-        child.sendline('quit')
-        child.expect([pexpect.EOF])
-        return filename
+        self.gather_facts()
+        return self.uptime
 
     def get_config_filename(self):
-        return self.ssh_command(None, self.configFilenameCB)
+        self.gather_facts()
+        return self.config_filename
 
     def _start_sftp_server_CB(self, child):
         child.expect('<[\w-]+>')
@@ -160,9 +185,15 @@ class H3CSwitch(HostControl):
         dst_dir = HostControl.backup(self, backup_root)
         dst_file = '%s.cfg' % self.hostname
         src_dir = None
-        src_file = self.get_config_filename()
-        self._start_sftp_server()
-        self._safe_sftp(src_dir, src_file, dst_dir, dst_file)
+        self.gather_facts()
+        src_file = self.config_filename
+        fingerprint = self.config_fingerprint
+        if self._unchanged(fingerprint, dst_dir, dst_file):
+            return '%s unchanged' % src_file
+        if not self.sftp_enabled:
+            self._start_sftp_server()
+        checksum = self._safe_sftp(src_dir, src_file, dst_dir, dst_file)
+        self._set_fingerprint(fingerprint, dst_dir, dst_file, checksum)
         return src_file
 
     def rebootCB(self, child):
@@ -188,7 +219,9 @@ class H3CSwitch(HostControl):
 
         child.sendline('Y')
         try:
-            reply = child.expect([pexpect.TIMEOUT, 'press the enter key\):'])
+            # writing the config to flash can take a while
+            reply = child.expect([pexpect.TIMEOUT, 'press the enter key\):'],
+                                 timeout=self._timeout('transfer'))
         except pexpect.ExceptionPexpect, err:
             raise HostControlError(HostControlError.SSH, self.decode_err(err))
         if reply == 0: # Timeout
@@ -234,9 +267,11 @@ class H3CSwitch(HostControl):
         child.close()
         return ''
 
-    def reboot(self, tick):
+    def reboot(self, tick, tracker=None):
         """login and then transfer control to callback"""
-        return HostControl.reboot(self, None, 10, tick, self.rebootCB)
+        self.uptime = None # facts are stale after this
+        return HostControl.reboot(self, None, 10, tick, self.rebootCB,
+                                  tracker)
 
     def commandCB(self, child, command):
         """arbitrary single command line interaction"""
@@ -11,14 +11,22 @@ Written by jwiggins@inveneo.org 2011-2012
 import os
 import sys
 import time
+import errno
+import shutil
 import pexpect
 import tempfile
 import subprocess
+import threading
 import crawler_util
+from backup_store import BackupStore
+from timeout_policy import TimeoutPolicy
+from crawler_util import CHECKSUM, file_checksum
 
 SSH_NEWKEY      = '(?i)are you sure you want to continue connecting'
 PASSWORD_PROMPT = '(?i)password'
-TEMPFILE        = '/tmp/host_control.tmp'
+PASSWORD_DENIED = '(?i)Permission denied'
+STAGING_SUFFIX  = '.part' # files being transferred, until renamed
+SSH_FAILED      = 255     # ssh's own exit status, when it gives up
 
 class HostControlError(BaseException):
     """The exception type for this module"""
@@ -28,6 +36,8 @@ class HostControlError(BaseException):
     HSHAKE   = 'Handshake Error'
     PASSWD   = 'Password Error'
     NOPING   = 'Cannot Ping'
+    PARSE    = 'Parse Error'
+    API      = 'API Error'
 
     def __init__(self, code, tail=None):
         self.code = code
@@ -44,6 +54,9 @@ class HostControl(object):
 
     MAX_REBOOT_WAIT_SEC = 60 * 20 # 20 min wait for reboot (seconds)
     FULL_BOOT_WAIT      = 60      # extra wait from pingable to fully booted
+    SESSION_REUSE       = True    # False if device can't multiplex SSH
+    VISIT_STEPS         = (1, 1, 1) # most logins, commands and transfers
+                                    # in a visit, for the watchdog
 
     def __init__(self, hostname, ipaddress, user, pwd,
                        max_uptime=crawler_util.SEVEN_DAYS):
@@ -53,6 +66,13 @@ class HostControl(object):
         self.pwd        = pwd
         self.max_uptime = max_uptime
         self.host_make  = crawler_util.HOST_MAKE_UNKNOWN # set in subclass
+        self.control_dir  = None # holds socket of open SSH session, if any
+        self.control_path = None
+        self.store        = None # BackupStore, once backup() has been called
+        self.backup_checksums = [] # of the files pulled by backup()
+        self.timeouts = TimeoutPolicy() # how long to wait on this host
+        self.timings  = [] # (kind, what, seconds) of each wait on the host
+        self.sessions = None # session_replay recording or replaying, if any
 
     ##### ABSTRACT METHODS: Override these in your subclass #####
 
@@ -68,15 +88,36 @@ class HostControl(object):
         """Get the uptime of the host"""
         raise HostControlError(HostControlError.NOT_IMPL)
 
+    def get_routing(self):
+        """Routing tables for network_topology, if the host is a router
+        and this visit learned them; None otherwise"""
+        return None
+
     ##### PRIVATE METHODS #####
 
     def is_pingable(self):
-        ret = subprocess.call("ping -n -c 1 %s" % self.ipaddress,
-                              shell=True,
-                              stdout=open('/dev/null', 'w'),
-                              stderr=subprocess.STDOUT)
+        try:
+            ret = self._call(['ping', '-n', '-c', '1', str(self.ipaddress)])
+        except OSError:
+            return False # no ping program to be had
         return (ret == 0)
 
+    def _call(self, argv):
+        """Run a local program that talks to the host, throwing away its
+        output; returns its exit status"""
+        if self.sessions is not None:
+            return self.sessions.call(argv)
+        return subprocess.call(argv, stdout=open('/dev/null', 'w'),
+                               stderr=subprocess.STDOUT)
+
+    def _popen(self, argv):
+        """subprocess.Popen a local program that talks to the host, with
+        its output and errors piped back to us"""
+        if self.sessions is not None:
+            return self.sessions.popen(argv)
+        return subprocess.Popen(argv, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+
     def decode_err(self, err):
         """Parse the ugly pexpect exception"""
         message = []
@@ -91,20 +132,46 @@ class HostControl(object):
                 message.append(line)
         return ''.join(message)
 
-    def ssh_command(self, command, callback=None):
-        """Use pexpect to interact with remote SSH server"""
-
-        if command:
-            child = pexpect.spawn('ssh %s@%s %s' %
-                                        (self.user, self.ipaddress, command))
-        else:
-            child = pexpect.spawn('ssh %s@%s' % (self.user, self.ipaddress))
-        # uncomment this to see more verbosity
-        #child.logfile = sys.stdout
-
-        # start the connection; expect password prompt
+    def _timed(self, kind, what, started):
+        """Note how long a 'connect', 'command', 'transfer' or 'reboot'
+        that began at started took; what says which one it was"""
+        self.timings.append((kind, what, time.time() - started))
+
+    def _timeout(self, kind):
+        """Seconds to wait for 'connect', 'command' or 'transfer' (see
+        TimeoutPolicy); a Timeout error if the visit is already over time"""
+        seconds = getattr(self.timeouts, 'for_%s' % kind)()
+        if seconds <= 0:
+            raise HostControlError(HostControlError.TIMEOUT,
+                                   'visit took over %d seconds' %
+                                       self.timeouts.visit)
+        return seconds
+
+    def _spawn(self, command, kind='command'):
+        """pexpect.spawn ssh/scp/sftp, giving up on connecting in time and
+        making the timeout of this kind the default for its expect()s"""
+        (program, args) = command.split(' ', 1)
+        command = '%s -o ConnectTimeout=%d %s' % \
+                      (program, max(1, self._timeout('connect')), args)
+        if self.sessions is not None:
+            return self.sessions.spawn(command, self._timeout(kind))
+        return pexpect.spawn(command, timeout=self._timeout(kind))
+
+    def _ssh_options(self):
+        """Options that make ssh/scp/sftp ride on the open session, if any.
+        BatchMode makes them fail rather than ask for a password if the
+        session dies under them."""
+        if self.control_path is None:
+            return ''
+        return '-o ControlMaster=no -o ControlPath=%s -o BatchMode=yes ' % \
+                    self.control_path
+
+    def _login(self, child):
+        """Get a freshly spawned ssh/scp/sftp child to where it wants the
+        password, then send the password"""
         try:
-            reply = child.expect([pexpect.TIMEOUT, SSH_NEWKEY, PASSWORD_PROMPT])
+            reply = child.expect([pexpect.TIMEOUT, SSH_NEWKEY, PASSWORD_PROMPT],
+                                 timeout=self._timeout('connect'))
         except pexpect.ExceptionPexpect, err:
             raise HostControlError(HostControlError.SSH, self.decode_err(err))
 
@@ -114,12 +181,102 @@ class HostControl(object):
         elif reply == 1: # SSH does not have the public key cached
             try:
                 child.sendline('yes')
-                child.expect(PASSWORD_PROMPT)
+                child.expect(PASSWORD_PROMPT,
+                             timeout=self._timeout('connect'))
             except pexpect.ExceptionPexpect:
                 raise HostControlError(HostControlError.HSHAKE)
 
-        # send password; either get command output or pass child to callback
         child.sendline(self.pwd)
+
+    def _on_session(self):
+        """True while there is a session from open_session().  It is only
+        checked once, as it opens; after that, a run on it that fails the
+        way ssh does (see _session_lost) is what says it has died."""
+        return self.control_path is not None
+
+    def _session_lost(self, status):
+        """A run on the session exited with status: if that is ssh giving
+        up (with BatchMode, rather than log in), the session has died under
+        us.  Then forget it and return True, so the caller can do the run
+        again by logging in; from then on, we log in every time."""
+        if self.control_path is None or status != SSH_FAILED:
+            return False
+        self.close_session()
+        return True
+
+    def open_session(self):
+        """Log in once and keep the connection open (OpenSSH ControlMaster),
+        so that later commands and file transfers skip the login handshake.
+        Call close_session() when done with the host."""
+        if not self.SESSION_REUSE or self.control_path is not None:
+            return
+        control_dir = tempfile.mkdtemp(prefix='crawler-ssh-')
+        control_path = os.path.join(control_dir, 'master')
+        started = time.time()
+
+        # -f puts ssh in the background once logged in, closing our pty
+        child = self._spawn('ssh -f -N -o ControlMaster=yes '
+                            '-o ControlPath=%s %s@%s' %
+                                (control_path, self.user, self.ipaddress))
+        try:
+            self._login(child)
+            try:
+                reply = child.expect([pexpect.EOF, PASSWORD_DENIED],
+                                     timeout=self._timeout('connect'))
+            except pexpect.ExceptionPexpect, err:
+                raise HostControlError(HostControlError.PASSWD,
+                                       self.decode_err(err))
+            if reply == 1: # bad password
+                raise HostControlError(HostControlError.PASSWD)
+            child.close(force=True)
+            if child.exitstatus != 0:
+                raise HostControlError(HostControlError.SSH, child.before)
+        except:
+            child.close(force=True)
+            shutil.rmtree(control_dir, True)
+            raise
+        self.control_dir = control_dir
+        self.control_path = control_path
+        self._timed('connect', 'session', started)
+        # once per visit: make sure the master is there to ride on
+        if self._call(['ssh', '-O', 'check',
+                       '-o', 'ControlPath=%s' % control_path,
+                       '%s@%s' % (self.user, self.ipaddress)]) != 0:
+            self.close_session()
+
+    def close_session(self):
+        """Shut down the connection opened by open_session(), if any"""
+        if self.control_path is None:
+            return
+        self._call(['ssh', '-o', 'ControlPath=%s' % self.control_path,
+                    '-O', 'exit', '%s@%s' % (self.user, self.ipaddress)])
+        shutil.rmtree(self.control_dir, True)
+        self.control_dir = None
+        self.control_path = None
+
+    def ssh_command(self, command, callback=None, timeout='command'):
+        """Use pexpect to interact with remote SSH server; timeout is the
+        kind of wait for the command (see TimeoutPolicy)"""
+
+        on_session = self._on_session()
+        started = time.time()
+        if command:
+            child = self._spawn('ssh %s%s@%s %s' % (self._ssh_options(),
+                                        self.user, self.ipaddress, command),
+                                timeout)
+        else:
+            child = self._spawn('ssh %s%s@%s' % (self._ssh_options(),
+                                        self.user, self.ipaddress), timeout)
+        # uncomment this to see more verbosity
+        #child.logfile = sys.stdout
+
+        # on an open session we are already logged in
+        if not on_session:
+            self._login(child)
+            self._timed('connect', 'login', started)
+            started = time.time()
+
+        # either get command output or pass child to callback
         lines = []
         if command:
             try:
@@ -130,67 +287,199 @@ class HostControl(object):
                                        self.decode_err(err))
             if reply == 0: # command finished
                 before = child.before.split('\n')
-                lines = before[1:-1] # tear off garbage at beginning and end
+                if on_session:
+                    lines = before[:-1] # tear off garbage at end
+                else:
+                    lines = before[1:-1] # and at beginning
             elif reply == 1: # bad password
                 raise HostControlError(HostControlError.PASSWD)
         else:
-            lines = callback(child)
+            try:
+                lines = callback(child)
+            except:
+                child.close(force=True)
+                if on_session and self._session_lost(child.exitstatus):
+                    return self.ssh_command(command, callback, timeout)
+                raise
         child.close(force=True)
+        if on_session and self._session_lost(child.exitstatus):
+            return self.ssh_command(command, callback, timeout)
+        self._timed(timeout, command or callback.__name__, started)
         return lines
 
     def _scp(self, src_dir, src_file, dst_dir, dst_file):
         """A little SCP utility that uses pexpect to pull one file"""
-        child = pexpect.spawn('scp %s@%s:%s %s' % \
-                                  (self.user,
+        on_session = self._on_session()
+        started = time.time()
+        child = self._spawn('scp %s%s@%s:%s %s' % \
+                                  (self._ssh_options(),
+                                   self.user,
                                    self.ipaddress,
                                    os.path.join(src_dir, src_file),
                                    os.path.join(dst_dir, dst_file)))
         # uncomment this to see more verbosity
         #child.logfile = sys.stdout
 
-        # start the connection; expect password prompt
-        try:
-            reply = child.expect([pexpect.TIMEOUT, SSH_NEWKEY, PASSWORD_PROMPT])
-        except pexpect.ExceptionPexpect, err:
-            raise HostControlError(HostControlError.SSH, self.decode_err(err))
-
-        if reply == 0: # Timeout
-            raise HostControlError(HostControlError.TIMEOUT)
-
-        elif reply == 1: # SSH does not have the public key cached
-            try:
-                child.sendline('yes')
-                child.expect(PASSWORD_PROMPT)
-            except pexpect.ExceptionPexpect:
-                raise HostControlError(HostControlError.HSHAKE)
+        # log in unless on an open session, and wait for command to exit
+        if not on_session:
+            self._login(child)
+        child.expect([pexpect.EOF], timeout=self._timeout('transfer'))
+        child.close(force=True)
+        if on_session and self._session_lost(child.exitstatus):
+            return self._scp(src_dir, src_file, dst_dir, dst_file)
+        self._timed('transfer', src_file, started)
+
+    def _staging_file(self, dst_dir, dst_file):
+        """Name for a transfer to land under before being renamed into place.
+        It is in the destination directory, so the rename is atomic, and it is
+        unique, so transfers cannot trip over each other.  The file itself is
+        not left in place, so a transfer that fails to create it is noticed
+        when the rename fails."""
+        (fd, staging) = tempfile.mkstemp(prefix='.%s.' % dst_file,
+                                         suffix=STAGING_SUFFIX, dir=dst_dir)
+        os.close(fd)
+        os.unlink(staging)
+        return staging
+
+    def _commit_staging(self, staging, dst_dir, dst_file, checksum=None):
+        """Put a finished transfer into the backup store (or, outside of
+        backup(), just rename it into place); returns its checksum"""
+        dst_path = os.path.join(dst_dir, dst_file)
+        if self.store is None:
+            os.rename(staging, dst_path)
+            checksum = checksum or file_checksum(dst_path)
+        else:
+            checksum = self.store.add(staging, self.hostname, dst_path,
+                                      checksum)
+        self.backup_checksums.append(checksum)
+        return checksum
+
+    def _discard_staging(self, staging):
+        """Transfer failed: remove what it left behind"""
+        if os.path.exists(staging):
+            os.unlink(staging)
+
+    def _unchanged(self, fingerprint, dst_dir, dst_file):
+        """True if the file already backed up to dst has this fingerprint,
+        in which case it counts as backed up again without a transfer"""
+        if fingerprint is None or self.store is None:
+            return False
+        checksum = self.store.unchanged(self.hostname,
+                                        os.path.join(dst_dir, dst_file),
+                                        fingerprint)
+        if checksum is None:
+            return False
+        self.backup_checksums.append(checksum)
+        return True
 
-        # send password and wait for command to exit
-        child.sendline(self.pwd)
-        child.expect([pexpect.EOF])
+    def _set_fingerprint(self, fingerprint, dst_dir, dst_file, checksum):
+        """Remember the fingerprint of a file just backed up to dst"""
+        if fingerprint is None or self.store is None:
+            return
+        self.store.set_fingerprint(self.hostname,
+                                   os.path.join(dst_dir, dst_file),
+                                   fingerprint, checksum)
 
     def _safe_scp(self, src_dir, src_file, dst_dir, dst_file):
-        """Uses SCP to a temp file and then moves the temp file if OK"""
-        (tmp_dir, tmp_file) = os.path.split(TEMPFILE)
+        """Uses SCP to a staging file and then moves it into place if OK.
+        Returns the checksum of the file."""
+        staging = self._staging_file(dst_dir, dst_file)
+        try:
+            self._scp(src_dir, src_file, dst_dir, os.path.basename(staging))
+            return self._commit_staging(staging, dst_dir, dst_file)
+        except:
+            # file transfer failed: remove staging file
+            self._discard_staging(staging)
+            raise
+
+    def _stream(self, src_dir, src_file, dst):
+        """Pipe a remote file through 'cat' on the open session straight
+        into dst; returns the checksum of what was written, or None if the
+        session died under it"""
+        checksum = CHECKSUM()
+        started = time.time()
+        argv = ['ssh'] + self._ssh_options().split() + \
+               ['%s@%s' % (self.user, self.ipaddress),
+                'cat %s' % os.path.join(src_dir, src_file)]
+        sp = self._popen(argv)
+        # there's no expect() here to time out, so kill it if it takes long
+        watchdog = threading.Timer(self._timeout('transfer'), sp.kill)
+        watchdog.start()
+        # stderr is drained alongside, or a chatty one fills its pipe and
+        # stalls ssh while we wait on stdout
+        errors = []
+        drain = threading.Thread(target=lambda:
+                                     errors.append(sp.stderr.read()))
+        drain.setDaemon(True)
+        drain.start()
+        outfile = open(dst, 'wb')
+        try:
+            while True:
+                chunk = sp.stdout.read(crawler_util.CHUNK_SIZE)
+                if not chunk:
+                    break
+                checksum.update(chunk)
+                outfile.write(chunk)
+        finally:
+            outfile.close()
+            watchdog.cancel()
+        drain.join()
+        stderr = ''.join(errors)
+        if sp.wait() != 0:
+            if self._session_lost(sp.returncode):
+                return None
+            if sp.returncode < 0:
+                raise HostControlError(HostControlError.TIMEOUT,
+                                       'transfer killed')
+            raise HostControlError(HostControlError.SSH, stderr.strip())
+        self._timed('transfer', src_file, started)
+        return checksum.hexdigest()
+
+    def _safe_stream(self, src_dir, src_file, dst_dir, dst_file):
+        """Streams the remote file into place over the open session (or, if
+        there is no session, uses SCP).  Returns the checksum of the file."""
+        if not self._on_session():
+            return self._safe_scp(src_dir, src_file, dst_dir, dst_file)
+        staging = self._staging_file(dst_dir, dst_file)
         try:
-            self._scp(src_dir, src_file, tmp_dir, tmp_file)
-            os.rename(TEMPFILE, os.path.join(dst_dir, dst_file))
+            checksum = self._stream(src_dir, src_file, staging)
+            if checksum is None:
+                # the session died under it: log in and pull it that way
+                self._discard_staging(staging)
+                return self._safe_scp(src_dir, src_file, dst_dir, dst_file)
+            return self._commit_staging(staging, dst_dir, dst_file, checksum)
         except:
-            # file transfer failed: remove temp file
-            if os.path.exists(TEMPFILE):
-                os.unlink(TEMPFILE)
+            # file transfer failed: remove staging file
+            self._discard_staging(staging)
             raise
 
     def _sftp(self, src_dir, src_file, dst_dir, dst_file):
         """A little SFTP utility that uses pexpect to pull one file"""
-        child = pexpect.spawn('sftp %s@%s' % (self.user, self.ipaddress))
-        try:
-            reply = child.expect([pexpect.TIMEOUT, PASSWORD_PROMPT])
-        except pexpect.ExceptionPexpect, err:
-            raise HostControlError(HostControlError.SSH, self.decode_err(err))
-        if reply == 0: # Timeout
-            raise HostControlError(HostControlError.TIMEOUT)
-        child.sendline(self.pwd)
-        child.expect('sftp>')
+        on_session = self._on_session()
+        started = time.time()
+        child = self._spawn('sftp %s%s@%s' % (self._ssh_options(),
+                                              self.user, self.ipaddress))
+        if on_session:
+            try:
+                child.expect('sftp>')
+            except pexpect.EOF:
+                child.close(force=True)
+                if not self._session_lost(child.exitstatus):
+                    raise
+                return self._sftp(src_dir, src_file, dst_dir, dst_file)
+        else:
+            try:
+                reply = child.expect([pexpect.TIMEOUT, PASSWORD_PROMPT],
+                                     timeout=self._timeout('connect'))
+            except pexpect.ExceptionPexpect, err:
+                raise HostControlError(HostControlError.SSH,
+                                       self.decode_err(err))
+            if reply == 0: # Timeout
+                raise HostControlError(HostControlError.TIMEOUT)
+            child.sendline(self.pwd)
+            child.expect('sftp>')
+            self._timed('connect', 'login', started)
+        started = time.time()
         if src_dir:
             child.sendline('cd %s' % src_dir)
             child.expect('sftp>')
@@ -198,41 +487,114 @@ class HostControl(object):
             child.sendline('lcd %s' % dst_dir)
             child.expect('sftp>')
         child.sendline('get %s %s' % (src_file, dst_file))
-        child.expect('sftp>')
+        child.expect('sftp>', timeout=self._timeout('transfer'))
         child.sendline('quit')
         child.expect([pexpect.EOF])
         child.close()
+        self._timed('transfer', src_file, started)
 
     def _safe_sftp(self, src_dir, src_file, dst_dir, dst_file):
-        """Uses SFTP to a temp file and then moves the temp file if OK"""
-        (tmp_dir, tmp_file) = os.path.split(TEMPFILE)
+        """Uses SFTP to a staging file and then moves it into place if OK.
+        Returns the checksum of the file."""
+        staging = self._staging_file(dst_dir, dst_file)
+        try:
+            self._sftp(src_dir, src_file, dst_dir, os.path.basename(staging))
+            return self._commit_staging(staging, dst_dir, dst_file)
+        except:
+            # file transfer failed: remove staging file
+            self._discard_staging(staging)
+            raise
+
+    def _safe_write(self, lines, dst_dir, dst_file):
+        """Writes lines of text to a staging file and moves it into place.
+        Returns the checksum of the file."""
+        return self._safe_write_data(''.join([line + '\n' for line in lines]),
+                                     dst_dir, dst_file)
+
+    def _safe_write_data(self, data, dst_dir, dst_file):
+        """Writes data as is to a staging file and moves it into place.
+        Returns the checksum of the file."""
+        staging = self._staging_file(dst_dir, dst_file)
         try:
-            self._sftp(src_dir, src_file, tmp_dir, tmp_file)
-            os.rename(TEMPFILE, os.path.join(dst_dir, dst_file))
+            outfile = open(staging, 'wb')
+            try:
+                outfile.write(data)
+            finally:
+                outfile.close()
+            return self._commit_staging(staging, dst_dir, dst_file)
         except:
-            # file transfer failed: remove temp file
-            if os.path.exists(TEMPFILE):
-                os.unlink(TEMPFILE)
+            self._discard_staging(staging)
             raise
 
+    def _exec(self, command):
+        """Run a command on the open session, without a pty, so what it
+        writes comes back byte for byte; returns that, or None if the
+        session died under it"""
+        started = time.time()
+        argv = ['ssh'] + self._ssh_options().split() + \
+               ['%s@%s' % (self.user, self.ipaddress), command]
+        sp = self._popen(argv)
+        # there's no expect() here to time out, so kill it if it takes long
+        watchdog = threading.Timer(self._timeout('transfer'), sp.kill)
+        watchdog.start()
+        try:
+            (stdout, stderr) = sp.communicate()
+        finally:
+            watchdog.cancel()
+        if self._session_lost(sp.returncode):
+            return None
+        elif sp.returncode < 0:
+            raise HostControlError(HostControlError.TIMEOUT, 'command killed')
+        elif sp.returncode != 0:
+            raise HostControlError(HostControlError.SSH, stderr.strip())
+        self._timed('command', 'exec', started)
+        return stdout
+
+    def use_store(self, backup_root):
+        """Say early where backups will go, for drivers that look at what is
+        already backed up before backup() is called"""
+        backup_root = os.path.abspath(backup_root)
+        if self.store is None or self.store.backup_root != backup_root:
+            self.store = BackupStore(backup_root)
+
     def backup(self, backup_root):
-        """Subclasses should call this first, to create place for backup"""
+        """Subclasses should call this first, to create place for backup.
+        Files pulled from here on go into the backup store."""
         backup_root = os.path.abspath(backup_root)
+        self.use_store(backup_root)
+        self.backup_checksums = []
         backup_path = os.path.join(backup_root, self.host_make)
-        if not os.path.isdir(backup_path):
+        try:
             os.mkdir(backup_path)
+        except OSError, err:
+            # fine if it exists already (maybe another worker just made it)
+            if err.errno != errno.EEXIST:
+                raise
         return backup_path
 
-    def reboot(self, rebootStr, rebootWait, tick, rebootCB=None):
-        """Reboot the host"""
+    def reboot(self, rebootStr, rebootWait, tick, rebootCB=None,
+                     tracker=None):
+        """Reboot the host.  Given a RebootTracker, return None as soon as
+        the reboot command is sent and let the tracker watch for the host to
+        come back; otherwise wait here and return True if it came back."""
         if not self.is_pingable():
             raise HostControlError(HostControlError.NOPING)
 
+        # the reboot drops the connection, so don't issue it on the session
+        self.close_session()
+
         # issue the reboot command (may raise exception)
+        started = time.time()
         if rebootStr:
             self.ssh_command(rebootStr)
         else:
             self.ssh_command(None, rebootCB)
+        self._timed('reboot', 'send', started)
+        started = time.time()
+
+        if tracker is not None:
+            tracker.track(self, rebootWait)
+            return None
 
         # wait for reboot command to take the machine down
         time.sleep(rebootWait)
@@ -254,6 +616,7 @@ class HostControl(object):
             # ping the machine
             resurrected = self.is_pingable()
 
+        self._timed('reboot', 'downtime', started)
         time.sleep(self.FULL_BOOT_WAIT)
         return True
 
@@ -272,7 +635,11 @@ if __name__ == '__main__':
     if not control.is_pingable():
         sys.exit('Cannot ping %s' % ipaddr)
 
-    lines = control.ssh_command(command)
+    control.open_session()
+    try:
+        lines = control.ssh_command(command)
+    finally:
+        control.close_session()
     if lines:
         for line in lines:
             print line
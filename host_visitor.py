@@ -15,21 +15,44 @@ Written by jwiggins@inveneo.org 2011-2012
 from __future__ import with_statement
 import os
 import sys
+import time
+import Queue
+import socket
 import string
 import random
+import threading
 import traceback
+import ping_sweep
 import host_walker
 import crawler_conf
 import crawler_util
 from ipaddr import IPv4Address
+from optparse import OptionParser
 from subprocess import Popen, PIPE
 from h3c_control import H3CSwitch
 from host_control import HostControlError
 from mikrotik_control import MikrotikRouter
 from ubiquiti_control import UbiquitiRadio
+from visit_scheduler import VisitScheduler
+from visit_history import VisitHistory, VisitRecord
+from visit_budget import CostEstimator, Deadline
+from timeout_policy import TimeoutPolicy
+from failure_cache import FailureCache, failure_code
+from visit_metrics import RunMetrics
+from session_replay import SessionRecorder
+from crawl_shard import Shard
+from network_topology import Topology
+from link_watch import LinkWatch
+from reboot_tracker import RebootTracker
+from run_report import ReportWriter, TsvSink, JsonLinesSink, SummarySink, \
+                       visit_row, backoff_row, reboot_row, link_row
 
 PRINTWORTHY_CHARS = string.digits + string.letters + string.punctuation
 
+# maps every other character to a space, for str.translate
+PRINTWORTHY_TABLE = ''.join([c if c in PRINTWORTHY_CHARS else ' '
+                             for c in map(chr, range(256))])
+
 def get_last_visited(state_file):
     """Pull IP address of last visited host from given file"""
     if not os.path.exists(state_file): return None
@@ -46,39 +69,16 @@ def set_last_visited(state_file, last_visited_ip):
     with open(state_file, 'w') as outfile:
         outfile.write('%s\n' % IPv4Address(last_visited_ip))
 
-def emit(obj):
-    """For unbuffered writing to stdout"""
-    sys.stdout.write(str(obj))
-    sys.stdout.flush()
-
-def emit_tab(obj):
-    """For tab-separated values"""
-    emit(obj)
-    emit('\t')
-
-def emit_fail(obj):
-    """Standard error format, for easy search"""
-    emit('FAIL:')
-    emit_tab(obj)
-
 def ask_exception():
     """Create succinct exception tuple"""
     exctype, value = sys.exc_info()[:2]
+    if isinstance(value, unicode):
+        value = value.encode('ascii', 'replace')
     first_line = str(value).split('\n')[0]
-    chars = []
-    for i in range(len(first_line)):
-        if first_line[i] in PRINTWORTHY_CHARS:
-            chars.append(first_line[i])
-        else:
-            chars.append(' ')
-    msg  = ''.join(chars)
+    msg = first_line.translate(PRINTWORTHY_TABLE)
     return (exctype.__name__, msg)
 
-def emit_exception(name, msg):
-    """Write succinct exception output"""
-    emit_fail('%s:%s' % (name, msg))
-
-def query_unit(unit):
+def query_unit(unit, record, row):
     """The unit is online: query it, return uptime"""
 
     # this first query gets firmware version and also tests the password
@@ -86,14 +86,22 @@ def query_unit(unit):
         version = unit.get_version()
     except:
         raise
-    emit_tab(version)
+    record.version = version
+    row.add(version)
 
     # also query for uptime
     try:
         uptime = unit.get_uptime()
-        emit_tab(crawler_util.rough_timespan(uptime))
+        record.uptime = uptime
+        row.add(crawler_util.rough_timespan(uptime))
     except:
         raise
+
+    # hardware is just for the history, so don't fail the visit over it
+    try:
+        record.hardware = unit.get_hardware()
+    except HostControlError:
+        pass
     return uptime
 
 def remove_ssh_key(ip_address):
@@ -102,20 +110,223 @@ def remove_ssh_key(ip_address):
                stdout=PIPE, stderr=PIPE)
     return sp.communicate()
 
-def visitation(unit, backup_root, rebootable):
+class RebootQuota(object):
+    """Thread-safe limit on how many hosts may be rebooted in one run"""
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Claim one reboot; False if the quota is used up"""
+        with self.lock:
+            if self.used >= self.maximum:
+                return False
+            self.used += 1
+            return True
+
+class ResumePoint(object):
+    """Tracks the round-robin resume point while visits finish out of order.
+
+    Hosts are numbered in walk order as they are handed out.  The resume point
+    only advances over an unbroken run of finished hosts, so a host that is
+    still being visited (or never got visited) is not skipped on the next run.
+    """
+
+    def __init__(self, last_visited_ip):
+        self.ip = last_visited_ip
+        self.next_index = 0
+        self.finished = {}
+        self.lock = threading.Lock()
+
+    def finish(self, index, ip):
+        """Record that the host at this walk position is done"""
+        with self.lock:
+            self.finished[index] = ip
+            while self.next_index in self.finished:
+                self.ip = self.finished.pop(self.next_index)
+                self.next_index += 1
+
+class SubtreeGate(object):
+    """Holds a router back until every host behind it has been visited (or
+    passed over) this run, so that rebooting it cannot strand them"""
+
+    def __init__(self, topology, hosts):
+        self.topology = topology
+        self.behind = {} # router IP as integer -> IPs behind it not yet done
+        self.lock = threading.Condition()
+        for host in hosts:
+            for router in topology.ancestors(host.ip):
+                self.behind.setdefault(router, set()).add(host.ip)
+
+    def clear(self, host):
+        """True if every host behind this one is done"""
+        with self.lock:
+            return not self.behind.get(host.ip)
+
+    def finish(self, host):
+        """The host has been visited, or passed over, this run"""
+        with self.lock:
+            for router in self.topology.ancestors(host.ip):
+                if router in self.behind:
+                    self.behind[router].discard(host.ip)
+            self.lock.notifyAll()
+
+    def wait(self, timeout):
+        """Wait a while for a visit to finish"""
+        with self.lock:
+            self.lock.wait(timeout)
+
+class Crawl(object):
+    """What all the visits of one run share"""
+
+    def __init__(self, backup_root, quota, addresses):
+        self.backup_root = backup_root # where to save config backups
+        self.quota       = quota       # RebootQuota for this run
+        self.tracker     = RebootTracker() # watches hosts we rebooted
+        self.report      = None        # ReportWriter of finished rows
+        self.scheduler   = None        # VisitScheduler, in priority mode
+        self.history     = None        # VisitHistory, if keeping one
+        self.failures    = None        # FailureCache, if keeping one
+        self.metrics     = None        # RunMetrics, if writing them out
+        self.recorder    = None        # SessionRecorder, if recording
+        self.topology    = None        # Topology, if keeping one
+        self.gate        = None        # SubtreeGate, with a topology
+        self.links       = None        # LinkWatch, if watching for dead links
+        self.gateways    = []          # their gateways, for ping sweeps
+        self.deadline    = Deadline()  # when we must be done by
+        self.costs       = CostEstimator() # how long visit phases take
+        self.unstarted   = 0           # hosts not visited for lack of time
+        self.addresses   = addresses   # every host address, for ping sweeps
+        self.reachable   = None        # address -> ping RTT, None if no reply
+        self.swept_at    = 0
+        self.refreshing  = False       # True while a sweep is redone
+        self.done        = set()       # addresses visited, for re-sweeps
+        self.sweep_lock  = threading.Lock()
+
+    def sweep(self, addresses=None):
+        """Ping these hosts (all of them, by default) and the gateways at
+        once, folding the replies into what earlier sweeps found.  Returns
+        address -> RTT, or None if we cannot sweep: then hosts are pinged
+        one at a time."""
+        if addresses is None:
+            addresses = self.addresses
+        pinger = ping_sweep.PingSweep()
+        try:
+            found = pinger.sweep(list(addresses) + self.gateways)
+        except socket.error:
+            # no ICMP socket for us: ping hosts one at a time
+            found = None
+        with self.sweep_lock:
+            self.swept_at = time.time()
+            if found is not None:
+                # a new map, so that readers of the old one are not upset
+                reachable = dict(self.reachable or {})
+                reachable.update(found)
+                self.reachable = reachable
+        if self.topology is not None:
+            self.topology.measured(pinger.hop_counts())
+        if self.failures is not None and found is not None:
+            self.failures.answered(found)
+        if self.links is not None and found is not None:
+            self.links.swept(found)
+        return self.reachable
+
+    def refresh(self):
+        """Start sweeping again in the background, only the hosts not yet
+        visited; the last sweep's results serve until it is done"""
+        with self.sweep_lock:
+            if self.refreshing or self.reachable is None:
+                return
+            self.refreshing = True
+            addresses = [address for address in self.addresses
+                         if address not in self.done]
+        thread = threading.Thread(target=self._refresh, args=(addresses,))
+        thread.setDaemon(True)
+        thread.start()
+
+    def _refresh(self, addresses):
+        try:
+            self.sweep(addresses)
+        finally:
+            with self.sweep_lock:
+                self.refreshing = False
+
+    def visited(self, record):
+        """Take note of how a visit went"""
+        no_time = record.error is not None and record.error[0] == 'no_time'
+        self.done.add(record.host.ip_addr)
+        if self.scheduler is not None and no_time:
+            self.scheduler.not_visited(record.host, record.uptime)
+        elif self.scheduler is not None:
+            self.scheduler.visited(record.host, record.backup is not None,
+                                   record.uptime)
+        if self.history is not None:
+            self.history.add(record)
+        if self.metrics is not None:
+            self.metrics.add(record)
+        if self.failures is not None and not no_time:
+            self.failures.visited(record.host, failure_code(record))
+
+    def backing_off(self, host):
+        """The host's chronic Failure if it should be skipped, else None"""
+        if self.failures is None:
+            return None
+        failure = self.failures.backing_off(host)
+        if failure is not None and self.metrics is not None:
+            self.metrics.count('backoff')
+        return failure
+
+    def rebooted(self, outcome):
+        """Take note of what became of a reboot"""
+        if self.history is not None:
+            self.history.add_reboot(outcome)
+        if self.metrics is not None:
+            self.metrics.add_reboot(outcome)
+
+    def ping(self, unit):
+        """Look the unit up in the sweep, having it redone in the
+        background if it is old.  Returns (pingable, round trip seconds or
+        None if not measured)"""
+        reachable = self.reachable
+        if time.time() - self.swept_at > crawler_conf.PING_SWEEP_MAX_AGE:
+            self.refresh()
+        if reachable is None or unit.ipaddress not in reachable:
+            return (unit.is_pingable(), None)
+        rtt = reachable[unit.ipaddress]
+        return (rtt is not None, rtt)
+
+def visitation(unit, crawl, record, row):
     """Should catch all exceptions and only re-raise Control-C
-       Arg: backup_root = where to save backup of config file(s)
-       Arg: rebootable = False if reboot should not be attempted
+       Arg: crawl = Crawl with the backup root, reboot quota and ping sweep
+       Arg: record = VisitRecord to fill in with how the visit went
+       Arg: row = ReportRow to add report fields to
        Return: True if rebooted host, else False"""
     uptime = None
 
     # ping the unit and query it (which also tests the password)
     try:
-        if unit.is_pingable():
-            emit_tab('ping')
-            uptime = query_unit(unit)
+        started = time.time()
+        (record.pingable, record.rtt) = crawl.ping(unit)
+        record.timed('ping', started)
+        if record.pingable:
+            row.add('ping')
+            # wait on it as long as its round trip and its past deserve
+            unit.timeouts = TimeoutPolicy(record.rtt,
+                                crawl.costs.measured(record.host, 'query'),
+                                crawl.costs.measured(record.host, 'backup'),
+                                unit.VISIT_STEPS)
+            unit.timeouts.start()
+            started = time.time()
+            try:
+                unit.open_session()
+                uptime = query_unit(unit, record, row)
+            finally:
+                record.timed('query', started)
         else:
-            emit_fail('no_ping')
+            row.fail('no_ping')
+            record.error = ('no_ping', '')
             return
     except KeyboardInterrupt:
         # caught control-c; kick it upstairs
@@ -126,26 +337,45 @@ def visitation(unit, backup_root, rebootable):
         if msg.strip().endswith('Host key verification failed.'):
             (stdout, stderr) = remove_ssh_key(unit.ipaddress)
             msg = msg + stdout + stderr
-        emit_exception(name, msg)
+        row.fail(name, msg)
+        record.error = (name, msg)
         return
 
-    # pull config(s) from unit to keep as backup
+    # pull config(s) from unit to keep as backup, if there's time
+    if not crawl.deadline.allows(crawl.costs.cost(record.host, 'backup')):
+        row.fail('no_time')
+        record.error = ('no_time', '')
+        return
+    started = time.time()
     try:
-        emit_tab(str(unit.backup(backup_root)))
+        record.backup = unit.backup(crawl.backup_root)
+        record.backup_hash = ','.join(unit.backup_checksums)
+        row.add(record.backup)
     except KeyboardInterrupt:
         # caught control-c; kick it upstairs
         raise KeyboardInterrupt
     except:
         # caught other exception: print it out
         (name, msg) = ask_exception()
-        emit_exception(name, msg)
+        row.fail(name, msg)
+        record.error = (name, msg)
         return
-
-    # reboot if past maximum uptime
-    if rebootable and uptime and uptime > unit.max_uptime:
-        emit_tab('REBOOT')
+    finally:
+        record.timed('backup', started)
+
+    # reboot if past maximum uptime, and there's time to see it come back
+    if uptime and uptime > unit.max_uptime and \
+       not crawl.deadline.allows(crawl.costs.costs(record.host,
+                                                   ('reboot', 'downtime'))):
+        row.add('REBOOT:no_time')
+        record.reboot = 'no_time'
+    elif uptime and uptime > unit.max_uptime and crawl.quota.acquire():
+        row.add('REBOOT')
+        started = time.time()
         try:
-            unit.reboot(True)
+            # the tracker reports later whether the host came back
+            unit.reboot(False, crawl.tracker)
+            record.reboot = 'sent'
             return True
         except KeyboardInterrupt:
             # caught control-c; kick it upstairs
@@ -153,18 +383,309 @@ def visitation(unit, backup_root, rebootable):
         except:
             # caught other exception: print it out
             (name, msg) = ask_exception()
-            emit_exception(name, msg)
+            row.fail(name, msg)
+            record.error = (name, msg)
             return False
+        finally:
+            record.timed('reboot', started)
     return False
 
+def report_reboot_outcomes(crawl, outcomes=None):
+    """Report rows for the reboots that have resolved since last time"""
+    if outcomes is None:
+        outcomes = crawl.tracker.collect()
+    for outcome in outcomes:
+        crawl.rebooted(outcome)
+        crawl.report.add(reboot_row(outcome))
+
+def await_reboots(crawl):
+    """After the last visit, report reboots as they resolve (until the end
+    time; any still pending then are reported as unresolved)"""
+    while crawl.tracker.pending() and not crawl.deadline.passed():
+        remaining = crawl.deadline.remaining()
+        if remaining is None:
+            remaining = 10
+        crawl.tracker.wait(min(10, remaining))
+        report_reboot_outcomes(crawl)
+    report_reboot_outcomes(crawl)
+
+def make_unit(host):
+    """Create the controller for this make of host; None if unknown make"""
+    if host.host_make == crawler_util.HOST_MAKE_UBIQUITI:
+        return UbiquitiRadio(host.hostname,
+                             host.ip_addr,
+                             host.password,
+                             host.max_uptime)
+    elif host.host_make == crawler_util.HOST_MAKE_H3C:
+        return H3CSwitch(host.hostname,
+                         host.ip_addr,
+                         host.password,
+                         host.max_uptime)
+    elif host.host_make == crawler_util.HOST_MAKE_MIKROTIK:
+        return MikrotikRouter(host.hostname,
+                              host.ip_addr,
+                              host.password,
+                              host.max_uptime)
+    return None
+
+def visit_host(host, unit, crawl, row):
+    """Fill in the host's report row; returns the row to report (which is
+    another row if the host is resting)"""
+
+    # a host that keeps failing the same way gets a rest
+    failure = crawl.backing_off(host)
+    if failure is not None:
+        return backoff_row(host, failure)
+
+    # do the work for this kind of device, on one SSH login if we can
+    record = VisitRecord(host)
+    unit.use_store(crawl.backup_root)
+    if crawl.recorder is not None:
+        crawl.recorder.attach(unit)
+    try:
+        visitation(unit, crawl, record, row)
+    finally:
+        unit.close_session()
+        if unit.sessions is not None:
+            # detached too: the reboot tracker may still ping the unit, and
+            # that must not start the finished transcript over
+            unit.sessions.close()
+            unit.sessions = None
+        record.finished = time.time()
+        record.operations = unit.timings
+    if crawl.topology is not None:
+        crawl.topology.learn(unit.ipaddress, unit.get_routing())
+    row.visited(record)
+    crawl.visited(record)
+    if crawl.links is not None:
+        crawl.links.visited(host, failure_code(record))
+    return row
+
+def report_visit(host, unit, crawl):
+    """Visit the host and report its row, whatever happens"""
+    row = visit_row(host)
+    try:
+        row = visit_host(host, unit, crawl, row)
+    except KeyboardInterrupt:
+        raise
+    except:
+        # visitation catches device errors; this is our own bug
+        (name, msg) = ask_exception()
+        row.failed(name, msg)
+    try:
+        crawl.report.add(row)
+        report_reboot_outcomes(crawl)
+    except KeyboardInterrupt:
+        raise
+    except:
+        # the row is lost, but not the rest of the run
+        traceback.print_exc()
+
+def fits_in_time(host, crawl):
+    """True if there is time to at least ping and query the host"""
+    if crawl.deadline.allows(crawl.costs.costs(host, ('ping', 'query'))):
+        return True
+    crawl.unstarted += 1
+    return False
+
+def visit_worker(jobs, crawl, resume):
+    """Pool thread: visit hosts from the queue"""
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        try:
+            visit_job(job, crawl, resume)
+        except:
+            # our own bug, past report_visit: keep the worker going, or the
+            # main thread waits on a pool with no one left in it
+            traceback.print_exc()
+
+def visit_job(job, crawl, resume):
+    """Visit the host of an (index, host, unit) job, unless its link is
+    down: then the job is held for link_watch to give back later"""
+    (index, host, unit) = job
+    try:
+        if crawl.links is not None and crawl.links.hold(host, job):
+            return
+        report_visit(host, unit, crawl)
+        resume.finish(index, host.ip_addr)
+    finally:
+        if crawl.gate is not None:
+            crawl.gate.finish(host)
+
+def put_interruptibly(jobs, job):
+    """Queue.put that still lets Control-C through to the main thread"""
+    while True:
+        try:
+            jobs.put(job, True, 1)
+            return
+        except Queue.Full:
+            pass
+
+def hand_out_ready(hand_out, crawl, held):
+    """Hand out the held jobs whose hosts are now clear; returns the rest"""
+    still_held = []
+    for job in held:
+        if crawl.gate.clear(job[1]):
+            hand_out(job)
+        else:
+            still_held.append(job)
+    return still_held
+
+def join_interruptibly(threads):
+    """Thread.join that still lets Control-C through to the main thread"""
+    for thread in threads:
+        while thread.isAlive():
+            thread.join(1)
+
+def walk_jobs(hosts, crawl, resume):
+    """An (index, host, unit) job for each host there is time for"""
+    for (index, host) in enumerate(hosts):
+        if not fits_in_time(host, crawl):
+            if crawl.gate is not None:
+                crawl.gate.finish(host)
+            continue
+        unit = make_unit(host)
+        if unit is None:
+            # unknown make of host: skip it
+            resume.finish(index, host.ip_addr)
+            if crawl.gate is not None:
+                crawl.gate.finish(host)
+            continue
+        yield (index, host, unit)
+
+def visit_all(hosts, crawl, resume, workers):
+    """Visit every host in turn, using a pool if workers > 1"""
+    run_jobs(walk_jobs(hosts, crawl, resume), crawl, resume, workers)
+
+def run_jobs(jobs_in_turn, crawl, resume, workers):
+    """Visit the host of each job in turn, using a pool if workers > 1.
+    With a topology, a router's job waits until every host behind it is
+    done, however the jobs come."""
+    threads = []
+    if workers <= 1:
+        hand_out = lambda job: visit_job(job, crawl, resume)
+    else:
+        jobs = Queue.Queue(workers)
+        for i in range(workers):
+            thread = threading.Thread(target=visit_worker,
+                                      args=(jobs, crawl, resume))
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        hand_out = lambda job: put_interruptibly(jobs, job)
+
+    held = [] # jobs for routers with hosts behind them not yet done
+    for job in jobs_in_turn:
+        if crawl.gate is None:
+            hand_out(job)
+            continue
+        held = hand_out_ready(hand_out, crawl, held + [job])
+    while held:
+        if threads:
+            crawl.gate.wait(1)
+        still_held = hand_out_ready(hand_out, crawl, held)
+        if not threads and len(still_held) == len(held):
+            # nothing left that they wait on: visit them as they are
+            for job in still_held:
+                hand_out(job)
+            still_held = []
+        held = still_held
+    for thread in threads:
+        put_interruptibly(jobs, None)
+    join_interruptibly(threads)
+
+def retry_links(crawl, resume, workers):
+    """Try the links found down again, now and then every so often while
+    there is time, visiting the hosts held behind each once it answers.
+    Each link still down at the end gets one report row for its hosts."""
+    for attempt in range(crawler_conf.LINK_RETRIES + 1):
+        if not crawl.links.down():
+            return
+        if attempt:
+            if not crawl.deadline.allows(crawler_conf.LINK_RETRY_WAIT):
+                break
+            time.sleep(crawler_conf.LINK_RETRY_WAIT)
+        for group in crawl.links.down():
+            down_at = group.down_at
+            held = crawl.links.retry(group)
+            if held is None:
+                continue
+            crawl.report.add(link_row(group, len(held),
+                                      time.time() - down_at))
+            run_jobs([job for job in held if fits_in_time(job[1], crawl)],
+                     crawl, resume, workers)
+    for group in crawl.links.down():
+        crawl.report.add(link_row(group, len(group.held)))
+        if crawl.metrics is not None:
+            crawl.metrics.count('link_down', len(group.held))
+        for (index, host, unit) in group.held:
+            resume.finish(index, host.ip_addr)
+
 if __name__ == '__main__':
 
-    if len(sys.argv) < 3:
-        sys.exit('usage: %s state_file backup_root opennms_file ...' % \
-                    sys.argv[0])
-    state_file  = os.path.abspath(sys.argv[1])
-    backup_root = os.path.abspath(sys.argv[2])
-    xml_files   = sys.argv[3:]
+    parser = OptionParser(usage='usage: %prog [options] '
+                                'state_file backup_root opennms_file ...')
+    parser.add_option('-w', '--workers', type='int', default=1,
+                      help='hosts to visit at once [default: %default]')
+    parser.add_option('-i', '--inventory-cache', metavar='FILE',
+                      help='remember parsed OpenNMS files here between runs')
+    parser.add_option('-s', '--schedule', default='round-robin',
+                      choices=['round-robin', 'priority'],
+                      help='round-robin, or priority (neediest hosts first, '
+                           'needs --host-state) [default: %default]')
+    parser.add_option('-H', '--host-state', metavar='FILE',
+                      help='what the priority schedule knows of each host')
+    parser.add_option('-d', '--history', metavar='FILE',
+                      help='SQLite database to record every visit in')
+    parser.add_option('-f', '--failure-cache', metavar='FILE',
+                      help='rest hosts that keep failing, remembering them '
+                           'here between runs')
+    parser.add_option('-e', '--end-time', type='int', metavar='SECONDS',
+                      help='when to be done by, in seconds past the epoch: '
+                           'only work that fits (judging by --history) '
+                           'is started')
+    parser.add_option('-M', '--metrics', metavar='PREFIX',
+                      help='write timings of the run to PREFIX.prom '
+                           '(Prometheus text format) and PREFIX.json')
+    parser.add_option('-R', '--record', metavar='DIR',
+                      help='write a transcript of every visit under DIR, '
+                           'for session_replay.py (Mikrotik routers are '
+                           'visited over SSH only)')
+    parser.add_option('-j', '--json-report', metavar='FILE',
+                      help='also write the report here, as one JSON object '
+                           'per row')
+    parser.add_option('-S', '--summary', metavar='FILE',
+                      help='write a summary of the run here at the end '
+                           '(counts, and the hosts that failed)')
+    parser.add_option('-T', '--topology', metavar='FILE',
+                      help='walk hosts leaf-first, by what Mikrotik routers '
+                           'and hop counts say of the network, remembering '
+                           'it here between runs')
+    parser.add_option('-l', '--link-watch', action='store_true',
+                      help='when hosts behind one link fail in a row and '
+                           'its gateway does not answer ping either, set '
+                           'them aside and try them again later')
+    parser.add_option('-x', '--shard', metavar='I/N',
+                      help='visit only the hosts that fall to node I of N '
+                           '(give each node its own state and backups)')
+    (options, args) = parser.parse_args()
+    shard = None
+    if options.shard:
+        try:
+            shard = Shard.parse(options.shard)
+        except ValueError, err:
+            parser.error(str(err))
+    if len(args) < 3:
+        parser.error('need state_file, backup_root and opennms_file(s)')
+    if options.workers < 1:
+        parser.error('--workers must be at least 1')
+    if options.schedule == 'priority' and not options.host_state:
+        parser.error('--schedule priority needs --host-state')
+    state_file  = os.path.abspath(args[0])
+    backup_root = os.path.abspath(args[1])
+    xml_files   = args[2:]
 
     try:
         os.makedirs(backup_root)
@@ -174,57 +695,88 @@ if __name__ == '__main__':
             sys.exit('Cannot write to %s' % backup_root)
 
     last_visited_ip = get_last_visited(state_file)
+    resume = ResumePoint(last_visited_ip)
+    crawl = None
+    topology = None
     try:
-        walker = host_walker.HostWalker(xml_files, last_visited_ip)
+        if options.topology:
+            topology = Topology(os.path.abspath(options.topology))
+        walker = host_walker.HostWalker(xml_files, last_visited_ip,
+                                        options.inventory_cache, shard,
+                                        topology)
         total_units = walker.host_count()
+        if shard is not None:
+            print 'Shard', shard, 'of', walker.inventory_count, 'units'
         print 'There are', total_units, 'units to visit'
-        reboots = 0
+        for host in walker.added:
+            print 'New since last run:', host
+        for host in walker.removed:
+            print 'Gone since last run:', host
         max_reboots = (total_units / 7) + 1
         # XXX
         max_reboots = 0
         print 'Maximum number of reboots is', max_reboots
-
-        # column headings
-        emit_tab('Make')
-        emit_tab('Host')
-        emit_tab('IP')
-        emit_tab('Ping')
-        emit_tab('Version')
-        emit_tab('Uptime')
-        emit('Config\n')
-
-        for host in walker:
-            if host.host_make == crawler_util.HOST_MAKE_UBIQUITI:
-                unit = UbiquitiRadio(host.hostname,
-                                     host.ip_addr,
-                                     host.password,
-                                     host.max_uptime)
-            elif host.host_make == crawler_util.HOST_MAKE_H3C:
-                unit = H3CSwitch(host.hostname,
-                                 host.ip_addr,
-                                 host.password,
-                                 host.max_uptime)
-            elif host.host_make == crawler_util.HOST_MAKE_MIKROTIK:
-                unit = MikrotikRouter(host.hostname,
-                                      host.ip_addr,
-                                      host.password,
-                                      host.max_uptime)
-            else:
-                # unknown make of host: skip it
-                continue
-
-            # the first output fields
-            emit_tab(host.host_make)
-            emit_tab(host.hostname)
-            emit_tab(str(host.ip_addr))
-
-            # do the work for this kind of device
-            if visitation(unit, backup_root, reboots < max_reboots):
-                reboots += 1
-
-            # record having visited this device
-            print ''
-            last_visited_ip = host.ip_addr
+        print 'Visiting with', options.workers, 'worker(s)'
+        crawl = Crawl(backup_root, RebootQuota(max_reboots),
+                      [host.ip_addr for host in walker])
+        if topology is not None:
+            crawl.topology = topology
+            crawl.gate = SubtreeGate(topology, walker)
+            print 'Walking leaf-first through', len(walker.subtrees()), \
+                  'separate trees'
+        if options.link_watch:
+            crawl.links = LinkWatch(topology)
+            crawl.gateways = sorted(crawl.links.gateways(crawl.addresses))
+        if options.metrics:
+            crawl.metrics = RunMetrics()
+        if options.record:
+            crawl.recorder = SessionRecorder(os.path.abspath(options.record))
+        if options.failure_cache:
+            crawl.failures = FailureCache(
+                                os.path.abspath(options.failure_cache))
+        reachable = crawl.sweep()
+        if reachable is None:
+            print 'Cannot open ICMP socket: will ping units one at a time'
+        else:
+            answered = [address for address in crawl.addresses
+                        if reachable.get(address) is not None]
+            print len(answered), 'units answered the ping sweep'
+        if crawl.failures is not None:
+            print crawl.failures.backed_off(), \
+                  'units are resting after failing repeatedly'
+
+        # the report starts with its column headings
+        sinks = [TsvSink()]
+        if options.json_report:
+            sinks.append(JsonLinesSink(os.path.abspath(options.json_report)))
+        if options.summary:
+            sinks.append(SummarySink(os.path.abspath(options.summary)))
+        crawl.report = ReportWriter(sinks)
+
+        if options.history:
+            crawl.history = VisitHistory(os.path.abspath(options.history))
+            crawl.costs = CostEstimator(crawl.history)
+        if options.end_time:
+            crawl.deadline = Deadline(options.end_time)
+        hosts = walker
+        if options.schedule == 'priority':
+            crawl.scheduler = VisitScheduler(walker,
+                                        os.path.abspath(options.host_state),
+                                        topology)
+            hosts = crawl.scheduler
+        visit_all(hosts, crawl, resume, options.workers)
+        if crawl.links is not None:
+            retry_links(crawl, resume, options.workers)
+        crawl.report.flush()
+        if crawl.unstarted:
+            print 'Out of time:', crawl.unstarted, 'units not visited'
+            crawl.report.note('Out of time: %d units not visited' %
+                              crawl.unstarted)
+        await_reboots(crawl)
+        crawl.report.flush()
+        if crawl.metrics is not None:
+            for line in crawl.metrics.summary_lines():
+                print line
 
     except KeyboardInterrupt:
         print ''
@@ -236,5 +788,22 @@ if __name__ == '__main__':
         traceback.print_exc()
 
     finally:
-        if last_visited_ip:
-            set_last_visited(state_file, last_visited_ip)
+        if crawl and crawl.report:
+            report_reboot_outcomes(crawl)
+            report_reboot_outcomes(crawl, crawl.tracker.stop())
+            crawl.report.close()
+        elif crawl:
+            crawl.tracker.stop()
+        if resume.ip:
+            set_last_visited(state_file, resume.ip)
+        if crawl and crawl.scheduler:
+            crawl.scheduler.save()
+        if crawl and crawl.history:
+            crawl.history.close()
+        if crawl and crawl.failures:
+            crawl.failures.save()
+        if topology is not None:
+            topology.save()
+        if crawl and crawl.metrics:
+            crawl.metrics.count('unstarted', crawl.unstarted)
+            crawl.metrics.write(os.path.abspath(options.metrics))
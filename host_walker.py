@@ -4,77 +4,234 @@
 
 """A generator that walks hosts in a network in depth-first fashion.
 
-By "depth-first" we mean "furthest downstream first".
-
-Right now it's pretty brain-dead, not doing depth-first, but instead going in
-order of sorted IP address.
+By "depth-first" we mean "furthest downstream first".  Given a
+network_topology.Topology, the walk is leaf-first: every host comes before
+the router it sits behind.  Without one (or for hosts it knows nothing of)
+the walk goes in order of sorted IP address.
 
 Written by jwiggins@inveneo.org 2011-2012
 """
 
+import os
 import sys
+import array
+import bisect
 import ipaddr
+import cPickle
+import tempfile
 import crawler_conf
 import crawler_util
-from xml.etree import ElementTree
+import multiprocessing
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
 
 # for parsing OpenNMS XML
 NAMESPACE = '{http://xmlns.opennms.org/xsd/config/model-import}'
 NODE      = NAMESPACE + 'node'
 INTERFACE = NAMESPACE + 'interface'
 
+# bump this whenever what goes into the inventory cache changes
+CACHE_VERSION = 2
+
+# array type code for IP addresses as unsigned 32-bit integers
+IP_TYPECODE = array.array('I').itemsize >= 4 and 'I' or 'L'
+
+class HostSettings(object):
+    """What all hosts of one make have in common (not copied per host)"""
+    __slots__ = ('password', 'max_uptime')
+
+    def __init__(self, password, max_uptime):
+        self.password   = password
+        self.max_uptime = max_uptime
+
+DEFAULT_SETTINGS = HostSettings(crawler_conf.NODE_PASSWORD,
+                                crawler_conf.MAX_UPTIME)
+MAKE_SETTINGS = {} # host make -> HostSettings, if not the default
+
 class HostNode(object):
-    """Represents one OpenNMS node"""
+    """Represents one OpenNMS node, compactly: there may be 100,000 of us"""
+    __slots__ = ('host_make', 'hostname', 'ip')
+
+    def __init__(self, host_make, hostname, ip):
+        self.host_make = intern(host_make)
+        self.hostname  = hostname
+        self.ip        = ip # 32-bit integer
 
-    def __init__(self, xml_node, host_make):
-        self.host_make  = host_make
-        self.hostname   = xml_node.attrib['node-label']
-        interface       = xml_node.find(INTERFACE)
-        self.ip_addr    = ipaddr.IPv4Address(interface.attrib['ip-addr'])
-        self.password   = crawler_conf.NODE_PASSWORD
-        self.max_uptime = crawler_conf.MAX_UPTIME
+    @property
+    def ip_addr(self):
+        return ipaddr.IPv4Address(self.ip)
+
+    @property
+    def password(self):
+        return MAKE_SETTINGS.get(self.host_make, DEFAULT_SETTINGS).password
+
+    @property
+    def max_uptime(self):
+        return MAKE_SETTINGS.get(self.host_make, DEFAULT_SETTINGS).max_uptime
+
+    def key(self):
+        """Compact, picklable identity of the node (see InventoryCache)"""
+        return (self.host_make, self.hostname, self.ip)
 
     def __str__(self):
-        return '%s %s %s' % (self.host_make, self.hostname, self.ip_addr)
+        return '%s %s %s' % (self.host_make, self.hostname,
+                             crawler_util.int_to_ip(self.ip))
+
+def xml_host_node(xml_node, host_make):
+    """Makes a HostNode out of an OpenNMS <node> element"""
+    interface = xml_node.find(INTERFACE)
+    return HostNode(host_make, xml_node.attrib['node-label'],
+                    crawler_util.ip_to_int(interface.attrib['ip-addr']))
+
+def foreign_source_make(foreign_source):
+    """Which make of host an OpenNMS foreign-source holds"""
+    if foreign_source in crawler_conf.FOREIGN_SOURCES_UBIQUITI:
+        return crawler_util.HOST_MAKE_UBIQUITI
+    elif foreign_source in crawler_conf.FOREIGN_SOURCES_H3C:
+        return crawler_util.HOST_MAKE_H3C
+    elif foreign_source in crawler_conf.FOREIGN_SOURCES_MIKROTIK:
+        return crawler_util.HOST_MAKE_MIKROTIK
+    return crawler_util.HOST_MAKE_UNKNOWN
 
 class OpenNMSFile(object):
-    """Represents the contents of one OpenNMS XML provisioning file"""
+    """Represents the contents of one OpenNMS XML provisioning file.
+    The file is parsed as it is iterated, one host at a time, throwing away
+    each <node> element once its host has been made, so that even a huge
+    file never sits in memory all at once."""
 
     def __init__(self, xml_file):
         self.xmlFile = xml_file
-        self.host_nodes = []
-        et = ElementTree.parse(xml_file)
-        root = et.getroot()
-        foreign_source = root.attrib['foreign-source']
-        if foreign_source in crawler_conf.FOREIGN_SOURCES_UBIQUITI:
-            self.host_make = crawler_util.HOST_MAKE_UBIQUITI
-        elif foreign_source in crawler_conf.FOREIGN_SOURCES_H3C:
-            self.host_make = crawler_util.HOST_MAKE_H3C
-        elif foreign_source in crawler_conf.FOREIGN_SOURCES_MIKROTIK:
-            self.host_make = crawler_util.HOST_MAKE_MIKROTIK
-        else:
-            self.host_make = crawler_util.HOST_MAKE_UNKNOWN
-
-        for xml_node in et.findall(NODE):
-            host_node = HostNode(xml_node, self.host_make)
-            self.host_nodes.append(host_node)
+        self.host_make = None # known once iteration starts
 
     def __iter__(self):
-        for host_node in self.host_nodes:
-            yield host_node
+        root = None
+        for (event, elem) in ElementTree.iterparse(self.xmlFile,
+                                                   ('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                    self.host_make = \
+                        foreign_source_make(root.attrib['foreign-source'])
+            elif elem.tag == NODE:
+                yield xml_host_node(elem, self.host_make)
+                # drop finished nodes (and all inside them) from the tree
+                root.clear()
+
+def parse_opennms_file(xml_file):
+    """Node keys of the hosts in one OpenNMS file; runs in a pool worker"""
+    return [host.key() for host in OpenNMSFile(xml_file)]
+
+def parse_opennms_files(xml_files):
+    """{xml_file: node keys}, parsing the files in parallel processes"""
+    if len(xml_files) < 2:
+        return dict([(xml_file, parse_opennms_file(xml_file))
+                     for xml_file in xml_files])
+    pool = multiprocessing.Pool(min(len(xml_files),
+                                    multiprocessing.cpu_count()))
+    try:
+        results = pool.map(parse_opennms_file, xml_files)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(xml_files, results))
+
+class InventoryCache(object):
+    """On-disk memory of the hosts in each OpenNMS file, so files that have
+    not changed since the last run need not be parsed again.  A file counts
+    as unchanged if its mtime and size are the same, or failing that, if its
+    checksum is."""
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.files = {}    # path -> (mtime, size, checksum, [node keys])
+        self.nodes = set() # node keys of all hosts seen on the last run
+        if cache_file and os.path.exists(cache_file):
+            try:
+                infile = open(cache_file, 'rb')
+                try:
+                    cache = cPickle.load(infile)
+                finally:
+                    infile.close()
+                if cache.get('version') == CACHE_VERSION:
+                    self.files = cache['files']
+                    self.nodes = cache['nodes']
+            except (EnvironmentError, cPickle.UnpicklingError,
+                    EOFError, AttributeError, KeyError):
+                # unreadable cache: just parse everything
+                pass
+
+    def node_keys(self, xml_files):
+        """[(path, node keys)] for each file in turn, parsing (all at once)
+        only those that are not in the cache or have changed"""
+        paths = [os.path.abspath(xml_file) for xml_file in xml_files]
+        stale = {} # path -> (mtime, size, checksum)
+        for path in paths:
+            st = os.stat(path)
+            entry = self.files.get(path)
+            if entry and entry[:2] == (st.st_mtime, st.st_size):
+                continue
+            checksum = None
+            if self.cache_file:
+                checksum = crawler_util.file_checksum(path)
+                if entry and entry[2] == checksum:
+                    self.files[path] = (st.st_mtime, st.st_size, checksum,
+                                        entry[3])
+                    continue
+            stale[path] = (st.st_mtime, st.st_size, checksum)
+
+        parsed = parse_opennms_files(stale.keys())
+        for (path, keys) in parsed.items():
+            self.files[path] = stale[path] + (keys,)
+        return [(path, self.files[path][3]) for path in paths]
+
+    def save(self, host_nodes):
+        """Remember these hosts, and the files they came from, for next run.
+        Returns (added, removed) HostNodes compared to the last run."""
+        if not self.cache_file:
+            return ([], [])
+        nodes = set([host.key() for host in host_nodes])
+        added = []
+        if self.nodes:
+            # (on the first run, everyone is new: not worth saying)
+            added = [host for host in host_nodes
+                     if host.key() not in self.nodes]
+        removed = [HostNode(*key) for key in sorted(self.nodes - nodes)]
+        self.nodes = nodes
+        if self.cache_file:
+            (fd, tmp) = tempfile.mkstemp(
+                            dir=os.path.dirname(self.cache_file) or '.')
+            outfile = os.fdopen(fd, 'wb')
+            try:
+                cPickle.dump({'version' : CACHE_VERSION,
+                              'files'   : self.files,
+                              'nodes'   : self.nodes},
+                             outfile, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                outfile.close()
+            os.rename(tmp, self.cache_file)
+        return (added, removed)
 
 class HostWalker(object):
     """Compiles a list of all hosts, organizes them, and allows iteration"""
 
-    def __init__(self, opennms_files, start_after_ip=None):
-        '''reads XML files to populate dictionary of unique and dup hosts'''
+    def __init__(self, opennms_files, start_after_ip=None, cache_file=None,
+                 shard=None, topology=None):
+        '''reads XML files to populate dictionary of unique and dup hosts;
+           with a cache_file, only files changed since last time get read;
+           with a crawl_shard.Shard, only that shard's hosts are kept;
+           with a network_topology.Topology, the walk is leaf-first'''
         self.start_after_ip = start_after_ip
-        self.unique_hosts = {}
+        self.unique_hosts = {} # IP as integer -> HostNode
         self.duplicates = {}
-        for opennms_file in opennms_files:
-            host_list = OpenNMSFile(opennms_file)
+        cache = InventoryCache(cache_file)
+        all_hosts = []
+        for (opennms_file, keys) in cache.node_keys(opennms_files):
+            host_list = [HostNode(*key) for key in keys]
+            all_hosts.extend(host_list)
             for host in host_list:
-                key = host.ip_addr
+                key = host.ip
                 if self.unique_hosts.has_key(key):
                     if not self.duplicates.has_key(key):
                         self.duplicates[key] = [host]
@@ -82,24 +239,61 @@ class HostWalker(object):
                         self.duplicates[key].append(host)
                 else:
                     self.unique_hosts[key] = host
+        (self.added, self.removed) = cache.save(all_hosts)
+        self.inventory_count = len(self.unique_hosts)
+        if shard is not None:
+            self.unique_hosts = dict([(key, host) for (key, host)
+                                      in self.unique_hosts.items()
+                                      if shard.owns(key)])
+            self.duplicates = dict([(key, hosts) for (key, hosts)
+                                    in self.duplicates.items()
+                                    if shard.owns(key)])
+            self.added = [host for host in self.added if shard.owns(host.ip)]
+            self.removed = [host for host in self.removed
+                            if shard.owns(host.ip)]
+
+        # sorted once, here, rather than on every walk
+        self.sorted_ips = array.array(IP_TYPECODE,
+                                      sorted(self.unique_hosts.keys()))
+        self.trees = None
+        self.walk_ips = self.sorted_ips
+        if topology is not None:
+            self.trees = topology.subtrees(self.sorted_ips)
+            self.walk_ips = array.array(IP_TYPECODE,
+                                        [ip for tree in self.trees
+                                         for ip in tree])
 
     def __iter__(self):
         '''iterates through unique hosts'''
-        sorted_keys = sorted(self.unique_hosts.keys())
-
-        # find where we left off and split the list
+        walk_ips = self.walk_ips
         start = 0
-        if self.start_after_ip:
-            try:
-                index = sorted_keys.index(self.start_after_ip)
-                start = (index + 1) % len(sorted_keys)
-            except:
-                start = 0
-        tail = sorted_keys[:start]
-        head = sorted_keys[start:]
-
-        for key in head + tail:
-            yield self.unique_hosts[key]
+        if self.start_after_ip and walk_ips:
+            start = self._resume_index()
+
+        for i in xrange(start, len(walk_ips)):
+            yield self.unique_hosts[walk_ips[i]]
+        for i in xrange(start):
+            yield self.unique_hosts[walk_ips[i]]
+
+    def _resume_index(self):
+        '''where in the walk to carry on from: after where we left off, or
+           if that host has since left the inventory, at the next address
+           after it'''
+        last_ip = crawler_util.ip_to_int(self.start_after_ip)
+        sorted_ips = self.sorted_ips
+        start = bisect.bisect_right(sorted_ips, last_ip) % len(sorted_ips)
+        if self.walk_ips is sorted_ips:
+            return start
+        if last_ip in self.unique_hosts:
+            return (self.walk_ips.index(last_ip) + 1) % len(sorted_ips)
+        return self.walk_ips.index(sorted_ips[start])
+
+    def subtrees(self):
+        '''lists of hosts, leaf-first, that share no router with each other
+           (each host its own, without a topology)'''
+        if self.trees is None:
+            return [[self.unique_hosts[ip]] for ip in self.sorted_ips]
+        return [[self.unique_hosts[ip] for ip in tree] for tree in self.trees]
 
     def host_count(self):
         '''accessor so folks don't have to mess with self data'''
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+# link_watch.py
+
+"""Notices a dead link from the hosts behind it failing one after another.
+
+Hosts are grouped by the link they are reached over: the router they sit
+behind, if the network_topology knows it, else their subnet (whose gateway
+is taken to be its first address).  When LINK_FAILURES hosts of a group in a
+row cannot be reached, the group's gateway is pinged once.  If it does not
+answer either, the link is taken to be down: the rest of the group is set
+aside rather than visited (and timed out on) one by one, and is tried again
+later in the run, once the gateway answers.
+
+Only a gateway that answered the ping sweep is trusted to say a link is down;
+one that never answers ping says nothing.
+"""
+
+from __future__ import with_statement
+import sys
+import time
+import socket
+import ipaddr
+import threading
+import subprocess
+import ping_sweep
+import crawler_conf
+import crawler_util
+from host_control import HostControlError
+
+# failures that look like the host can't be got at, rather than misbehaving
+UNREACHABLE = (HostControlError.NOPING, HostControlError.TIMEOUT,
+               HostControlError.SSH)
+
+def probe(address):
+    """True if the address answers ping now"""
+    try:
+        rtt = ping_sweep.sweep([address],
+                               retries=crawler_conf.LINK_PROBE_RETRIES)
+        return rtt.get(address) is not None
+    except socket.error:
+        # no ICMP socket for us: the ping program, then
+        try:
+            return subprocess.call(['ping', '-n', '-c', '1', str(address)],
+                                   stdout=open('/dev/null', 'w'),
+                                   stderr=subprocess.STDOUT) == 0
+        except OSError:
+            return False
+
+class LinkGroup(object):
+    """Hosts reached over one link, and how that link is doing"""
+
+    def __init__(self, name, gateway):
+        self.name     = name     # the subnet, or the router behind
+        self.gateway  = gateway  # IPv4Address to probe
+        self.failures = 0        # hosts that failed in a row
+        self.down_at  = None     # when we found the link down, if we did
+        self.probing  = False
+        self.held     = []       # jobs set aside while the link is down
+
+    def is_down(self):
+        return self.down_at is not None
+
+    def __str__(self):
+        return self.name
+
+class LinkWatch(object):
+    """Groups of hosts by link, and which links look down; thread-safe"""
+
+    def __init__(self, topology=None, prefix=crawler_conf.LINK_PREFIX,
+                 failures=crawler_conf.LINK_FAILURES, probe=probe):
+        self.topology  = topology
+        self.prefix    = prefix   # subnet size, without a topology
+        self.threshold = failures # failures in a row before probing
+        self.probe     = probe
+        self.groups    = {}       # name -> LinkGroup
+        self.trusted   = set()    # gateways that answered the ping sweep
+        self.lock      = threading.Lock()
+
+    def group(self, ip):
+        """The LinkGroup of a host's IPv4Address"""
+        parents = []
+        if self.topology is not None:
+            parents = self.topology.ancestors(crawler_util.ip_to_int(ip))
+        if parents:
+            gateway = ipaddr.IPv4Address(parents[0])
+            name = 'behind %s' % gateway
+        else:
+            subnet = ipaddr.IPv4Network('%s/%d' % (ip, self.prefix)).masked()
+            gateway = subnet.network + crawler_conf.LINK_GATEWAY_HOST
+            name = str(subnet)
+        with self.lock:
+            if name not in self.groups:
+                self.groups[name] = LinkGroup(name, gateway)
+            return self.groups[name]
+
+    def gateways(self, addresses):
+        """The gateways of the groups these host addresses fall in"""
+        return set([self.group(address).gateway for address in addresses])
+
+    def swept(self, reachable):
+        """Take note of which gateways answered a ping sweep"""
+        with self.lock:
+            for group in self.groups.values():
+                if reachable.get(group.gateway) is not None:
+                    self.trusted.add(group.gateway)
+
+    def hold(self, host, job):
+        """If the host's link is down, set the job aside and return the
+        LinkGroup; else None (go ahead and visit)"""
+        group = self.group(host.ip_addr)
+        with self.lock:
+            if not group.is_down():
+                return None
+            group.held.append(job)
+            return group
+
+    def visited(self, host, code):
+        """Take note of how a visit went (failure_code of it); probes the
+        gateway if the host's group has failed often enough in a row.
+        Returns the LinkGroup if its link has just been found down."""
+        group = self.group(host.ip_addr)
+        with self.lock:
+            if code not in UNREACHABLE:
+                group.failures = 0
+                return None
+            group.failures += 1
+            if group.failures < self.threshold or group.is_down() or \
+               group.probing or group.gateway not in self.trusted:
+                return None
+            group.probing = True
+        answered = self.probe(group.gateway)
+        with self.lock:
+            group.probing = False
+            group.failures = 0
+            if answered:
+                return None # the hosts themselves are down, not the link
+            group.down_at = time.time()
+            return group
+
+    def down(self):
+        """The groups whose links are down, with what they hold"""
+        with self.lock:
+            return [group for group in self.groups.values()
+                    if group.is_down()]
+
+    def retry(self, group):
+        """Probe a down link again; if it is back up, returns the jobs
+        held for it (and lets its hosts through again), else None"""
+        if not self.probe(group.gateway):
+            return None
+        with self.lock:
+            held = group.held
+            group.held = []
+            group.down_at = None
+            return held
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        sys.exit('usage: %s opennms_file ...' % sys.argv[0])
+
+    # the links the inventory is reached over, and whether they answer
+    import host_walker
+    watch = LinkWatch()
+    walker = host_walker.HostWalker(sys.argv[1:])
+    counts = {}
+    for host in walker:
+        group = watch.group(host.ip_addr)
+        counts[group] = counts.get(group, 0) + 1
+    reachable = ping_sweep.sweep(set([group.gateway for group in counts]))
+    for (group, count) in sorted(counts.items(), key=lambda item: item[1],
+                                 reverse=True):
+        answered = 'answers'
+        if reachable.get(group.gateway) is None:
+            answered = 'does not answer'
+        print '%s: %d units, gateway %s %s ping' % (group, count,
+                                                    group.gateway, answered)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+# mikrotik_api_client.py
+
+"""A small client for the RouterOS API (TCP port 8728).
+
+The API speaks in sentences: a command word such as '/system/resource/print',
+then attribute words such as '=name=value', then an empty word.  Each word is
+sent as its length (in one to five bytes) followed by the word.  Replies are
+sentences too: '!re' for each row of output, '!trap' for an error, '!done'
+when a command is finished, and '!fatal' just before the router hangs up.
+
+One connection does for a whole visit, and commands can be pipelined: all of
+them sent at once, each with its own '.tag', and the replies sorted out by tag
+as they come back.  That is one round trip for what SSH would do with a login
+and a pty apiece, and the answers come back as fields, not screen scrapings.
+
+(RouterOS has no /export over the API, so config exports still go over SSH.)
+"""
+
+import sys
+import socket
+import struct
+import hashlib
+import binascii
+
+API_PORT = 8728
+
+class ApiError(Exception):
+    """The router said '!trap' or '!fatal', or spoke nonsense"""
+
+class ApiLoginError(ApiError):
+    """The router would not let us log in"""
+
+def encode_length(length):
+    """The bytes that say how long a word is"""
+    if length < 0x80:
+        return chr(length)
+    elif length < 0x4000:
+        return struct.pack('!H', length | 0x8000)
+    elif length < 0x200000:
+        return struct.pack('!I', length | 0xC00000)[1:]
+    elif length < 0x10000000:
+        return struct.pack('!I', length | 0xE0000000)
+    return '\xF0' + struct.pack('!I', length)
+
+def decode_length(read):
+    """Read how long the next word is; read(n) must return n bytes"""
+    first = ord(read(1))
+    if first < 0x80:
+        return first
+    elif first < 0xC0:
+        return ((first & 0x3F) << 8) | ord(read(1))
+    elif first < 0xE0:
+        return ((first & 0x1F) << 16) | struct.unpack('!H', read(2))[0]
+    elif first < 0xF0:
+        return ((first & 0x0F) << 24) | \
+               struct.unpack('!I', '\x00' + read(3))[0]
+    elif first == 0xF0:
+        return struct.unpack('!I', read(4))[0]
+    raise ApiError('bad word length byte 0x%02x' % first)
+
+def parse_sentence(words):
+    """(reply word, {attribute: value}) of a reply sentence.  API attributes
+    ('=name=value') go in by name, '.tag=N' as '.tag', and a bare word (as
+    after '!fatal') as 'message'."""
+    attrs = {}
+    for word in words[1:]:
+        if word.startswith('='):
+            (name, value) = (word[1:].split('=', 1) + [''])[:2]
+            attrs[name] = value
+        elif word.startswith('.tag='):
+            attrs['.tag'] = word[len('.tag='):]
+        else:
+            attrs['message'] = word
+    return (words[0], attrs)
+
+class ApiRos(object):
+    """A logged-in connection to one router's API"""
+
+    def __init__(self, sock):
+        self.sock   = sock
+        self.infile = sock.makefile('rb')
+
+    @classmethod
+    def connect(cls, address, user, pwd, port=API_PORT,
+                connect_timeout=10, timeout=30):
+        """Connect to a router and log in; socket.error if it won't talk"""
+        sock = socket.create_connection((str(address), port),
+                                        connect_timeout)
+        sock.settimeout(timeout)
+        api = cls(sock)
+        try:
+            api.login(user, pwd)
+        except:
+            api.close()
+            raise
+        return api
+
+    def close(self):
+        self.infile.close()
+        self.sock.close()
+
+    def _read(self, count):
+        data = self.infile.read(count)
+        if len(data) != count:
+            raise socket.error('router closed the API connection')
+        return data
+
+    def write_sentence(self, words):
+        """Send a sentence (in one go, so pipelined ones aren't split up)"""
+        data = []
+        for word in words:
+            data.append(encode_length(len(word)))
+            data.append(word)
+        data.append(encode_length(0))
+        self.sock.sendall(''.join(data))
+
+    def read_sentence(self):
+        """(reply word, attributes) of the next sentence from the router"""
+        words = []
+        while True:
+            length = decode_length(self._read)
+            if length == 0:
+                break
+            words.append(self._read(length))
+        if not words:
+            raise ApiError('empty sentence')
+        (reply, attrs) = parse_sentence(words)
+        if reply == '!fatal':
+            raise ApiError(attrs.get('message', 'fatal'))
+        return (reply, attrs)
+
+    def _done(self, error_class=ApiError):
+        """Read an untagged command's replies; the attributes of '!done'"""
+        trap = None
+        while True:
+            (reply, attrs) = self.read_sentence()
+            if reply == '!trap':
+                trap = attrs.get('message', 'trap')
+            elif reply == '!done':
+                if trap is not None:
+                    raise error_class(trap)
+                return attrs
+
+    def login(self, user, pwd):
+        """Log in: by name and password since RouterOS 6.43, or else by
+        answering the challenge older routers reply with"""
+        self.write_sentence(['/login', '=name=%s' % user,
+                             '=password=%s' % pwd])
+        attrs = self._done(ApiLoginError)
+        if 'ret' in attrs:
+            challenge = binascii.unhexlify(attrs['ret'])
+            response = hashlib.md5('\x00' + pwd + challenge).hexdigest()
+            self.write_sentence(['/login', '=name=%s' % user,
+                                 '=response=00%s' % response])
+            self._done(ApiLoginError)
+
+    def pipeline(self, commands):
+        """Send several commands (each a list of words) at once, then
+        collect the replies.  Returns, for each command in turn, (rows,
+        error): rows a list of attribute dictionaries, error the message of
+        its '!trap' or None."""
+        for (tag, words) in enumerate(commands):
+            self.write_sentence(list(words) + ['.tag=%d' % tag])
+        results = [([], None) for words in commands]
+        pending = set(range(len(commands)))
+        while pending:
+            (reply, attrs) = self.read_sentence()
+            try:
+                tag = int(attrs.pop('.tag'))
+                (rows, error) = results[tag]
+            except (KeyError, ValueError, IndexError):
+                raise ApiError('reply with no tag of ours: %s' % reply)
+            if reply == '!re':
+                rows.append(attrs)
+            elif reply == '!trap':
+                results[tag] = (rows, attrs.get('message', 'trap'))
+            elif reply == '!done':
+                pending.discard(tag)
+        return results
+
+    def talk(self, words):
+        """Run one command; its rows, or ApiError if it failed"""
+        [(rows, error)] = self.pipeline([words])
+        if error is not None:
+            raise ApiError(error)
+        return rows
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 5:
+        sys.exit('usage: %s ipaddress user password command [=attr=value...]'
+                 % sys.argv[0])
+
+    api = ApiRos.connect(sys.argv[1], sys.argv[2], sys.argv[3])
+    try:
+        for row in api.talk(sys.argv[4:]):
+            for (name, value) in sorted(row.items()):
+                print '%s: %s' % (name, value)
+            print
+    finally:
+        api.close()
@@ -9,109 +9,263 @@ Written by jwiggins@inveneo.org 2011-2012
 
 from __future__ import with_statement
 import os
+import re
 import sys
+import time
 import socket
 import ipaddr
 import crawler_conf
 import crawler_util
 from host_control import HostControl, HostControlError
-#from mikrotik_api_client import ApiRos
+from mikrotik_api_client import ApiRos, ApiError, ApiLoginError, API_PORT
 
-API_PORT = 8728 
+# the first line of an export says when it was made; that is no change
+EXPORT_STAMP = re.compile(r'^# \S+ \S+ by RouterOS')
+
+# multipliers for memory sizes in "system resource print"
+SIZE_UNITS = {'': 1, 'B': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3}
+
+# a RouterOS timespan such as '1w2d3h4m5s' (the API says it the same way)
+TIMESPAN      = re.compile(r'^(?:\d+[wdhms])+$')
+TIMESPAN_PART = re.compile(r'(\d+)([wdhms])')
+TIMESPAN_UNIT = {'w': 7 * 24 * 60 * 60, 'd': 24 * 60 * 60, 'h': 60 * 60,
+                 'm': 60, 's': 1}
+
+def parse_uptime(text):
+    """RouterOS timespan such as '1w2d3h4m5s' into seconds"""
+    if not TIMESPAN.match(text):
+        raise HostControlError(HostControlError.PARSE,
+                               'uptime string %s' % text)
+    return sum([int(number) * TIMESPAN_UNIT[unit]
+                for (number, unit) in TIMESPAN_PART.findall(text)])
+
+def parse_size(text):
+    """Memory size such as '105020KiB' or '30.2MiB' into bytes"""
+    number = text.rstrip('BKMGi')
+    try:
+        return int(float(number) * SIZE_UNITS[text[len(number):]])
+    except (ValueError, KeyError):
+        raise HostControlError(HostControlError.PARSE, 'size %s' % text)
+
+def export_fingerprint(lines):
+    """Checksum of an export, leaving out the line saying when it was made"""
+    checksum = crawler_util.CHECKSUM()
+    for line in lines:
+        if not EXPORT_STAMP.match(line):
+            checksum.update(line)
+            checksum.update('\n')
+    return checksum.hexdigest()
+
+def routing_tables(addresses, routes, neighbors):
+    """The API's address, route and OSPF neighbour rows, as
+    network_topology.Topology.learn takes them"""
+    return {'addresses' : [row['address'] for row in addresses
+                           if row.get('disabled') != 'true' and
+                              'address' in row],
+            'routes'    : [[row['dst-address'], row.get('gateway'),
+                            int(row.get('connect') == 'true')]
+                           for row in routes
+                           if row.get('active') == 'true' and
+                              'dst-address' in row],
+            'neighbors' : [row['address'] for row in neighbors or []
+                           if 'address' in row]}
 
 class MikrotikRouter(HostControl):
     """Controls a Mikrotik router"""
 
+    USE_API = True # False to do everything over SSH
+
+    # API and SSH logins and the SFTP pull; the API's resource print and
+    # SSH's if the API won't talk; the export, saving the binary backup
+    # and pulling it
+    VISIT_STEPS = (3, 2, 3)
+
     def __init__(self, hostname, ipaddress, pwd,
                        max_uptime=crawler_util.SEVEN_DAYS):
         HostControl.__init__(self, hostname, ipaddress,
                                crawler_conf.USERNAME_MIKROTIK, pwd, max_uptime)
         self.host_make  = crawler_util.HOST_MAKE_MIKROTIK
-        self.version  = None
-        self.hardware = None
+        self.facts = None
+        self.api = None            # ApiRos connection, once opened
+        self.api_refused = False   # True if the router won't talk API
+
+    def _api(self):
+        """The API connection for this visit, opened on first use"""
+        if self.api is None:
+            started = time.time()
+            self.api = ApiRos.connect(self.ipaddress, self.user, self.pwd,
+                                      API_PORT, self._timeout('connect'),
+                                      self._timeout('command'))
+            self._timed('connect', 'api', started)
+        return self.api
+
+    def _close_api(self):
+        if self.api is not None:
+            try:
+                self.api.close()
+            except socket.error:
+                pass
+            self.api = None
+
+    def close_session(self):
+        self._close_api()
+        HostControl.close_session(self)
+
+    def _api_facts(self):
+        """Resources, OSPF neighbours, addresses and routes over the API,
+        in one round trip: (fields of the resource print, [fields of each
+        neighbour] or None if the router does no OSPF, routing tables for
+        get_routing or None).  socket.error if the API won't talk."""
+        try:
+            api = self._api()
+            started = time.time()
+            [(resources, error), (neighbors, ospf_error),
+             (addresses, address_error), (routes, route_error)] = \
+                api.pipeline([['/system/resource/print'],
+                              ['/routing/ospf/neighbor/print'],
+                              ['/ip/address/print'],
+                              ['/ip/route/print']])
+            self._timed('command', 'api', started)
+        except ApiLoginError, err:
+            raise HostControlError(HostControlError.PASSWD, str(err))
+        except ApiError, err:
+            raise HostControlError(HostControlError.API, str(err))
+        if error or not resources:
+            raise HostControlError(HostControlError.API,
+                                   error or 'no system resources')
+        if ospf_error:
+            neighbors = None # no routing package, or no OSPF
+        routing = None
+        if not address_error and not route_error:
+            routing = routing_tables(addresses, routes, neighbors)
+        return (resources[0], neighbors, routing)
+
+    def _ssh_facts(self):
+        """The fields of "system resource print", scraped over SSH"""
+        raw = {}
+        for line in self.ssh_command('system resource print; quit'):
+            if ':' in line:
+                (key, val) = line.split(':', 1)
+                raw[key.strip()] = val.strip().strip('"')
+        return raw
+
+    def gather_facts(self, refresh=False):
+        """Ask for system resources (and OSPF neighbours) once and keep
+        what they say, over the API if the router will talk it, else SSH.
+        Returns a dictionary with keys version, hardware, uptime (seconds),
+        cpu_load (percent), free_memory and total_memory (bytes), neighbors
+        (see get_adjacency), routing (see get_routing) and raw (every
+        resource field, by its own name)."""
+        if self.facts is not None and not refresh:
+            return self.facts
+        raw = None
+        neighbors = None
+        routing = None
+        if self.USE_API and not self.api_refused:
+            try:
+                (raw, neighbors, routing) = self._api_facts()
+            except socket.error:
+                # API service off or filtered: do without it
+                self._close_api()
+                self.api_refused = True
+        if raw is None:
+            raw = self._ssh_facts()
+        try:
+            facts = {'version'      : raw['version'],
+                     'hardware'     : raw['board-name'],
+                     'uptime'       : parse_uptime(raw['uptime']),
+                     'cpu_load'     : int(raw.get('cpu-load', '0').rstrip('%')),
+                     'free_memory'  : parse_size(raw.get('free-memory', '0')),
+                     'total_memory' : parse_size(raw.get('total-memory',
+                                                         '0'))}
+        except KeyError, err:
+            raise HostControlError(HostControlError.PARSE,
+                                   'system resource print lacks %s' % err)
+        except ValueError:
+            raise HostControlError(HostControlError.PARSE,
+                                   'cpu-load %s' % raw['cpu-load'])
+        facts['neighbors'] = neighbors
+        facts['routing'] = routing
+        facts['raw'] = raw
+        self.facts = facts
+        return self.facts
 
     def get_version(self):
-        if self.version == None:
-            result = self.ssh_command('system resource print; quit')
-            line = result[1]
-            self.version = line.split(':')[1].strip().strip('"')
-        return self.version
+        return self.gather_facts()['version']
 
     def get_hardware(self):
-        if self.hardware == None:
-            result = self.ssh_command('system resource print; quit')        
-            for i, line in enumerate(result):
-                if "board-name" in line:
-                      self.hardware = line.split(':')[1].strip().strip('"')           
-            if self.hardware == None:
-               raise HostControl.HostControlError((
-                       'Error parsing system resource printout'))
-        return self.hardware
+        return self.gather_facts()['hardware']
 
     def get_uptime(self):
-        """This thing is a bear to parse"""
-        result = self.ssh_command('system resource print; quit')
-        line = result[0]
-        str = line.split(':')[1].strip()
-        parts = {'w':0, 'd':0, 'h':0, 'm':0, 's':0}
-        sum = 0
-        for i in range(len(str)):
-            c = str[i]
-            if c.isdigit():
-                sum = sum * 10 + int(c)
-            elif c in parts.keys():
-                parts[c] = sum
-                sum = 0
-            else:
-                raise HostControl.HostControlError((
-                        'Error parsing uptime string %s' % str))
-        weeks = parts['w']
-        days  = parts['d'] + weeks * 7
-        hours = parts['h'] + days * 24
-        mins  = parts['m'] + hours * 60
-        return parts['s'] + mins * 60
-
-#    def get_adjacency(self):
-#        """Return OSPF neighbor adjacency time"""
-#        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-#        s.connect((str(self.ipaddress), API_PORT))
-#        apiros = ApiRos(s)
-#        apiros.login(self.user, self.pwd)
-#        apiros.writeSentence('/routing/ospf/neighbor/print')
-#        return 1
+        return self.gather_facts()['uptime']
+
+    def get_adjacency(self):
+        """OSPF neighbours, as [(router id, address, state, adjacency time
+        in seconds or None)]; None if not known (no API, or no OSPF)"""
+        neighbors = self.gather_facts()['neighbors']
+        if neighbors is None:
+            return None
+        adjacency = []
+        for row in neighbors:
+            seconds = None
+            if TIMESPAN.match(row.get('adjacency', '')):
+                seconds = parse_uptime(row['adjacency'])
+            adjacency.append((row.get('router-id'), row.get('address'),
+                              row.get('state'), seconds))
+        return adjacency
+
+    def get_routing(self):
+        """Addresses, routes and OSPF neighbours, as network_topology
+        takes them, if this visit asked for them over the API"""
+        if self.facts is None:
+            return None
+        return self.facts['routing']
 
     def _backup_file_stem(self):
         return '%s_%s_%s' % (self.hostname,
                              self.get_hardware(),
                              self.get_version())
 
-    def _backup_binary(self, dst_dir):
+    def _backup_binary(self, dst_dir, fingerprint):
+        """Saves and pulls a binary backup, unless the export (fingerprint)
+        is the same as when we last did"""
         dst_file = '%s.backup' % self._backup_file_stem()
         src_dir = None
         src_file = 'crawler.backup'
-        self.ssh_command('system backup save name=crawler; quit')
-        self._safe_sftp(src_dir, src_file, dst_dir, dst_file)
+        if self._unchanged(fingerprint, dst_dir, dst_file):
+            return '%s unchanged' % src_file
+        self.ssh_command('system backup save name=crawler; quit',
+                         timeout='transfer')
+        checksum = self._safe_sftp(src_dir, src_file, dst_dir, dst_file)
+        self._set_fingerprint(fingerprint, dst_dir, dst_file, checksum)
         return src_file
 
     def _backup_config(self, dst_dir):
+        """Writes out the export; returns what to report and its fingerprint"""
         dst_file = '%s.config' % self._backup_file_stem()
-        config = self.ssh_command('export; quit')
-        with open(os.path.join(dst_dir, dst_file), 'w') as outfile:
-            for line in config:
-                clean = line.rstrip()
-                if clean != 'interrupted':
-                    outfile.write(clean)
-                    outfile.write('\n')
-        return 'export'
+        config = self.ssh_command('export; quit', timeout='transfer')
+        clean = [line.rstrip() for line in config]
+        lines = [line for line in clean if line != 'interrupted']
+        fingerprint = export_fingerprint(lines)
+        if self._unchanged(fingerprint, dst_dir, dst_file):
+            return ('export unchanged', fingerprint)
+        checksum = self._safe_write(lines, dst_dir, dst_file)
+        self._set_fingerprint(fingerprint, dst_dir, dst_file, checksum)
+        return ('export', fingerprint)
 
     def backup(self, backup_root):
+        """The export is cheap, so it comes first: if it has not changed,
+        neither (to our way of thinking) has the binary backup, and we are
+        spared saving one on the router and pulling it over"""
         dst_dir = HostControl.backup(self, backup_root)
-        fileb = self._backup_binary(dst_dir)
-        filec = self._backup_config(dst_dir)
+        (filec, fingerprint) = self._backup_config(dst_dir)
+        fileb = self._backup_binary(dst_dir, fingerprint)
         return '%s+%s' % (fileb, filec)
 
-    def reboot(self, tick):
-        return HostControl.reboot(self, 'system reboot ; beep', 10, tick)
+    def reboot(self, tick, tracker=None):
+        self.facts = None # uptime and the rest are stale after this
+        return HostControl.reboot(self, 'system reboot ; beep', 10, tick,
+                                  None, tracker)
 
 if __name__ == '__main__':
 
@@ -128,8 +282,9 @@ if __name__ == '__main__':
     print 'Version =', router.get_version()
     print 'Hardware =', router.get_hardware()
     print 'Uptime about', crawler_util.rough_timespan(router.get_uptime())
-#    print 'Adjacency:'
-#    print router.get_adjacency()
+    print 'CPU load = %d%%' % router.gather_facts()['cpu_load']
+    print 'Adjacency:'
+    print router.get_adjacency()
     if reboot:
         print router.backup('.')
         print router.reboot(True)
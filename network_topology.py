@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+# network_topology.py
+
+"""Which hosts sit behind which routers, for a downstream-first walk.
+
+The model is built from what the crawl already sees:
+
+  * each Mikrotik router's addresses, routes and OSPF neighbours, asked for
+    over the API on its visit (see MikrotikRouter.get_routing)
+  * each host's hop count from the crawler, from the TTL of its reply to
+    the ping sweep (when the sweep has a raw socket)
+
+A router's parent is the router its route back to the crawler goes through
+(none if the crawler is on one of its own networks); failing that, the
+neighbour or router on a shared network with the most hops fewer than its
+own.  Any other host's parent is the router nearest the crawler of those
+with the most specific connected network around it.  Hosts with no router
+around them are roots of their own.
+
+Walking each tree children first (furthest hops first among siblings, then
+by address) gives a leaf-first order, in which a router comes after every
+host behind it, so rebooting it cannot strand them.  Separate trees share
+no router, and can be crawled at the same time.
+
+What was learned is kept in a JSON file between runs, as the walk order is
+wanted before the night's visits start.
+"""
+
+from __future__ import with_statement
+import os
+import sys
+import json
+import socket
+import ipaddr
+import threading
+import crawler_util
+
+class Topology(object):
+    """Routing tables and hop counts, and the trees they make"""
+
+    def __init__(self, topo_file=None):
+        self.topo_file = topo_file
+        self.routers   = {} # IP as integer -> routing tables (see learn)
+        self.hops      = {} # IP as integer -> hops from the crawler
+        self.parent_of = {} # IP as integer -> parent's, from the last walk
+        self.local_ip  = None # the crawler's own address, once looked up
+        self.lock      = threading.Lock()
+        if topo_file and os.path.exists(topo_file):
+            with open(topo_file) as infile:
+                saved = json.load(infile)
+            self.routers = dict([(int(ip), tables) for (ip, tables)
+                                 in saved.get('routers', {}).items()])
+            self.hops = dict([(int(ip), hops) for (ip, hops)
+                              in saved.get('hops', {}).items()])
+
+    def learn(self, ip, tables):
+        """Take in a router's tables: {'addresses' : [CIDR of each of its
+        addresses], 'routes' : [[destination CIDR, gateway, 1 if connected
+        else 0]], 'neighbors' : [address of each OSPF neighbour]}; None if
+        it didn't say"""
+        if tables is None:
+            return
+        with self.lock:
+            self.routers[crawler_util.ip_to_int(ip)] = tables
+
+    def measured(self, hop_counts):
+        """Take in {address: hops} from a ping sweep"""
+        with self.lock:
+            for (address, hops) in hop_counts.items():
+                self.hops[crawler_util.ip_to_int(address)] = hops
+
+    def save(self):
+        if not self.topo_file:
+            return
+        with self.lock:
+            saved = {'routers' : dict([(str(ip), tables) for (ip, tables)
+                                       in self.routers.items()]),
+                     'hops'    : dict([(str(ip), hops) for (ip, hops)
+                                       in self.hops.items()])}
+        crawler_util.write_atomically(self.topo_file,
+                                      json.dumps(saved, sort_keys=True))
+
+    def _local_ip(self, toward):
+        """The crawler's own address on the way to toward (an integer)"""
+        if self.local_ip is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                try:
+                    # sends nothing; just picks the route and the address
+                    sock.connect((str(ipaddr.IPv4Address(toward)), 9))
+                    self.local_ip = crawler_util.ip_to_int(
+                                        sock.getsockname()[0])
+                except socket.error:
+                    pass
+            finally:
+                sock.close()
+        return self.local_ip
+
+    def parents(self, ips):
+        """{IP: IP of its parent, or None} for the given integer IPs"""
+        with self.lock:
+            routers = dict([(ip, self.routers[ip]) for ip in ips
+                            if ip in self.routers])
+            hops = dict(self.hops)
+        owner = {}     # address of a router interface -> the router
+        networks = {}  # router -> [its connected networks]
+        for (router, tables) in routers.items():
+            networks[router] = []
+            for cidr in tables.get('addresses') or []:
+                interface = ipaddr.IPv4Network(cidr)
+                owner[int(interface.ip)] = router
+                networks[router].append(interface.masked())
+            for (dst, gateway, connected) in tables.get('routes') or []:
+                if connected:
+                    networks[router].append(ipaddr.IPv4Network(dst))
+
+        sharing = {} # (network as integer, prefix length) -> routers on it
+        for (router, nets) in networks.items():
+            for net in nets:
+                sharing.setdefault((int(net.network), net.prefixlen),
+                                   set()).add(router)
+
+        parent_of = dict([(ip, None) for ip in ips])
+        for router in routers:
+            parent_of[router] = self._router_parent(router, routers, owner,
+                                                    networks, sharing, hops)
+        break_cycles(parent_of)
+
+        # each network as integers, by prefix length: network -> the router
+        # nearest the crawler (then lowest address) of those on it
+        by_prefix = {} # prefix length -> {network as integer -> router}
+        for (router, nets) in networks.items():
+            key = (len(ancestors(parent_of, router)), router)
+            for net in nets:
+                on_net = by_prefix.setdefault(net.prefixlen, {})
+                network = int(net.network)
+                if network not in on_net or key < on_net[network][0]:
+                    on_net[network] = (key, router)
+        lookups = [(prefix_mask(prefixlen), by_prefix[prefixlen])
+                   for prefixlen in sorted(by_prefix, reverse=True)]
+        for ip in ips:
+            if ip in routers:
+                continue
+            for (mask, on_net) in lookups: # most specific first
+                found = on_net.get(ip & mask)
+                if found is not None:
+                    parent_of[ip] = found[1]
+                    break
+        return parent_of
+
+    def _router_parent(self, router, routers, owner, networks, sharing,
+                       hops):
+        """The router that a router's traffic to the crawler goes through"""
+        local_ip = self._local_ip(router)
+        if local_ip is not None:
+            local = ipaddr.IPv4Address(local_ip)
+            for net in networks[router]:
+                if local in net:
+                    return None # the crawler is right there
+            best = None
+            for (dst, gateway, connected) in \
+                    routers[router].get('routes') or []:
+                net = ipaddr.IPv4Network(dst)
+                if connected or local not in net:
+                    continue
+                if best is None or net.prefixlen > best[0]:
+                    best = (net.prefixlen, gateway)
+            if best is not None:
+                try:
+                    gateway = crawler_util.ip_to_int(best[1])
+                except socket.error:
+                    gateway = None # an interface name, not an address
+                if owner.get(gateway, router) != router:
+                    return owner[gateway]
+
+        # no route to go on: the nearest of its neighbours, by hops
+        if router not in hops:
+            return None
+        candidates = set()
+        for address in routers[router].get('neighbors') or []:
+            try:
+                candidates.add(owner.get(crawler_util.ip_to_int(address)))
+            except socket.error:
+                pass
+        for net in networks[router]:
+            candidates.update(sharing[(int(net.network), net.prefixlen)])
+        best = None
+        for other in candidates:
+            if other is None or other == router or other not in hops:
+                continue
+            if hops[other] < hops[router] and \
+               (best is None or hops[other] > hops[best]):
+                best = other
+        return best
+
+    def subtrees(self, ips):
+        """Leaf-first lists of the given integer IPs, one per tree, each
+        sharing no router with the others; remembers the parents for
+        ancestors()"""
+        ips = list(ips)
+        parent_of = self.parents(ips)
+        children = {}
+        roots = []
+        for ip in ips:
+            parent = parent_of[ip]
+            if parent is None or parent not in parent_of:
+                roots.append(ip)
+            else:
+                children.setdefault(parent, []).append(ip)
+        hops = self.hops
+        order = lambda ip: (-hops.get(ip, 0), ip) # furthest first
+        trees = []
+        for root in sorted(roots, key=order):
+            tree = []
+            stack = [(root, False)]
+            while stack:
+                (ip, expanded) = stack.pop()
+                if expanded:
+                    tree.append(ip)
+                    continue
+                stack.append((ip, True))
+                for child in sorted(children.get(ip, []), key=order,
+                                    reverse=True):
+                    stack.append((child, False))
+            trees.append(tree)
+        with self.lock:
+            self.parent_of = parent_of
+        return trees
+
+    def leaf_first(self, ips):
+        """The given integer IPs, each after every host behind it"""
+        order = []
+        for tree in self.subtrees(ips):
+            order.extend(tree)
+        return order
+
+    def ancestors(self, ip):
+        """Routers between the crawler and an integer IP, nearest first"""
+        with self.lock:
+            return ancestors(self.parent_of, ip)
+
+def prefix_mask(prefixlen):
+    """The netmask of a prefix length, as an integer"""
+    return (0xffffffff << (32 - prefixlen)) & 0xffffffff
+
+def ancestors(parent_of, ip):
+    """Parents of ip, nearest first, following parent_of"""
+    chain = []
+    parent = parent_of.get(ip)
+    while parent is not None:
+        chain.append(parent)
+        parent = parent_of.get(parent)
+    return chain
+
+def break_cycles(parent_of):
+    """Cut any loop of parents (from tables that disagree) at one link"""
+    for ip in parent_of:
+        seen = set([ip])
+        parent = parent_of[ip]
+        while parent is not None:
+            if parent == ip:
+                parent_of[ip] = None
+                break
+            if parent in seen:
+                break # a loop further up, cut when we get to it
+            seen.add(parent)
+            parent = parent_of.get(parent)
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 3:
+        sys.exit('usage: %s topology_file opennms_file ...' % sys.argv[0])
+
+    # draw the trees the walk would follow
+    import host_walker
+    topology = Topology(sys.argv[1])
+    walker = host_walker.HostWalker(sys.argv[2:])
+    hosts = dict([(host.ip, host) for host in walker])
+    trees = topology.subtrees(hosts.keys())
+    for tree in trees:
+        for ip in reversed(tree):
+            print '%s%s (%s hops)' % ('  ' * len(topology.ancestors(ip)),
+                                      hosts[ip], topology.hops.get(ip, '?'))
+    print '%d units in %d trees' % (len(hosts), len(trees))
@@ -13,6 +13,7 @@ COMMAND=`${BASENAME} $1`
 
 LOG_DIR="/var/log/inveneo"
 LOG_FILE="${LOG_DIR}/${COMMAND}.log"
+SUMMARY="${LOG_DIR}/${COMMAND}.summary"  # heads the email, if written
 TMPLOG="/tmp/${COMMAND}.log"
 PIDFILE="/tmp/${COMMAND}.pid"
 
@@ -43,12 +44,19 @@ fi
 trap "rm -f ${PIDFILE}; exit" INT TERM EXIT
 echo $$ > ${PIDFILE}
 
-# execute the command as passed in
+# execute the command as passed in (it may write a summary of its run)
+rm -f ${SUMMARY}
+NIGHTLY_SUMMARY=${SUMMARY} ; export NIGHTLY_SUMMARY
 $* 2>&1 >> ${LOG_FILE}
 
 # attempt to send email report (append any output to logfile)
 echo "${COMMAND} sending report at `date`" 2>&1 >> ${LOG_FILE}
-cat ${LOG_FILE} | ${MAIL} -s"${SUBJECT}" ${MAILTO} 2>&1 > ${TMPLOG}
+if [ -s ${SUMMARY} ] ; then
+    ( cat ${SUMMARY} ; echo ; cat ${LOG_FILE} ) | \
+        ${MAIL} -s"${SUBJECT}" ${MAILTO} 2>&1 > ${TMPLOG}
+else
+    cat ${LOG_FILE} | ${MAIL} -s"${SUBJECT}" ${MAILTO} 2>&1 > ${TMPLOG}
+fi
 cat ${TMPLOG} >> ${LOG_FILE}
 rm -f ${TMPLOG}
 
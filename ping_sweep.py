@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+# ping_sweep.py
+
+"""Pings a whole list of hosts at once, from one ICMP socket in this process.
+
+Uses an unprivileged ICMP datagram socket if the kernel allows it (see sysctl
+net.ipv4.ping_group_range), otherwise a raw socket (which needs root).  Many
+echo requests are kept in flight at once, and hosts that do not answer in time
+are retried.  The result maps each address to its round trip time in seconds,
+or to None if it never answered.  With a raw socket, the TTL of each reply
+also tells how many hops away the host is (see hop_counts).
+"""
+
+import os
+import sys
+import time
+import errno
+import select
+import socket
+import struct
+import crawler_conf
+from collections import deque
+
+ICMP_ECHO_REPLY   = 0
+ICMP_ECHO_REQUEST = 8
+ICMP_HEADER       = '!BBHHH' # type, code, checksum, identifier, sequence
+PAYLOAD           = 'inveneo-crawler-sweep'
+INITIAL_TTLS      = (32, 64, 128, 255) # what hosts start their replies at
+
+def checksum(data):
+    """The Internet checksum (RFC 1071) of a string"""
+    if len(data) % 2:
+        data += '\0'
+    total = sum(struct.unpack('!%dH' % (len(data) / 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+def echo_request(ident, seq):
+    """Build an ICMP echo request packet"""
+    header = struct.pack(ICMP_HEADER, ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    csum = checksum(header + PAYLOAD)
+    header = struct.pack(ICMP_HEADER, ICMP_ECHO_REQUEST, 0, csum, ident, seq)
+    return header + PAYLOAD
+
+def open_icmp_socket():
+    """Returns (socket, is_raw); raises socket.error if we may not ping"""
+    try:
+        return (socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                              socket.IPPROTO_ICMP), False)
+    except socket.error:
+        return (socket.socket(socket.AF_INET, socket.SOCK_RAW,
+                              socket.IPPROTO_ICMP), True)
+
+def hop_count(ttl):
+    """Hops a reply came, from its TTL: the host started it from the
+    smallest of the usual initial TTLs not below what arrived"""
+    for initial in INITIAL_TTLS:
+        if ttl <= initial:
+            return initial - ttl
+    return 0
+
+def parse_reply(packet, is_raw):
+    """Returns (ident, seq, ttl) of an echo reply packet, else None.
+    Raw sockets hand us the IP header too (and so the TTL); datagram sockets
+    do not (ttl None)."""
+    ttl = None
+    if is_raw:
+        ttl = ord(packet[8])
+        packet = packet[(ord(packet[0]) & 0x0f) * 4:]
+    if len(packet) < 8:
+        return None
+    (icmp_type, code, csum, ident, seq) = struct.unpack(ICMP_HEADER,
+                                                        packet[:8])
+    if icmp_type != ICMP_ECHO_REPLY:
+        return None
+    return (ident, seq, ttl)
+
+class PingSweep(object):
+    """One sweep of echo requests over a list of addresses"""
+
+    def __init__(self, timeout=crawler_conf.PING_SWEEP_TIMEOUT,
+                       retries=crawler_conf.PING_SWEEP_RETRIES,
+                       in_flight=crawler_conf.PING_SWEEP_IN_FLIGHT):
+        self.timeout   = timeout   # seconds to wait for each reply
+        self.retries   = retries   # extra tries before giving up on a host
+        self.in_flight = in_flight # most requests outstanding at once
+        self.ident     = os.getpid() & 0xffff
+        self.seq       = 0
+        self.ttls      = {}        # address -> TTL of its reply, if seen
+
+    def hop_counts(self):
+        """{address: hops away} of the hosts whose reply TTL we saw"""
+        return dict([(address, hop_count(ttl))
+                     for (address, ttl) in self.ttls.items()])
+
+    def _next_seq(self):
+        self.seq = (self.seq + 1) & 0xffff
+        return self.seq
+
+    def sweep(self, addresses):
+        """Ping every address; returns {address: rtt seconds or None}"""
+        (sock, is_raw) = open_icmp_socket()
+        self.ttls = {}
+        try:
+            return self._sweep(sock, is_raw, addresses)
+        finally:
+            sock.close()
+
+    def _sweep(self, sock, is_raw, addresses):
+        by_ip = {}        # dotted quad -> address object passed in
+        tries = {}        # dotted quad -> echo requests sent so far
+        sent = {}         # (dotted quad, seq) -> time sent
+        waiting = {}      # dotted quad -> seq of outstanding request
+        expiry = deque()  # (deadline, dotted quad, seq), oldest first
+        results = {}
+        todo = deque()
+        for address in addresses:
+            ip = str(address)
+            if ip not in by_ip:
+                by_ip[ip] = address
+                tries[ip] = 0
+                todo.append(ip)
+
+        while todo or waiting:
+
+            # fill the window of outstanding requests
+            while todo and len(waiting) < self.in_flight:
+                ip = todo.popleft()
+                seq = self._next_seq()
+                tries[ip] += 1
+                now = time.time()
+                try:
+                    sock.sendto(echo_request(self.ident, seq), (ip, 0))
+                except socket.error:
+                    # unroutable and the like; let it time out like a loss
+                    pass
+                sent[(ip, seq)] = now
+                waiting[ip] = seq
+                expiry.append((now + self.timeout, ip, seq))
+
+            # wait for replies until the oldest request expires
+            wait = 0
+            if expiry:
+                wait = max(0, expiry[0][0] - time.time())
+            try:
+                (readable, w, x) = select.select([sock], [], [], wait)
+            except select.error, err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+            while readable:
+                try:
+                    (packet, (ip, port)) = sock.recvfrom(2048)
+                except socket.error:
+                    break
+                received = time.time()
+                reply = parse_reply(packet, is_raw)
+                if reply and ip in waiting:
+                    (ident, seq, ttl) = reply
+                    # the kernel picks the ident of a datagram socket
+                    if (is_raw and ident != self.ident) or \
+                       (ip, seq) not in sent:
+                        continue
+                    results[by_ip[ip]] = received - sent[(ip, seq)]
+                    if ttl is not None:
+                        self.ttls[by_ip[ip]] = ttl
+                    del waiting[ip]
+                (readable, w, x) = select.select([sock], [], [], 0)
+
+            # retry or give up on requests that have gone unanswered
+            now = time.time()
+            while expiry and expiry[0][0] <= now:
+                (deadline, ip, seq) = expiry.popleft()
+                if waiting.get(ip) != seq:
+                    continue # answered, or superseded by a retry
+                del waiting[ip]
+                if tries[ip] <= self.retries:
+                    todo.append(ip)
+                else:
+                    results[by_ip[ip]] = None
+
+        return results
+
+def sweep(addresses, **kwargs):
+    """Convenience: one sweep with the configured settings"""
+    return PingSweep(**kwargs).sweep(addresses)
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        sys.exit('usage: %s ipaddress ...' % sys.argv[0])
+
+    start = time.time()
+    results = sweep(sys.argv[1:])
+    for address in sys.argv[1:]:
+        rtt = results[address]
+        if rtt is None:
+            print address, 'no reply'
+        else:
+            print address, '%.1f ms' % (rtt * 1000)
+    print 'Swept %d hosts in %.2f seconds' % (len(results), time.time() - start)
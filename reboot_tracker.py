@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+# reboot_tracker.py
+
+"""Watches rebooted hosts in the background while the crawl goes on.
+
+A host is handed over once its reboot command has been sent.  A single thread
+pings all the hosts it is watching together (see ping_sweep), backing off for
+each host that has not come back yet, until the host answers or has been gone
+too long.  The outcomes pile up until the visitor collects them for its report.
+"""
+
+from __future__ import with_statement
+import sys
+import time
+import socket
+import threading
+import ping_sweep
+import crawler_util
+from host_control import HostControl
+
+FIRST_POLL = 15  # seconds between first pings of a rebooting host
+MAX_POLL   = 120 # longest backoff between pings of a rebooting host
+
+class RebootOutcome(object):
+    """What became of one reboot"""
+    BACK       = 'back'       # answered ping again
+    LOST       = 'lost'       # did not answer within MAX_REBOOT_WAIT_SEC
+    UNRESOLVED = 'unresolved' # still being watched when the run ended
+
+    def __init__(self, unit, sent_at):
+        self.unit     = unit
+        self.sent_at  = sent_at
+        self.state    = self.UNRESOLVED
+        self.back_at  = None
+
+    def downtime(self):
+        """Seconds from sending the reboot until the host answered"""
+        if self.back_at is None:
+            return None
+        return self.back_at - self.sent_at
+
+    def __str__(self):
+        if self.state == self.BACK:
+            return 'back after %s' % \
+                        crawler_util.rough_timespan(self.downtime())
+        return self.state
+
+class RebootTracker(object):
+    """Background pinger of hosts that have been sent a reboot command"""
+
+    def __init__(self, max_wait=HostControl.MAX_REBOOT_WAIT_SEC,
+                       first_poll=FIRST_POLL, max_poll=MAX_POLL):
+        self.max_wait   = max_wait
+        self.first_poll = first_poll
+        self.max_poll   = max_poll
+        self.watching   = {} # address -> [outcome, next poll, poll interval]
+        self.resolved   = []
+        self.lock       = threading.Condition()
+        self.thread     = None
+        self.stopping   = False
+
+    def track(self, unit, down_wait):
+        """Start watching a unit; down_wait is seconds it takes to go down"""
+        now = time.time()
+        with self.lock:
+            self.watching[unit.ipaddress] = [RebootOutcome(unit, now),
+                                             now + down_wait, self.first_poll]
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.setDaemon(True)
+                self.thread.start()
+            self.lock.notify()
+
+    def pending(self):
+        """How many hosts are still being watched"""
+        with self.lock:
+            return len(self.watching)
+
+    def collect(self):
+        """Hand over (and forget) the outcomes resolved so far"""
+        with self.lock:
+            resolved = self.resolved
+            self.resolved = []
+            return resolved
+
+    def wait(self, timeout):
+        """Sleep up to timeout seconds, waking early if something resolves"""
+        with self.lock:
+            if self.watching and not self.resolved:
+                self.lock.wait(timeout)
+
+    def stop(self):
+        """Stop watching; outcomes still pending come back as unresolved"""
+        with self.lock:
+            self.stopping = True
+            unresolved = [entry[0] for entry in self.watching.values()]
+            self.watching = {}
+            self.lock.notifyAll()
+            return unresolved
+
+    def _due(self):
+        """Addresses whose next ping is due, and seconds until the next one"""
+        now = time.time()
+        due = []
+        sleep = self.max_poll
+        for (address, (outcome, next_poll, interval)) in self.watching.items():
+            if next_poll <= now:
+                due.append(address)
+            else:
+                sleep = min(sleep, next_poll - now)
+        return (due, sleep)
+
+    def _ping(self, addresses):
+        """address -> True if it answered; one sweep for all of them"""
+        try:
+            reachable = ping_sweep.sweep(addresses, retries=0)
+            return dict([(address, reachable.get(address) is not None)
+                         for address in addresses])
+        except socket.error:
+            # no ICMP socket for us: fork a ping per host
+            with self.lock:
+                units = [self.watching[address][0].unit
+                         for address in addresses
+                         if address in self.watching]
+            return dict([(unit.ipaddress, unit.is_pingable())
+                         for unit in units])
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if self.stopping:
+                    return
+                (due, sleep) = self._due()
+                if not due:
+                    self.lock.wait(sleep)
+                    continue
+
+            # ping outside the lock so track() and collect() don't wait on it
+            answered = self._ping(due)
+
+            now = time.time()
+            with self.lock:
+                for address in due:
+                    entry = self.watching.get(address)
+                    if entry is None:
+                        continue
+                    outcome = entry[0]
+                    if answered.get(address):
+                        outcome.state = RebootOutcome.BACK
+                        outcome.back_at = now
+                    elif now - outcome.sent_at > self.max_wait:
+                        outcome.state = RebootOutcome.LOST
+                    else:
+                        # back off until the next ping
+                        entry[1] = now + entry[2]
+                        entry[2] = min(entry[2] * 2, self.max_poll)
+                        continue
+                    del self.watching[address]
+                    self.resolved.append(outcome)
+                    self.lock.notifyAll()
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        sys.exit('usage: %s ipaddress ...' % sys.argv[0])
+
+    # pretend each address was just sent a reboot, to watch the polling
+    tracker = RebootTracker(max_wait=60, first_poll=2, max_poll=8)
+    for ip in sys.argv[1:]:
+        tracker.track(HostControl('unknown', ip, None, None), 0)
+    while tracker.pending():
+        tracker.wait(1)
+        for outcome in tracker.collect():
+            print outcome.unit.ipaddress, outcome
+    for outcome in tracker.collect():
+        print outcome.unit.ipaddress, outcome
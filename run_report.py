@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+
+# run_report.py
+
+"""The report of a run: one finished row per host, written in batches.
+
+A ReportRow is built up while its host is visited and handed to the
+ReportWriter only once it is whole, so rows from several workers never mix.
+The writer holds rows until it has a batch (or the batch has waited long
+enough), then hands them to each of its sinks:
+
+  * TsvSink, tab-separated values for the spreadsheet (the visitor's stdout)
+  * JsonLinesSink, one JSON object per row, for machines
+  * SummarySink, a few lines of counts and failures, for the nightly email
+
+Whatever is held is written out by flush(), and by close() at the end.
+"""
+
+from __future__ import with_statement
+import sys
+import json
+import time
+import threading
+import crawler_util
+from host_control import HostControlError
+from visit_metrics import FAILED, visit_result
+
+BATCH_ROWS = 20 # rows to hold before writing them out
+BATCH_WAIT = 30 # seconds to hold a row at most (checked as rows come in)
+MAX_FAILED = 50 # failed hosts to name in the summary
+
+HEADINGS = ('Make', 'Host', 'IP', 'Ping', 'Version', 'Uptime', 'Config')
+
+def failure_kind(error):
+    """Short name of a visit's (exception name, message), for counting"""
+    (name, msg) = error
+    if name == HostControlError.__name__:
+        return msg.split(':')[0]
+    return name
+
+class ReportRow(object):
+    """One row of the report: a host, and what became of it"""
+
+    VISIT   = 'visit'   # the host was visited (or tried)
+    BACKOFF = 'backoff' # the host is resting after failing repeatedly
+    REBOOT  = 'reboot'  # what became of a reboot sent earlier
+    LINK    = 'link'    # a link found down, and the hosts held behind it
+
+    def __init__(self, kind, make, hostname, ip):
+        self.kind     = kind
+        self.make     = make
+        self.hostname = hostname
+        self.ip       = str(ip)
+        self.cells    = [] # report fields after the IP
+        self.facts    = {} # the same, as values for JSON
+        self.result   = None # visit_metrics result, or reboot/backoff state
+
+    def add(self, cell):
+        """Add the next field"""
+        self.cells.append(str(cell))
+
+    def fail(self, name, msg=None):
+        """Add a field saying what went wrong"""
+        if msg is None:
+            self.add('FAIL:%s' % name)
+        else:
+            self.add('FAIL:%s:%s' % (name, msg))
+
+    def failed(self, name, msg):
+        """The visit broke off with an exception outside visitation"""
+        self.fail(name, msg)
+        self.result = FAILED
+        self.facts.update({'result' : FAILED,
+                           'error'  : {'name' : name, 'message' : msg}})
+
+    def visited(self, record):
+        """Take the facts of a finished VisitRecord"""
+        self.result = visit_result(record)
+        duration = None
+        if record.finished is not None:
+            duration = record.finished - record.started
+        self.facts.update({'result'      : self.result,
+                           'started'     : record.started,
+                           'duration'    : duration,
+                           'pingable'    : record.pingable,
+                           'rtt'         : record.rtt,
+                           'version'     : record.version,
+                           'hardware'    : record.hardware,
+                           'uptime'      : record.uptime,
+                           'backup'      : record.backup,
+                           'backup_hash' : record.backup_hash,
+                           'reboot'      : record.reboot,
+                           'phases'      : record.phases})
+        if record.error is not None:
+            self.facts['error'] = {'name'    : record.error[0],
+                                   'message' : record.error[1]}
+
+    def tsv(self):
+        return '\t'.join([self.make, self.hostname, self.ip] + self.cells)
+
+    def as_dict(self):
+        """The row as something json can write (device text as unicode)"""
+        row = {'kind'     : self.kind,
+               'make'     : self.make,
+               'hostname' : self.hostname,
+               'ip'       : self.ip,
+               'fields'   : self.cells}
+        row.update(self.facts)
+        return as_json(row)
+
+def as_json(value):
+    """value with every bytestring in it decoded, as json.dumps would
+    otherwise choke on one that is not UTF-8"""
+    if isinstance(value, dict):
+        return dict([(key, as_json(item)) for (key, item) in value.items()])
+    if isinstance(value, (list, tuple)):
+        return [as_json(item) for item in value]
+    return crawler_util.as_text(value)
+
+def visit_row(host):
+    """An empty row for a visit to a host_walker host"""
+    return ReportRow(ReportRow.VISIT, host.host_make, host.hostname,
+                     host.ip_addr)
+
+def backoff_row(host, failure):
+    """A row for a host resting after a failure_cache Failure"""
+    row = ReportRow(ReportRow.BACKOFF, host.host_make, host.hostname,
+                    host.ip_addr)
+    row.add('BACKOFF:%s' % failure)
+    row.result = failure.code
+    row.facts.update({'result' : 'backoff', 'failure' : failure.code,
+                      'count' : failure.count})
+    return row
+
+def reboot_row(outcome):
+    """A row saying what became of a reboot_tracker.RebootOutcome"""
+    unit = outcome.unit
+    row = ReportRow(ReportRow.REBOOT, unit.host_make, unit.hostname,
+                    unit.ipaddress)
+    row.add('REBOOT')
+    if outcome.state == outcome.BACK:
+        row.add(outcome)
+    else:
+        row.fail(outcome)
+    row.result = outcome.state
+    row.facts.update({'result' : outcome.state, 'sent_at' : outcome.sent_at,
+                      'downtime' : outcome.downtime()})
+    return row
+
+def read_rows(path):
+    """The ReportRows of a --json-report file"""
+    rows = []
+    with open(path) as infile:
+        for line in infile:
+            fields = json.loads(line)
+            row = ReportRow(fields['kind'], fields['make'],
+                            fields['hostname'], fields['ip'])
+            row.cells = fields['fields']
+            row.result = fields.get('failure', fields.get('result'))
+            row.facts = fields
+            rows.append(row)
+    return rows
+
+def link_row(group, units, down_for=None):
+    """A row for a link_watch LinkGroup found down, and the units held
+    behind it: visited after all if it came back after down_for seconds,
+    else not visited"""
+    row = ReportRow(ReportRow.LINK, ReportRow.LINK, group.name, group.gateway)
+    if down_for is not None:
+        row.add('LINK:back after %s, %d units held' %
+                (crawler_util.rough_timespan(down_for), units))
+        row.result = 'back'
+    else:
+        row.fail('link_down', '%d units not visited' % units)
+        row.result = 'down'
+    row.facts.update({'result' : row.result, 'units' : units,
+                      'down_for' : down_for})
+    return row
+
+class TsvSink(object):
+    """Tab-separated rows, under a line of column headings"""
+
+    def __init__(self, outfile=None):
+        if outfile is None:
+            outfile = sys.stdout
+        self.outfile = outfile
+        self.outfile.write('\t'.join(HEADINGS) + '\n')
+        self.outfile.flush()
+
+    def write(self, rows):
+        self.outfile.write(''.join([row.tsv() + '\n' for row in rows]))
+        self.outfile.flush()
+
+    def close(self):
+        pass
+
+class JsonLinesSink(object):
+    """One JSON object per row, in a file of its own"""
+
+    def __init__(self, path):
+        self.outfile = open(path, 'w')
+
+    def write(self, rows):
+        self.outfile.write(''.join([json.dumps(row.as_dict(),
+                                               sort_keys=True) + '\n'
+                                    for row in rows]))
+        self.outfile.flush()
+
+    def close(self):
+        self.outfile.close()
+
+class SummarySink(object):
+    """Counts of how the run went, and which hosts failed, written to a file
+    at the end (for nightly.sh to put at the top of its email)"""
+
+    def __init__(self, path, max_failed=MAX_FAILED):
+        self.path       = path
+        self.max_failed = max_failed
+        self.first      = None # when the first visit started
+        self.last       = None # when the last visit finished
+        self.results    = {} # visit result -> how many
+        self.failures   = {} # failure_kind -> how many
+        self.backoffs   = {} # failure code of resting hosts -> how many
+        self.reboots    = {} # RebootOutcome state -> how many
+        self.links      = {} # 'back' or 'down' -> links found down
+        self.stranded   = 0  # units not visited for a link down
+        self.pulled     = 0  # visits that pulled a config
+        self.unchanged  = 0  # visits that found the config unchanged
+        self.failed     = [] # rows of failed visits, the first max_failed
+        self.notes      = [] # lines the visitor adds (out of time, ...)
+
+    def write(self, rows):
+        for row in rows:
+            if row.kind == ReportRow.BACKOFF:
+                self.backoffs[row.result] = \
+                    self.backoffs.get(row.result, 0) + 1
+            elif row.kind == ReportRow.REBOOT:
+                self.reboots[row.result] = self.reboots.get(row.result, 0) + 1
+            elif row.kind == ReportRow.LINK:
+                self.links[row.result] = self.links.get(row.result, 0) + 1
+                if row.result == 'down':
+                    self.stranded += row.facts['units']
+            else:
+                self.visit(row)
+
+    def visit(self, row):
+        started = row.facts.get('started')
+        if started is not None:
+            self.first = min(self.first or started, started)
+            self.last = max(self.last, started + (row.facts['duration'] or 0))
+        self.results[row.result] = self.results.get(row.result, 0) + 1
+        backup = row.facts.get('backup')
+        if backup and unchanged(backup):
+            self.unchanged += 1
+        elif backup:
+            self.pulled += 1
+        error = row.facts.get('error')
+        if row.result == FAILED:
+            if error is not None:
+                kind = failure_kind((error['name'], error['message']))
+                self.failures[kind] = self.failures.get(kind, 0) + 1
+            if len(self.failed) < self.max_failed:
+                self.failed.append(row)
+
+    def lines(self):
+        """The summary, as lines of text"""
+        visits = sum(self.results.values())
+        lines = ['%d units visited: %s' %
+                 (visits, counts(self.results) or 'none')]
+        if self.first is not None:
+            lines[0] += ' (in %s)' % \
+                crawler_util.rough_timespan(self.last - self.first)
+        lines.append('Configs pulled %d, unchanged %d' %
+                     (self.pulled, self.unchanged))
+        if self.failures:
+            lines.append('Failures: %s' % counts(self.failures))
+        if self.backoffs:
+            lines.append('Resting: %s' % counts(self.backoffs))
+        if self.reboots:
+            lines.append('Reboots: %s' % counts(self.reboots))
+        if self.links:
+            lines.append('Links found down: %s (%d units not visited)' %
+                         (counts(self.links), self.stranded))
+        lines.extend(self.notes)
+        if self.failed:
+            lines.append('')
+            lines.append('Failed:')
+            lines.extend(['  ' + row.tsv().replace('\t', ' ')
+                          for row in self.failed])
+            failed = sum(self.failures.values())
+            if failed > len(self.failed):
+                lines.append('  and %d more' % (failed - len(self.failed)))
+        return lines
+
+    def close(self):
+        crawler_util.write_atomically(self.path, '\n'.join(self.lines()) + '\n')
+
+def unchanged(backup):
+    """True if what backup() said was that nothing needed pulling"""
+    return all([part.endswith(' unchanged') for part in backup.split('+')])
+
+def counts(numbers):
+    """'3 ok, 1 failed' from {'ok' : 3, 'failed' : 1}"""
+    return ', '.join(['%d %s' % (number, name)
+                      for (name, number) in sorted(numbers.items())
+                      if number])
+
+class ReportWriter(object):
+    """Takes finished rows from any thread; writes them to every sink in
+    batches"""
+
+    def __init__(self, sinks, batch_rows=BATCH_ROWS, batch_wait=BATCH_WAIT):
+        self.sinks      = sinks
+        self.batch_rows = batch_rows
+        self.batch_wait = batch_wait
+        self.pending    = []
+        self.held_since = None
+        self.lock       = threading.Lock()
+
+    def add(self, row):
+        """Take a finished row; write the batch out if it is due"""
+        with self.lock:
+            if not self.pending:
+                self.held_since = time.time()
+            self.pending.append(row)
+            if len(self.pending) >= self.batch_rows or \
+               time.time() - self.held_since >= self.batch_wait:
+                self._flush()
+
+    def flush(self):
+        """Write out every row held"""
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        rows = self.pending
+        self.pending = []
+        if not rows:
+            return
+        for sink in self.sinks:
+            try:
+                sink.write(rows)
+            except Exception, err:
+                # the other sinks still get the batch
+                sys.stderr.write('Report: %s lost %d rows: %s\n' %
+                                 (sink.__class__.__name__, len(rows), err))
+
+    def note(self, line):
+        """A line for the summary, if there is one"""
+        for sink in self.sinks:
+            if isinstance(sink, SummarySink):
+                sink.notes.append(line)
+
+    def close(self):
+        """Write out every row held, and finish each sink"""
+        with self.lock:
+            self._flush()
+            for sink in self.sinks:
+                try:
+                    sink.close()
+                except Exception, err:
+                    sys.stderr.write('Report: %s did not close: %s\n' %
+                                     (sink.__class__.__name__, err))
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        sys.exit('usage: %s report.jsonl' % sys.argv[0])
+
+    # rebuild the spreadsheet rows and the summary of a JSON Lines report
+    summary = SummarySink(None)
+    rows = read_rows(sys.argv[1])
+    summary.write(rows)
+    TsvSink().write(rows)
+    print ''
+    for line in summary.lines():
+        print line
@@ -0,0 +1,600 @@
+#!/usr/bin/env python
+
+# session_replay.py
+
+"""Records what the drivers say to a host, and plays it back without one.
+
+Everything a driver runs to reach its host goes through three HostControl
+methods: _spawn (ssh, scp and sftp under pexpect), _popen (ssh with piped
+output) and _call (ssh -O and ping, for their exit status).  Attach a
+SessionRecording to a unit and each of those runs is written to a transcript
+file as it happens: the command line, every chunk of output and everything
+sent, each with its time since the start of the run, and the exit status.
+Passwords are blanked out.  Files pulled by scp or sftp are written into the
+transcript too, once the run is over.
+
+Attach a SessionReplay instead and the unit gets the recorded runs back, in
+order, with no host there: a pexpect child reading from a socketpair that a
+thread feeds the recorded output into, holding back each reply until the
+driver has sent its line, and writing the pulled files where the driver
+asked for them.  Words of the command line that differ from the recording
+(such as the random marker of the Ubiquiti one-shot) are changed to match
+in the output.  The replay keeps the original timing, or goes
+some number of times faster, or (speed 0) as fast as it can.  If the driver
+runs a different program than the recording did, or sends a different
+command, the replay stops there and says what differed.
+
+The RouterOS API is not recorded, so a Mikrotik router is recorded and
+replayed over SSH.  A replay starts from an empty backup store, so record a
+first visit to a host (one that pulls its configs) to replay a backup.
+
+  session_replay.py replay [--speed N] [--reboot] transcript ...
+  session_replay.py bench [--repeat N] transcript ...
+
+replays visits (query and backup, as host_visitor.py does them), or times
+them at full speed, by make, to catch a slower parser or expect loop.
+Transcripts are recorded by host_visitor.py --record; session_corpus/ holds
+a few for benchmarking.
+"""
+
+from __future__ import with_statement
+import os
+import re
+import sys
+import time
+import errno
+import shutil
+import socket
+import difflib
+import tempfile
+import threading
+import subprocess
+import pexpect
+try:
+    from pexpect import fdpexpect
+except ImportError:
+    import fdpexpect
+from cStringIO import StringIO
+import crawler_conf
+import crawler_util
+from optparse import OptionParser
+from host_control import HostControlError
+from h3c_control import H3CSwitch
+from mikrotik_control import MikrotikRouter
+from ubiquiti_control import UbiquitiRadio
+
+SUFFIX  = '.session'
+SECRET  = '********' # stands in for a password in a transcript
+CONTROL = re.compile(r'ControlPath=\S+') # temporary, so not worth keeping
+WORDS   = re.compile(r'([^\w@.-]+)')      # splits a command line into words
+OPTION  = re.compile(r'-o \S+')          # an ssh option, such as a timeout
+
+# transcript lines: tab-separated, the first field saying what the line is
+HEADER = 'H' # make, hostname, IP address, when recorded
+BEGIN  = 'B' # kind of run (spawn, popen or call), command line
+READ   = 'R' # seconds into the run, output (string-escaped)
+ERROR  = 'X' # seconds into the run, error output of a popen
+SENT   = 'S' # seconds into the run, what was sent
+FILE   = 'F' # seconds into the run, the contents of a file pulled
+END    = 'E' # seconds into the run, exit status (None if never closed)
+
+DRIVERS = {crawler_util.HOST_MAKE_UBIQUITI : UbiquitiRadio,
+           crawler_util.HOST_MAKE_MIKROTIK : MikrotikRouter,
+           crawler_util.HOST_MAKE_H3C      : H3CSwitch}
+
+class ReplayError(Exception):
+    """The driver did something the recording did not"""
+
+def escape(data):
+    return data.encode('string_escape')
+
+def unescape(text):
+    return text.decode('string_escape')
+
+def pulled_files(command, sent):
+    """Where an scp or sftp run put the files it pulled, going by its
+    command line and (for sftp) the lines sent to it"""
+    words = command.split()
+    if words[0] == 'scp':
+        return [words[-1]]
+    elif words[0] != 'sftp':
+        return []
+    local_dir = os.getcwd()
+    paths = []
+    for line in sent.split('\n'):
+        words = line.split()
+        if words[:1] == ['lcd'] and len(words) == 2:
+            local_dir = os.path.join(local_dir, words[1])
+        elif words[:1] == ['get'] and len(words) in (2, 3):
+            paths.append(os.path.join(local_dir,
+                                      (words + [os.path.basename(
+                                                    words[1])])[2]))
+    return paths
+
+def word_changes(recorded, actual):
+    """[(recorded word, actual word)] where two command lines differ word
+    for word"""
+    old = WORDS.split(OPTION.sub('', recorded))
+    new = WORDS.split(OPTION.sub('', actual))
+    changes = []
+    for (tag, i1, i2, j1, j2) in \
+            difflib.SequenceMatcher(None, old, new).get_opcodes():
+        if tag == 'replace' and i2 - i1 == j2 - j1:
+            changes.extend([pair for pair in zip(old[i1:i2], new[j1:j2])
+                            if pair[0].strip() and pair[1].strip()])
+    return changes
+
+def attach(unit, sessions):
+    """Have the unit's runs recorded or replayed by sessions"""
+    unit.sessions = sessions
+    if hasattr(unit, 'api_refused'):
+        unit.api_refused = True # the API is not recorded: use SSH
+
+##### RECORDING #####
+
+class EventLog(object):
+    """A file-like object pexpect can log to, writing transcript events"""
+
+    def __init__(self, recording, code, started):
+        self.recording = recording
+        self.code      = code
+        self.started   = started
+        self.data      = [] # everything written
+
+    def write(self, data):
+        self.data.append(data)
+        self.recording.event(self.code, self.started, data)
+
+    def flush(self):
+        pass
+
+class TeeReader(object):
+    """A pipe from a process, whose reads are logged as they happen"""
+
+    def __init__(self, infile, log):
+        self.infile = infile
+        self.log    = log
+
+    def read(self, size=-1):
+        data = self.infile.read(size)
+        if data:
+            self.log.write(data)
+        return data
+
+class RecordedChild(pexpect.spawn):
+    """pexpect.spawn, with its conversation written to the transcript"""
+
+    def __init__(self, recording, command, timeout):
+        pexpect.spawn.__init__(self, command, timeout=timeout)
+        self.recording = recording
+        self.started = recording.begin('spawn', command)
+        self.logfile_read = EventLog(recording, READ, self.started)
+        self.logfile_send = EventLog(recording, SENT, self.started)
+        self.ended = False
+
+    def close(self, force=True):
+        pexpect.spawn.close(self, force)
+        if not self.ended:
+            self.ended = True
+            for path in pulled_files(self.recording.command,
+                                     ''.join(self.logfile_send.data)):
+                if os.path.isfile(path):
+                    with open(path, 'rb') as infile:
+                        self.recording.event(FILE, self.started,
+                                             infile.read())
+            self.recording.end(self.started, self.exitstatus)
+
+class RecordedProcess(object):
+    """subprocess.Popen, with its output written to the transcript"""
+
+    def __init__(self, recording, argv):
+        self.recording = recording
+        self.started = recording.begin('popen', ' '.join(argv))
+        self.process = subprocess.Popen(argv, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+        self.stdout = TeeReader(self.process.stdout,
+                                EventLog(recording, READ, self.started))
+        self.stderr = TeeReader(self.process.stderr,
+                                EventLog(recording, ERROR, self.started))
+
+    @property
+    def returncode(self):
+        return self.process.returncode
+
+    def kill(self):
+        self.process.kill()
+
+    def communicate(self):
+        (stdout, stderr) = self.process.communicate()
+        self.stdout.log.write(stdout)
+        self.stderr.log.write(stderr)
+        self.recording.end(self.started, self.process.returncode)
+        return (stdout, stderr)
+
+    def wait(self):
+        status = self.process.wait()
+        self.recording.end(self.started, status)
+        return status
+
+class SessionRecording(object):
+    """Writes every run of one unit to one transcript file.  The runs of a
+    unit come one after another, so their events do not interleave (though
+    a run's output and errors may be read from two threads at once)."""
+
+    def __init__(self, path, unit):
+        self.path    = path
+        self.unit    = unit
+        self.secrets = [secret for secret in (unit.pwd,) if secret]
+        self.outfile = None
+        self.command = None # of the run being written
+        self.lock    = threading.RLock()
+
+    def _write(self, *fields):
+        with self.lock:
+            if self.outfile is None:
+                self.outfile = open(self.path, 'w')
+                self._write(HEADER, self.unit.host_make, self.unit.hostname,
+                            str(self.unit.ipaddress), '%.6f' % time.time())
+            self.outfile.write('\t'.join(fields) + '\n')
+
+    def begin(self, kind, command):
+        """Start writing a run; returns when it started"""
+        self.command = command
+        self._write(BEGIN, kind, escape(CONTROL.sub('ControlPath=CONTROL',
+                                                    command)))
+        return time.time()
+
+    def event(self, code, started, data):
+        if code == SENT:
+            for secret in self.secrets:
+                data = data.replace(secret, SECRET)
+        self._write(code, '%.6f' % (time.time() - started), escape(data))
+
+    def end(self, started, status):
+        self._write(END, '%.6f' % (time.time() - started), str(status))
+
+    def spawn(self, command, timeout):
+        return RecordedChild(self, command, timeout)
+
+    def popen(self, argv):
+        return RecordedProcess(self, argv)
+
+    def call(self, argv):
+        started = self.begin('call', ' '.join(argv))
+        status = subprocess.call(argv, stdout=open('/dev/null', 'w'),
+                                 stderr=subprocess.STDOUT)
+        self.end(started, status)
+        return status
+
+    def close(self):
+        if self.outfile is not None:
+            self.outfile.close()
+            self.outfile = None
+
+class SessionRecorder(object):
+    """Gives each unit visited a transcript file under a directory, as
+    <directory>/<make>/<hostname>_<when>.session"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def attach(self, unit):
+        make_dir = os.path.join(self.directory, unit.host_make)
+        try:
+            os.makedirs(make_dir)
+        except OSError, err:
+            # fine if it exists already (maybe another worker just made it)
+            if err.errno != errno.EEXIST:
+                raise
+        path = os.path.join(make_dir, '%s_%s%s' %
+                                (unit.hostname,
+                                 time.strftime('%Y%m%d-%H%M%S'), SUFFIX))
+        attach(unit, SessionRecording(path, unit))
+
+##### REPLAY #####
+
+class Run(object):
+    """One recorded run: its kind, command line, events and exit status"""
+    __slots__ = ('kind', 'command', 'events', 'status', 'duration')
+
+    def __init__(self, kind, command):
+        self.kind     = kind
+        self.command  = command
+        self.events   = [] # (code, seconds into the run, data)
+        self.status   = None
+        self.duration = 0.0
+
+    def program(self):
+        return self.command.split()[0]
+
+    def output(self, code=READ):
+        return ''.join([data for (event, offset, data) in self.events
+                        if event == code])
+
+def read_transcript(path):
+    """((make, hostname, IP address), [Run]) of a transcript file"""
+    header = None
+    runs = []
+    with open(path) as infile:
+        for line in infile:
+            fields = line.rstrip('\n').split('\t')
+            if fields[0] == HEADER:
+                header = tuple(fields[1:4])
+            elif fields[0] == BEGIN:
+                runs.append(Run(fields[1], unescape(fields[2])))
+            elif fields[0] in (READ, ERROR, SENT, FILE):
+                runs[-1].events.append((fields[0], float(fields[1]),
+                                        unescape(fields[2])))
+            elif fields[0] == END:
+                runs[-1].duration = float(fields[1])
+                if fields[2] != 'None':
+                    runs[-1].status = int(fields[2])
+    if header is None:
+        raise ReplayError('%s is not a session transcript' % path)
+    return (header, runs)
+
+def first_words(lines):
+    return [(line.split() or [''])[0] for line in lines]
+
+class ReplayChild(fdpexpect.fdspawn):
+    """A pexpect child that a recorded run is played into"""
+
+    def __init__(self, replay, run, command, timeout):
+        (ours, theirs) = socket.socketpair()
+        fdpexpect.fdspawn.__init__(self, os.dup(ours.fileno()),
+                                   timeout=timeout)
+        ours.close()
+        self.run = run
+        self.command = command
+        self.sent = [] # what the driver sent, as the feeder got it
+        self.feeder = threading.Thread(target=replay.feed,
+                                       args=(theirs, run,
+                                             word_changes(run.command,
+                                                          command),
+                                             self.sent))
+        self.feeder.setDaemon(True)
+        self.feeder.start()
+
+    def close(self, force=True):
+        if self.child_fd != -1:
+            fdpexpect.fdspawn.close(self)
+            self.feeder.join()
+            # put the pulled files where this driver asked for them
+            contents = [data for (code, offset, data) in self.run.events
+                        if code == FILE]
+            for (path, data) in zip(pulled_files(self.command,
+                                                 ''.join(self.sent)),
+                                    contents):
+                with open(path, 'wb') as outfile:
+                    outfile.write(data)
+        self.exitstatus = self.run.status
+
+class ReplayProcess(object):
+    """A subprocess.Popen that gives back a recorded run"""
+
+    def __init__(self, replay, run, command):
+        self.replay = replay
+        self.run    = run
+        stdout = run.output(READ)
+        for (recorded, actual) in word_changes(run.command, command):
+            stdout = stdout.replace(recorded, actual)
+        self.stdout = StringIO(stdout)
+        self.stderr = StringIO(run.output(ERROR))
+        self.returncode = None
+
+    def kill(self):
+        pass
+
+    def wait(self):
+        if self.returncode is None:
+            self.replay.sleep(self.run.duration)
+            self.returncode = self.run.status
+        return self.returncode
+
+    def communicate(self):
+        self.wait()
+        return (self.stdout.read(), self.stderr.read())
+
+class SessionReplay(object):
+    """Hands one transcript's runs back to a unit, in order"""
+
+    def __init__(self, path, speed=1.0):
+        """speed: 1 for the original timing, 10 for ten times as fast, 0
+        for no waiting at all"""
+        (self.header, self.runs) = read_transcript(path)
+        self.path       = path
+        self.speed      = speed
+        self.position   = 0
+        self.divergence = None # what the driver did differently, if any
+
+    def sleep(self, seconds):
+        if self.speed and seconds > 0:
+            time.sleep(seconds / self.speed)
+
+    def peek(self):
+        """The next recorded run, or None"""
+        if self.position < len(self.runs):
+            return self.runs[self.position]
+        return None
+
+    def _next(self, kind, command):
+        run = self.peek()
+        if run is None:
+            self.divergence = 'ran %s after the recording ended' % command
+        elif run.kind != kind or \
+             run.program() != command.split()[0]:
+            self.divergence = 'ran %s %s where the recording ran %s %s' % \
+                                  (kind, command, run.kind, run.command)
+        if self.divergence is not None:
+            raise ReplayError(self.divergence)
+        self.position += 1
+        return run
+
+    def spawn(self, command, timeout):
+        return ReplayChild(self, self._next('spawn', command), command,
+                           timeout)
+
+    def popen(self, argv):
+        command = ' '.join(argv)
+        return ReplayProcess(self, self._next('popen', command), command)
+
+    def call(self, argv):
+        run = self._next('call', ' '.join(argv))
+        self.sleep(run.duration)
+        return run.status
+
+    def close(self):
+        pass
+
+    def feed(self, sock, run, changes, sent):
+        """Play a run's output into sock: each reply as long after what went
+        before as it came in the recording, and not until the driver has
+        sent as many lines as had been sent by then.  changes are words to
+        change in the output; what the driver sends is kept in sent."""
+        last = 0.0
+        recorded = '' # sent in the recording, not yet compared
+        received = '' # sent by the driver, not yet compared
+        try:
+            for (code, offset, data) in run.events:
+                if code == READ:
+                    self.sleep(offset - last)
+                    for (recorded, actual) in changes:
+                        data = data.replace(recorded, actual)
+                    sock.sendall(data)
+                elif code == SENT:
+                    recorded += data
+                    while received.count('\n') < recorded.count('\n'):
+                        chunk = sock.recv(4096)
+                        if not chunk:
+                            return
+                        sent.append(chunk)
+                        received += chunk
+                    lines = recorded.count('\n')
+                    if lines and not self._same(recorded, received, lines):
+                        return
+                    recorded = recorded.split('\n', lines)[-1]
+                    received = received.split('\n', lines)[-1]
+                last = offset
+            self.sleep(run.duration - last)
+        except socket.error:
+            pass # the driver has hung up
+        finally:
+            sock.close()
+
+    def _same(self, recorded, received, lines):
+        """Compare the commands in the first lines sent (not their
+        arguments, which name temporary files); note any difference"""
+        expected = recorded.split('\n')[:lines]
+        actual = received.split('\n')[:lines]
+        for (want, got, line) in zip(first_words(expected),
+                                     first_words(actual), expected):
+            if SECRET not in line and want != got:
+                self.divergence = 'sent %r where the recording sent %r' % \
+                                      (got, want)
+                return False
+        return True
+
+class Untracked(object):
+    """Stands in for a RebootTracker: a replay ends at sending the reboot"""
+
+    def track(self, unit, wait):
+        pass
+
+def replay_visit(path, speed=1.0, reboot=False):
+    """Replay a recorded visit as host_visitor.py makes it: query the host,
+    back it up into a scratch directory, and maybe send a reboot.  Returns
+    (what came of it, as lines, seconds taken)."""
+    replay = SessionReplay(path, speed)
+    (make, hostname, ip) = replay.header
+    unit = DRIVERS[make](hostname, ip, crawler_conf.NODE_PASSWORD)
+    attach(unit, replay)
+    backup_root = tempfile.mkdtemp(prefix='crawler-replay-')
+    lines = []
+    started = time.time()
+    try:
+        try:
+            run = replay.peek()
+            if run is not None and run.program() == 'ping':
+                unit.is_pingable()
+            unit.open_session()
+            lines.append('version %s' % unit.get_version())
+            lines.append('uptime %s' % crawler_util.rough_timespan(
+                                           unit.get_uptime()))
+            lines.append('hardware %s' % unit.get_hardware())
+            lines.append('backup %s' % unit.backup(backup_root))
+            # more than closing the session left: the reboot was recorded
+            if reboot and len(replay.runs) - replay.position > 1:
+                unit.reboot(False, Untracked())
+                lines.append('reboot sent')
+        except (HostControlError, ReplayError, pexpect.ExceptionPexpect), err:
+            lines.append('FAIL:%s:%s' % (err.__class__.__name__,
+                                         str(err).split('\n')[0]))
+            if replay.divergence is not None:
+                lines.append('diverged: %s' % replay.divergence)
+    finally:
+        try:
+            unit.close_session()
+        except ReplayError:
+            pass # diverged already, and said so
+        shutil.rmtree(backup_root, True)
+    return (lines, time.time() - started)
+
+def bench(paths, repeat):
+    """Replay each transcript repeat times at full speed; print the
+    median and fastest per transcript, and the median per make"""
+    by_make = {}
+    for path in paths:
+        times = []
+        for i in range(repeat):
+            (lines, seconds) = replay_visit(path, 0)
+            times.append(seconds)
+        failed = [line for line in lines if line.startswith('FAIL')]
+        make = read_transcript(path)[0][0]
+        by_make.setdefault(make, []).extend(times)
+        print '%-50s median %7.2f  min %7.2f ms%s' % \
+              (os.path.basename(path)[:50],
+               crawler_util.percentile(times, 0.5) * 1000,
+               min(times) * 1000, failed and '  ' + failed[0] or '')
+    for (make, times) in sorted(by_make.items()):
+        print '%-50s median %7.2f ms over %d replays' % \
+              (make, crawler_util.percentile(times, 0.5) * 1000, len(times))
+
+def transcripts(args):
+    """The transcript files named, or under the directories named"""
+    paths = []
+    for arg in args:
+        if os.path.isdir(arg):
+            for (dirpath, dirnames, filenames) in os.walk(arg):
+                paths.extend([os.path.join(dirpath, filename)
+                              for filename in sorted(filenames)
+                              if filename.endswith(SUFFIX)])
+        else:
+            paths.append(arg)
+    return paths
+
+if __name__ == '__main__':
+
+    parser = OptionParser(usage='usage: %prog replay|bench [options] '
+                                'transcript|directory ...')
+    parser.add_option('-s', '--speed', type='float', default=1.0,
+                      help='times as fast as recorded, 0 for no waits '
+                           '[default: %default]')
+    parser.add_option('-r', '--reboot', action='store_true', default=False,
+                      help='replay the reboot too, if it was recorded')
+    parser.add_option('-n', '--repeat', type='int', default=20,
+                      help='replays of each transcript to time '
+                           '[default: %default]')
+    (options, args) = parser.parse_args()
+    if len(args) < 2 or args[0] not in ('replay', 'bench'):
+        parser.error('need replay or bench, and transcripts')
+    paths = transcripts(args[1:])
+
+    if args[0] == 'bench':
+        bench(paths, options.repeat)
+    else:
+        for path in paths:
+            (lines, seconds) = replay_visit(path, options.speed,
+                                            options.reboot)
+            print '%s (%.2f seconds)' % (path, seconds)
+            for line in lines:
+                print '   ', line
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+# shard_merge.py
+
+"""Puts together what the crawler nodes of a sharded crawl found.
+
+Each node (host_visitor.py --shard i/N) keeps its own report, history
+database and backup tree.  This merges them into one view of the fleet:
+
+  shard_merge.py report merged.jsonl node.jsonl ...
+      --json-report files into one, and prints it as the spreadsheet report
+      and its summary (or writes the summary to --summary FILE)
+
+  shard_merge.py history merged.db node.db ...
+      --history databases into one; visits already in it are not doubled
+
+  shard_merge.py backups merged_root node_root ...
+      backup trees into one: each host's manifests, the content they list,
+      and the usual <make>/<file> paths, pointing at the latest
+
+Merging again later (say, each morning) only adds what is new.
+"""
+
+import os
+import sys
+import run_report
+from optparse import OptionParser
+from backup_store import BackupStore
+from visit_history import VisitHistory
+
+def merge_reports(merged_file, report_files, summary_file=None):
+    """Rows of every node's report, in one JSON Lines file and on stdout"""
+    rows = []
+    for report_file in report_files:
+        rows.extend(run_report.read_rows(report_file))
+    writer = run_report.ReportWriter([run_report.TsvSink(),
+                                      run_report.JsonLinesSink(merged_file)])
+    summary = run_report.SummarySink(summary_file)
+    if summary_file is not None:
+        writer.sinks.append(summary)
+    for row in rows:
+        writer.add(row)
+    writer.close()
+    if summary_file is None:
+        summary.write(rows)
+        print ''
+        for line in summary.lines():
+            print line
+
+def merge_histories(merged_db, db_files):
+    """Every node's visits and reboots, in one history database"""
+    history = VisitHistory(merged_db)
+    try:
+        for db_file in db_files:
+            (visits, reboots) = history.take_in(os.path.abspath(db_file))
+            print '%s: %d visits, %d reboots' % (db_file, visits, reboots)
+    finally:
+        history.close()
+
+def merge_backups(merged_root, node_roots):
+    """Every node's backups, in one backup tree"""
+    merged = BackupStore(merged_root)
+    nodes = [BackupStore(node_root) for node_root in node_roots]
+    nights = sorted(set([night for node in nodes
+                         for night in node.nights()]))
+    for night in nights:
+        hosts = files = 0
+        for node in nodes:
+            for hostname in node.hostnames(night):
+                files += merged.take_in(node, hostname, night)
+                hosts += 1
+        print '%s: %d hosts, %d files' % (night, hosts, files)
+
+if __name__ == '__main__':
+
+    parser = OptionParser(usage='usage: %prog report merged.jsonl node.jsonl '
+                                '...\n'
+                                '       %prog history merged.db node.db ...\n'
+                                '       %prog backups merged_root node_root '
+                                '...')
+    parser.add_option('-S', '--summary', metavar='FILE',
+                      help='write the merged report\'s summary here, '
+                           'rather than print it')
+    (options, args) = parser.parse_args()
+    if len(args) < 3 or args[0] not in ('report', 'history', 'backups'):
+        parser.error('need report, history or backups, where to merge to, '
+                     'and what to merge')
+    (what, merged, parts) = (args[0], args[1], args[2:])
+
+    if what == 'report':
+        merge_reports(merged, parts, options.summary)
+    elif what == 'history':
+        merge_histories(merged, parts)
+    else:
+        merge_backups(merged, parts)
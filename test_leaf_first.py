@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+# test_leaf_first.py
+
+"""A router with one host behind it is visited after that host, however
+needy the router is and in whatever order its job comes.
+
+Run with: python -m unittest test_leaf_first
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import host_walker
+import host_visitor
+import crawler_util
+import crawl_benchmark
+from network_topology import Topology
+from visit_scheduler import VisitScheduler
+
+ROUTER = '127.1.0.1'
+CHILD  = '127.1.0.2'
+
+class LeafFirstTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        fleet = {ROUTER : {'make' : crawler_util.HOST_MAKE_MIKROTIK,
+                           'hostname' : 'router'},
+                 CHILD  : {'make' : crawler_util.HOST_MAKE_UBIQUITI,
+                           'hostname' : 'child'}}
+        xml_files = []
+        for make in (crawler_util.HOST_MAKE_MIKROTIK,
+                     crawler_util.HOST_MAKE_UBIQUITI):
+            xml_file = os.path.join(self.work_dir, '%s.xml' % make)
+            crawl_benchmark.write_inventory(xml_file, make, fleet)
+            xml_files.append(xml_file)
+
+        # the crawler is elsewhere; the child is on the router's network
+        self.topology = Topology()
+        self.topology.local_ip = crawler_util.ip_to_int('10.0.0.1')
+        self.topology.learn(ROUTER, {'addresses' : [ROUTER + '/24'],
+                                     'routes' : [], 'neighbors' : []})
+        self.walker = host_walker.HostWalker(xml_files,
+                                             topology=self.topology)
+        self.router = self.walker.unique_hosts[crawler_util.ip_to_int(ROUTER)]
+        self.child = self.walker.unique_hosts[crawler_util.ip_to_int(CHILD)]
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_topology(self):
+        self.assertEqual(self.topology.ancestors(self.child.ip),
+                         [self.router.ip])
+        self.assertEqual(list(self.walker), [self.child, self.router])
+
+    def test_scheduler_holds_needy_router(self):
+        scheduler = VisitScheduler(self.walker,
+                                   os.path.join(self.work_dir, 'state'),
+                                   self.topology)
+        # the child was backed up just now; the router never has been
+        scheduler.visited(self.child, True)
+        self.assertEqual(list(scheduler), [self.child, self.router])
+
+    def run_jobs(self, workers):
+        """The order run_jobs visits the router's job then the child's in"""
+        crawl = host_visitor.Crawl(self.work_dir,
+                                   host_visitor.RebootQuota(0), [])
+        crawl.gate = host_visitor.SubtreeGate(self.topology, self.walker)
+        visited = []
+        report_visit = host_visitor.report_visit
+        host_visitor.report_visit = \
+            lambda host, unit, crawl: visited.append(host)
+        try:
+            host_visitor.run_jobs(iter([(0, self.router, None),
+                                        (1, self.child, None)]),
+                                  crawl, host_visitor.ResumePoint(None),
+                                  workers)
+        finally:
+            host_visitor.report_visit = report_visit
+        return visited
+
+    def test_serial_run_holds_router(self):
+        self.assertEqual(self.run_jobs(1), [self.child, self.router])
+
+    def test_pool_run_holds_router(self):
+        self.assertEqual(self.run_jobs(2), [self.child, self.router])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+# timeout_policy.py
+
+"""How long to wait on a host before giving up on it.
+
+pexpect waits 30 seconds for anything, which is too long for a dead host on
+the LAN and may be too short for a live one three radio hops away.  Instead
+each host gets timeouts for logging in, for a command and for a file transfer
+that grow with its ping round trip time and with how long its visits have
+taken before (see visit_budget.CostEstimator).  On top of that, a watchdog
+caps the whole visit: once it runs out, every further wait is a timeout of
+zero, which HostControl turns into a Timeout error without waiting at all.
+The watchdog allows for as many logins, commands and transfers as a visit to
+the host's make does (HostControl.VISIT_STEPS).
+"""
+
+import sys
+import time
+
+# seconds: (least, most) for each kind of wait
+CONNECT_LIMITS  = (5, 60)
+COMMAND_LIMITS  = (15, 120)
+TRANSFER_LIMITS = (30, 600)
+VISIT_LIMITS    = (120, 30 * 60)
+
+# seconds, plus so many round trips, before the past is taken into account
+CONNECT_BASE,  CONNECT_RTTS  = 10, 40 # key exchange, auth: a dozen or so
+COMMAND_BASE,  COMMAND_RTTS  = 10, 20
+TRANSFER_BASE, TRANSFER_RTTS = 30, 200
+
+SLACK = 3 # allow this many times as long as the host took before
+
+UNKNOWN_RTT = 0.5 # seconds, to assume of a host not measured by ping sweep
+
+def clamp(seconds, limits):
+    (least, most) = limits
+    return max(least, min(most, seconds))
+
+class TimeoutPolicy(object):
+    """Timeouts, in seconds, for one visit to one host"""
+
+    def __init__(self, rtt=None, query_cost=None, backup_cost=None,
+                 steps=(1, 1, 1)):
+        """rtt is the ping round trip time, query_cost and backup_cost how
+        long those phases of a visit have taken; None if not known.  steps
+        is how many (logins, commands, transfers) a visit takes at most."""
+        if rtt is None:
+            rtt = UNKNOWN_RTT
+        self.connect = clamp(CONNECT_BASE + CONNECT_RTTS * rtt,
+                             CONNECT_LIMITS)
+        command = COMMAND_BASE + COMMAND_RTTS * rtt
+        if query_cost is not None:
+            command = max(command, SLACK * query_cost)
+        self.command = clamp(command, COMMAND_LIMITS)
+        transfer = TRANSFER_BASE + TRANSFER_RTTS * rtt
+        if backup_cost is not None:
+            transfer = max(transfer, SLACK * backup_cost)
+        self.transfer = clamp(transfer, TRANSFER_LIMITS)
+        (connects, commands, transfers) = steps
+        self.visit = clamp(connects * self.connect +
+                           commands * self.command +
+                           transfers * self.transfer, VISIT_LIMITS)
+        self.watchdog = None # when the visit must be over
+
+    def start(self):
+        """Set the watchdog going for a visit starting now"""
+        self.watchdog = time.time() + self.visit
+
+    def remaining(self):
+        """Seconds until the watchdog goes off; None if it is not set"""
+        if self.watchdog is None:
+            return None
+        return self.watchdog - time.time()
+
+    def _capped(self, seconds):
+        """The timeout, cut short by the watchdog if need be (0 once the
+        watchdog has gone off)"""
+        remaining = self.remaining()
+        if remaining is None:
+            return seconds
+        return max(0, min(seconds, remaining))
+
+    def for_connect(self):
+        """Timeout for logging in"""
+        return self._capped(self.connect)
+
+    def for_command(self):
+        """Timeout for a command's output or a prompt"""
+        return self._capped(self.command)
+
+    def for_transfer(self):
+        """Timeout for pulling a file, or writing one on the host"""
+        return self._capped(self.transfer)
+
+    def __str__(self):
+        return 'connect %d, command %d, transfer %d, visit %d seconds' % \
+                    (self.connect, self.command, self.transfer, self.visit)
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        sys.exit('usage: %s rtt_seconds [query_seconds [backup_seconds]]' %
+                 sys.argv[0])
+
+    costs = [float(arg) for arg in sys.argv[1:4]]
+    costs += [None] * (3 - len(costs))
+    from ubiquiti_control import UbiquitiRadio
+    from h3c_control import H3CSwitch
+    from mikrotik_control import MikrotikRouter
+    for make in (UbiquitiRadio, H3CSwitch, MikrotikRouter):
+        print '%s: %s' % (make.__name__,
+                          TimeoutPolicy(*costs + [make.VISIT_STEPS]))
@@ -7,15 +7,86 @@
 Written by jwiggins@inveneo.org 2011-2012
 """
 
+import os
+import re
 import sys
+import random
 import ipaddr
 import crawler_conf
 import crawler_util
 from host_control import HostControl, HostControlError
 
+CONFIG_DIR  = '/tmp'
+CONFIG_FILE = 'system.cfg'
+
+# one remote command for a whole visit: each section is announced by a line
+# of its own, "<marker> <name>", with a newline in front so that a section
+# need not end in one; the config is only sent if its md5sum isn't known
+# (known fingerprints are all md5sums, so an md5sum that failed matches none)
+ONE_SHOT = """m=%(marker)s
+printf '\\n%%s version\\n' $m; cat /etc/version
+printf '\\n%%s board\\n' $m; cat /etc/board.inc
+printf '\\n%%s uptime\\n' $m; cat /proc/uptime
+s=`md5sum %(config)s`; s=${s%%%% *}
+printf '\\n%%s md5\\n%%s' $m $s
+case "$s" in %(known)s) ;;
+*) printf '\\n%%s config\\n' $m; cat %(config)s;; esac
+printf '\\n%%s end\\n' $m"""
+
+# what md5sum prints for a file; anything else (an error) is no fingerprint
+MD5SUM = re.compile('^[0-9a-f]{32}$')
+
+def parse_md5sum(text):
+    """The checksum md5sum printed first in text, or None if it printed
+    something else (such as "sh: md5sum: not found")"""
+    words = text.split()
+    if not words or not MD5SUM.match(words[0]):
+        return None
+    return words[0]
+
+def parse_version(text):
+    """Firmware version out of /etc/version, e.g. 'XM.v5.5.4' -> '5.5.4'"""
+    try:
+        return text.strip().split('\n')[0].strip().split('v')[1]
+    except IndexError:
+        raise HostControlError(HostControlError.PARSE, 'version %s' % text)
+
+def parse_board(text):
+    """Board name out of /etc/board.inc ('$board_name="NanoStation M5";')"""
+    for line in text.split('\n'):
+        if '=' in line:
+            (key, val) = line.strip().split('=', 1)
+            if key == '$board_name':
+                return val.strip(';').strip('"')
+    raise HostControlError(HostControlError.PARSE, 'no board name')
+
+def parse_uptime(text):
+    """Seconds of uptime out of /proc/uptime"""
+    try:
+        return int(float(text.split()[0]))
+    except (IndexError, ValueError):
+        raise HostControlError(HostControlError.PARSE, 'uptime %s' % text)
+
+def parse_one_shot(output, marker):
+    """{section name: its text} out of what ONE_SHOT wrote"""
+    sections = {}
+    for part in output.split('\n%s ' % marker)[1:]:
+        (name, text) = (part.split('\n', 1) + [''])[:2]
+        sections[name] = text
+    if 'end' not in sections:
+        raise HostControlError(HostControlError.PARSE,
+                               'one-shot output cut short')
+    return sections
+
 class UbiquitiRadio(HostControl):
     """Controls a Ubiquiti radio"""
 
+    ONE_SHOT = True # False to ask for each thing with its own command
+
+    # the SSH login and scp's; version, board, uptime and md5sum, each with
+    # a command of its own without the one shot; the config
+    VISIT_STEPS = (2, 4, 1)
+
     def __init__(self, hostname, ipaddress, pwd,
                        max_uptime=crawler_util.SEVEN_DAYS):
         HostControl.__init__(self, hostname, ipaddress,
@@ -23,37 +94,109 @@ class UbiquitiRadio(HostControl):
         self.host_make  = crawler_util.HOST_MAKE_UBIQUITI
         self.version = None
         self.hardware = None
+        self.shot = None # sections of the one-shot output, once run
+
+    def _one_shot(self):
+        """Version, board, uptime, config md5sum and (unless we have it
+        already) the config itself, from one command on the open session.
+        Returns the sections, or None if there's no session to do it on
+        (or it died)."""
+        if self.shot is not None:
+            return self.shot
+        if not self.ONE_SHOT or not self._on_session():
+            return None
+        known = []
+        if self.store is not None:
+            # only what we could still link to, or we'd never be sent it
+            known = [fingerprint for (fingerprint, checksum)
+                     in self.store.fingerprints(self.hostname).values()
+                     if parse_md5sum(fingerprint) is not None and
+                        self.store.has(checksum)]
+        marker = '@@crawler-%08x' % random.getrandbits(32)
+        output = self._exec(ONE_SHOT % {'marker' : marker,
+                                        'config' : '%s/%s' % (CONFIG_DIR,
+                                                              CONFIG_FILE),
+                                        'known'  : '|'.join(known) or '-'})
+        if output is None:
+            return None # the session died: ask for each thing by logging in
+        shot = parse_one_shot(output, marker)
+        self.version  = parse_version(shot['version'])
+        self.hardware = parse_board(shot['board'])
+        shot['uptime'] = parse_uptime(shot['uptime'])
+        self.shot = shot
+        return self.shot
 
     def get_version(self):
-        if self.version == None:
-            result = self.ssh_command('cat /etc/version')
-            line = result[0].strip()
-            self.version = line.split('v')[1]
+        if self.version == None and self._one_shot() is None:
+            version = self.ssh_command('cat /etc/version')
+            self.version = parse_version('\n'.join(version))
         return self.version
 
     def get_hardware(self):
-        if self.hardware == None:
-            result = self.ssh_command('cat /etc/board.inc')
-            line = result[2].strip()
-            (key, val) = line.split('=')
-            self.hardware = val.strip(';').strip('"')
+        if self.hardware == None and self._one_shot() is None:
+            board = self.ssh_command('cat /etc/board.inc')
+            self.hardware = parse_board('\n'.join(board))
         return self.hardware
 
     def get_uptime(self):
-        result = self.ssh_command('cat /proc/uptime')
-        seconds, idle = result[0].split()
-        return int(float(seconds))
+        shot = self._one_shot()
+        if shot is not None:
+            return shot['uptime']
+        return parse_uptime('\n'.join(self.ssh_command('cat /proc/uptime')))
+
+    def get_md5sum(self, path):
+        """Checksum of a file on the radio, or None if it can't be had"""
+        result = self.ssh_command('md5sum %s' % path)
+        if not result:
+            return None
+        return parse_md5sum(result[0])
+
+    def _backup_one_shot(self, shot, dst_dir, dst_file):
+        """Backs up the config from the one-shot output (or, if it wasn't
+        sent, what we have already with the same md5sum)"""
+        fingerprint = parse_md5sum(shot['md5'])
+        if 'config' not in shot:
+            if self._unchanged(fingerprint, dst_dir, dst_file):
+                return '%s unchanged' % CONFIG_FILE
+            # maybe under another name (the firmware has been upgraded)
+            for (known, checksum) in \
+                    self.store.fingerprints(self.hostname).values():
+                if known == fingerprint and \
+                   self.store.reuse(self.hostname,
+                                    os.path.join(dst_dir, dst_file),
+                                    checksum):
+                    self.backup_checksums.append(checksum)
+                    self._set_fingerprint(fingerprint, dst_dir, dst_file,
+                                          checksum)
+                    return '%s unchanged' % CONFIG_FILE
+            # its content went from the store since the command was sent:
+            # pull it the long way
+            checksum = self._safe_stream(CONFIG_DIR, CONFIG_FILE, dst_dir,
+                                         dst_file)
+            self._set_fingerprint(fingerprint, dst_dir, dst_file, checksum)
+            return CONFIG_FILE
+        checksum = self._safe_write_data(shot['config'], dst_dir, dst_file)
+        self._set_fingerprint(fingerprint, dst_dir, dst_file, checksum)
+        return CONFIG_FILE
 
     def backup(self, backup_root):
-        src_dir = '/tmp'
-        src_file = 'system.cfg'
+        src_dir = CONFIG_DIR
+        src_file = CONFIG_FILE
         dst_dir = HostControl.backup(self, backup_root)
         dst_file = '%s_%s.cfg' % (self.hostname, self.get_version())
-        self._safe_scp(src_dir, src_file, dst_dir, dst_file)
+        shot = self._one_shot()
+        if shot is not None:
+            return self._backup_one_shot(shot, dst_dir, dst_file)
+        fingerprint = self.get_md5sum('%s/%s' % (src_dir, src_file))
+        if self._unchanged(fingerprint, dst_dir, dst_file):
+            return '%s unchanged' % src_file
+        checksum = self._safe_stream(src_dir, src_file, dst_dir, dst_file)
+        self._set_fingerprint(fingerprint, dst_dir, dst_file, checksum)
         return src_file
 
-    def reboot(self, tick):
-        return HostControl.reboot(self, 'reboot', 10, tick)
+    def reboot(self, tick, tracker=None):
+        self.shot = None # uptime is stale after this
+        return HostControl.reboot(self, 'reboot', 10, tick, None, tracker)
 
 if __name__ == '__main__':
 
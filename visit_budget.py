@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+# visit_budget.py
+
+"""Knows how long visits take, and whether the next step still fits.
+
+The crawl must be done by a set time of night.  Rather than be cut off in the
+middle of a file transfer, or send a reboot it cannot see through, the visitor
+asks before each step of a visit whether that step is likely to finish before
+the end time (less a margin for writing out state).
+
+How long a step takes is estimated from the visit history: from the host's
+own last few visits if it has any, else from most visits to hosts of its make,
+else from a cautious default.
+"""
+
+from __future__ import with_statement
+import sys
+import time
+import crawler_conf
+import crawler_util
+from visit_history import VisitRecord
+
+DAY = 24 * 60 * 60
+
+HISTORY_WINDOW = 14 * DAY # how far back the history is consulted
+HOST_VISITS    = 5        # a host's own visits that are consulted
+PERCENTILE     = 0.9      # of visits to a make that take no longer
+
+# seconds per phase of a visit (and for a rebooted host to come back), when
+# the history has nothing to go on
+DEFAULT_COSTS = {'ping'     : 5,
+                 'query'    : 60,
+                 'backup'   : 120,
+                 'reboot'   : 60,
+                 'downtime' : 5 * 60}
+
+class CostEstimator(object):
+    """Estimates, in seconds, what each phase of a visit will cost"""
+
+    def __init__(self, history=None, now=None):
+        self.by_host = {} # IP as integer -> {phase: seconds}
+        self.by_make = {} # host make -> {phase: seconds}
+        if history is not None:
+            if now is None:
+                now = time.time()
+            self._load(history, now - HISTORY_WINDOW)
+
+    def _load(self, history, since):
+        phases = VisitRecord.PHASES
+        host_times = {} # IP -> {phase: [seconds, newest first]}
+        make_times = {} # make -> {phase: [seconds]}
+        for row in history.phase_times(since):
+            (ip, make) = row[:2]
+            self._note(host_times, make_times, ip, make,
+                       zip(phases, row[2:]))
+        for (ip, make, downtime) in history.reboot_downtimes(since):
+            self._note(host_times, make_times, ip, make,
+                       [('downtime', downtime)])
+
+        # a host's worst recent time, so one fast visit doesn't fool us
+        for (ip, times) in host_times.items():
+            self.by_host[ip] = dict([(phase, max(seconds[:HOST_VISITS]))
+                                     for (phase, seconds) in times.items()])
+        for (make, times) in make_times.items():
+            self.by_make[make] = dict([(phase, crawler_util.percentile(
+                                                   seconds, PERCENTILE))
+                                       for (phase, seconds) in times.items()])
+
+    def _note(self, host_times, make_times, ip, make, phase_seconds):
+        for (phase, seconds) in phase_seconds:
+            if seconds is None:
+                continue # visit never got that far
+            host_times.setdefault(ip, {}).setdefault(phase, []).append(seconds)
+            make_times.setdefault(make, {}).setdefault(phase,
+                                                       []).append(seconds)
+
+    def measured(self, host, phase):
+        """Seconds the phase ('ping', 'query', 'backup', 'reboot' or
+        'downtime') has taken for this host or its make; None if unknown"""
+        seconds = self.by_host.get(host.ip, {}).get(phase)
+        if seconds is None:
+            seconds = self.by_make.get(host.host_make, {}).get(phase)
+        return seconds
+
+    def cost(self, host, phase):
+        """Seconds the phase is likely to take for this host"""
+        seconds = self.measured(host, phase)
+        if seconds is None:
+            seconds = DEFAULT_COSTS[phase]
+        return seconds
+
+    def costs(self, host, phases):
+        """Seconds the phases together are likely to take for this host"""
+        return sum([self.cost(host, phase) for phase in phases])
+
+class Deadline(object):
+    """When the crawl must be done by; None for no end time"""
+
+    def __init__(self, end_time=None, margin=crawler_conf.DEADLINE_MARGIN):
+        self.end_time = end_time
+        self.margin   = margin
+
+    def remaining(self):
+        """Seconds left to start and finish work in; None if no end time"""
+        if self.end_time is None:
+            return None
+        return self.end_time - self.margin - time.time()
+
+    def allows(self, seconds):
+        """True if work expected to take this long can finish in time"""
+        remaining = self.remaining()
+        return remaining is None or seconds <= remaining
+
+    def passed(self):
+        """True if there is no time left at all"""
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 3:
+        sys.exit('usage: %s history_db opennms_file ...' % sys.argv[0])
+
+    import host_walker
+    from visit_history import VisitHistory
+    history = VisitHistory(sys.argv[1])
+    estimator = CostEstimator(history)
+    history.close()
+    phases = VisitRecord.PHASES + ('downtime',)
+    for host in host_walker.HostWalker(sys.argv[2:]):
+        print host, ' '.join(['%s %s' % (phase, crawler_util.rough_timespan(
+                                                 estimator.cost(host, phase)))
+                              for phase in phases])
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+# visit_history.py
+
+"""Keeps a record of every visit (and every reboot outcome) in SQLite.
+
+Records are queued up and written in batches, one transaction per batch, so
+the crawl does not wait on the disk for every host.  Call flush() now and then
+and close() at the end of the run to get the stragglers written.
+"""
+
+from __future__ import with_statement
+import sys
+import time
+import sqlite3
+import threading
+import crawler_util
+
+BATCH_SIZE = 50 # records queued before they are written out
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS visits (
+    ip          INTEGER NOT NULL, -- IPv4 address as 32-bit integer
+    make        TEXT,
+    hostname    TEXT,
+    started     REAL NOT NULL,    -- epoch seconds
+    duration    REAL,             -- seconds
+    pingable    INTEGER,          -- 1 if it answered ping
+    rtt         REAL,             -- ping round trip, seconds
+    version     TEXT,
+    hardware    TEXT,
+    uptime      INTEGER,          -- seconds
+    backup      TEXT,             -- what backup() said it pulled
+    backup_hash TEXT,             -- checksum(s) of the pulled file(s)
+    reboot      TEXT,             -- 'sent' if a reboot was sent
+    error_class TEXT,             -- exception name, or 'no_ping'
+    error       TEXT,
+    ping_sec    REAL,             -- time spent in each phase of the visit
+    query_sec   REAL,
+    backup_sec  REAL,
+    reboot_sec  REAL
+);
+CREATE INDEX IF NOT EXISTS visits_by_host ON visits (ip, started);
+CREATE INDEX IF NOT EXISTS visits_by_time ON visits (started);
+
+CREATE TABLE IF NOT EXISTS reboots (
+    ip          INTEGER NOT NULL,
+    hostname    TEXT,
+    sent_at     REAL NOT NULL,
+    state       TEXT,             -- see reboot_tracker.RebootOutcome
+    downtime    REAL              -- seconds until it answered ping again
+);
+CREATE INDEX IF NOT EXISTS reboots_by_host ON reboots (ip, sent_at);
+'''
+
+VISIT_COLUMNS = ('ip', 'make', 'hostname', 'started', 'duration',
+                 'pingable', 'rtt', 'version', 'hardware', 'uptime',
+                 'backup', 'backup_hash', 'reboot', 'error_class', 'error',
+                 'ping_sec', 'query_sec', 'backup_sec', 'reboot_sec')
+
+class VisitRecord(object):
+    """What happened on one visit to one host"""
+
+    PHASES = ('ping', 'query', 'backup', 'reboot')
+
+    def __init__(self, host):
+        self.host        = host
+        self.started     = time.time()
+        self.finished    = None
+        self.pingable    = None # True/False once pinged
+        self.rtt         = None # seconds, if the ping sweep measured it
+        self.version     = None
+        self.hardware    = None
+        self.uptime      = None # seconds, if the host told us
+        self.backup      = None # what backup() pulled, if it worked
+        self.backup_hash = None
+        self.reboot      = None # 'sent' if we sent a reboot
+        self.error       = None # (exception name, message) if visit failed
+        self.phases      = {}   # phase name -> seconds spent in it
+        self.operations  = []   # (kind, what, seconds) of each wait on it
+
+    def timed(self, phase, started):
+        """Note the time spent in a phase that began at started"""
+        self.phases[phase] = self.phases.get(phase, 0) + time.time() - started
+
+    def row(self):
+        """Values for VISIT_COLUMNS; text as unicode, which is all SQLite
+        takes"""
+        (error_class, error) = self.error or (None, None)
+        pingable = None
+        if self.pingable is not None:
+            pingable = int(self.pingable)
+        duration = None
+        if self.finished is not None:
+            duration = self.finished - self.started
+        return tuple([crawler_util.as_text(value) for value in
+                      (self.host.ip, self.host.host_make, self.host.hostname,
+                       self.started, duration, pingable, self.rtt,
+                       self.version, self.hardware, self.uptime,
+                       self.backup, self.backup_hash, self.reboot,
+                       error_class, error)]) + \
+               tuple([self.phases.get(phase) for phase in self.PHASES])
+
+class VisitHistory(object):
+    """The SQLite store of visit records; safe to share between threads"""
+
+    def __init__(self, db_file, batch_size=BATCH_SIZE):
+        self.db_file    = db_file
+        self.batch_size = batch_size
+        self.lock       = threading.Lock()
+        self.visits     = [] # rows waiting to be written
+        self.reboots    = []
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def add(self, record):
+        """Queue up a VisitRecord; writes out a batch once enough pile up"""
+        with self.lock:
+            self.visits.append(record.row())
+            if len(self.visits) >= self.batch_size:
+                self._flush()
+
+    def add_reboot(self, outcome):
+        """Queue up a reboot_tracker.RebootOutcome"""
+        unit = outcome.unit
+        with self.lock:
+            self.reboots.append((crawler_util.ip_to_int(unit.ipaddress),
+                                 crawler_util.as_text(unit.hostname),
+                                 outcome.sent_at, outcome.state,
+                                 outcome.downtime()))
+
+    def flush(self):
+        """Write out everything queued, in one transaction"""
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.visits and not self.reboots:
+            return
+        (visits, reboots) = (self.visits, self.reboots)
+        self.visits = []
+        self.reboots = []
+        try:
+            self.db.executemany('INSERT INTO visits (%s) VALUES (%s)' %
+                                    (', '.join(VISIT_COLUMNS),
+                                     ', '.join('?' * len(VISIT_COLUMNS))),
+                                visits)
+            self.db.executemany('INSERT INTO reboots VALUES (?, ?, ?, ?, ?)',
+                                reboots)
+            self.db.commit()
+        except sqlite3.Error, err:
+            # a batch that will not go in would fail every flush after it
+            self.db.rollback()
+            sys.stderr.write('History: dropped %d visits and %d reboots: '
+                             '%s\n' % (len(visits), len(reboots), err))
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.db.close()
+
+    def take_in(self, db_file):
+        """Copy in the visits and reboots of another history database
+        (another crawler node's) that this one does not have yet.
+        Returns (visits, reboots) copied."""
+        with self.lock:
+            self._flush()
+            self.db.execute('ATTACH DATABASE ? AS other', (db_file,))
+            try:
+                columns = ', '.join(VISIT_COLUMNS)
+                visits = self.db.execute(
+                    'INSERT INTO visits (%s) SELECT %s FROM other.visits o '
+                    'WHERE NOT EXISTS (SELECT 1 FROM visits v '
+                    'WHERE v.ip = o.ip AND v.started = o.started)' %
+                        (columns, columns)).rowcount
+                reboots = self.db.execute(
+                    'INSERT INTO reboots SELECT * FROM other.reboots o '
+                    'WHERE NOT EXISTS (SELECT 1 FROM reboots r '
+                    'WHERE r.ip = o.ip AND r.sent_at = o.sent_at)').rowcount
+                self.db.commit()
+            finally:
+                self.db.rollback() # nothing, unless the copy failed
+                self.db.execute('DETACH DATABASE other')
+            return (visits, reboots)
+
+    def phase_times(self, since):
+        """(ip, make, seconds per phase...) of every visit since then,
+        each host's newest first; phases as in VisitRecord.PHASES"""
+        with self.lock:
+            self._flush()
+            return self.db.execute('SELECT ip, make, %s FROM visits '
+                                   'WHERE started >= ? '
+                                   'ORDER BY ip, started DESC' %
+                                      ', '.join(['%s_sec' % phase for phase
+                                                 in VisitRecord.PHASES]),
+                                   (since,)).fetchall()
+
+    def reboot_downtimes(self, since):
+        """(ip, make, downtime) of every reboot since then that came back"""
+        with self.lock:
+            self._flush()
+            return self.db.execute('SELECT r.ip, v.make, r.downtime '
+                                   'FROM reboots r JOIN '
+                                   '(SELECT DISTINCT ip, make FROM visits) v '
+                                   'ON r.ip = v.ip '
+                                   'WHERE r.sent_at >= ? AND r.state = ? '
+                                   'ORDER BY r.ip, r.sent_at DESC',
+                                   (since, 'back')).fetchall()
+
+    def host_visits(self, ip, limit=10):
+        """Latest visits to a host, newest first, as dictionaries"""
+        with self.lock:
+            self._flush()
+            cursor = self.db.execute('SELECT %s FROM visits WHERE ip = ? '
+                                     'ORDER BY started DESC LIMIT ?' %
+                                        ', '.join(VISIT_COLUMNS),
+                                     (crawler_util.ip_to_int(ip), limit))
+            return [dict(zip(VISIT_COLUMNS, row)) for row in cursor]
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 3:
+        sys.exit('usage: %s history_db ipaddress [count]' % sys.argv[0])
+
+    limit = 10
+    if len(sys.argv) > 3:
+        limit = int(sys.argv[3])
+    history = VisitHistory(sys.argv[1])
+    for visit in history.host_visits(sys.argv[2], limit):
+        print time.strftime('%Y-%m-%d %H:%M:%S',
+                            time.localtime(visit['started'])),
+        print visit['error_class'] or 'ok', visit['version'],
+        if visit['uptime'] is not None:
+            print crawler_util.rough_timespan(visit['uptime']),
+        print visit['backup_hash']
+    history.close()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+# visit_metrics.py
+
+"""How long each part of a run took, written out for capacity planning.
+
+Every visit is timed by phase (ping, query, backup, reboot), and within it
+HostControl times each wait on the host: connecting and logging in, each
+command, each file transfer, each reboot.  At the end of the run the timings
+are summed up by make of host, as the 0.5, 0.9 and 0.99 quantiles, and written
+out twice:
+
+  * PREFIX.prom, in the Prometheus text format, for node_exporter's textfile
+    collector to pick up
+  * PREFIX.json, for anything else
+
+together with how many visits went which way, hosts visited per minute, and
+the slowest visits of the night.
+"""
+
+from __future__ import with_statement
+import sys
+import json
+import time
+import threading
+import crawler_util
+
+QUANTILES = (0.5, 0.9, 0.99)
+SLOWEST   = 10 # slowest visits to name
+
+# what became of a visit
+OK      = 'ok'
+NO_PING = 'no_ping'
+NO_TIME = 'no_time'
+FAILED  = 'failed'
+
+def visit_result(record):
+    """OK, NO_PING, NO_TIME or FAILED, for a VisitRecord"""
+    if record.error is None:
+        return OK
+    elif record.error[0] in (NO_PING, NO_TIME):
+        return record.error[0]
+    return FAILED
+
+def summarize(values):
+    """count, sum and quantiles of some seconds"""
+    summary = {'count' : len(values), 'sum' : sum(values)}
+    for quantile in QUANTILES:
+        summary[str(quantile)] = crawler_util.percentile(values, quantile)
+    return summary
+
+def label_value(value):
+    """A value made safe to go between the quotes of a Prometheus label"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"'). \
+                      replace('\n', '\\n')
+
+def labels(**names):
+    return ','.join(['%s="%s"' % (name, label_value(value))
+                     for (name, value) in sorted(names.items())])
+
+class RunMetrics(object):
+    """Timings of every visit in a run; thread-safe"""
+
+    def __init__(self):
+        self.started   = time.time()
+        self.phases    = {} # (make, phase) -> [seconds]
+        self.steps     = {} # (make, kind, what) -> [seconds]
+        self.downtimes = {} # make -> [seconds a rebooted host was gone]
+        self.results   = {} # what became of visits -> how many
+        self.visits    = [] # (seconds, make, hostname, ip) of each visit
+        self.lock      = threading.Lock()
+
+    def count(self, result, number=1):
+        """Count visits (or hosts not visited) that went this way"""
+        with self.lock:
+            self.results[result] = self.results.get(result, 0) + number
+
+    def add(self, record):
+        """Take in the timings of a finished VisitRecord"""
+        host = record.host
+        make = host.host_make
+        with self.lock:
+            for (phase, seconds) in record.phases.items():
+                self.phases.setdefault((make, phase), []).append(seconds)
+            for (kind, what, seconds) in record.operations:
+                self.steps.setdefault((make, kind, what), []).append(seconds)
+            if record.finished is not None:
+                self.visits.append((record.finished - record.started, make,
+                                    host.hostname, str(host.ip_addr)))
+        self.count(visit_result(record))
+
+    def add_reboot(self, outcome):
+        """Take in a reboot_tracker.RebootOutcome"""
+        downtime = outcome.downtime()
+        if downtime is None:
+            return
+        with self.lock:
+            self.downtimes.setdefault(outcome.unit.host_make,
+                                      []).append(downtime)
+
+    def slowest(self, number=SLOWEST):
+        """(seconds, make, hostname, ip) of the longest visits"""
+        with self.lock:
+            return sorted(self.visits, reverse=True)[:number]
+
+    def hosts_per_minute(self, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            visits = len(self.visits)
+        return visits * 60.0 / max(1, now - self.started)
+
+    def _summaries(self):
+        """(metric, help, [(labels, seconds)]) of each summary metric"""
+        with self.lock:
+            return [('crawler_visit_phase_seconds',
+                     'Seconds spent in each phase of a visit',
+                     [(labels(make=make, phase=phase), seconds)
+                      for ((make, phase), seconds)
+                      in sorted(self.phases.items())]),
+                    ('crawler_step_seconds',
+                     'Seconds spent connecting, on a command, on a transfer '
+                     'or on a reboot',
+                     [(labels(make=make, kind=kind, step=what), seconds)
+                      for ((make, kind, what), seconds)
+                      in sorted(self.steps.items())]),
+                    ('crawler_reboot_downtime_seconds',
+                     'Seconds from sending a reboot until the host answered',
+                     [(labels(make=make), seconds)
+                      for (make, seconds) in sorted(self.downtimes.items())])]
+
+    def prometheus(self, now=None):
+        """The metrics as lines of Prometheus text format"""
+        if now is None:
+            now = time.time()
+        lines = []
+        for (metric, help, series) in self._summaries():
+            lines.append('# HELP %s %s' % (metric, help))
+            lines.append('# TYPE %s summary' % metric)
+            for (names, seconds) in series:
+                summary = summarize(seconds)
+                for quantile in QUANTILES:
+                    lines.append('%s{%s,quantile="%s"} %f' %
+                                 (metric, names, quantile,
+                                  summary[str(quantile)]))
+                lines.append('%s_sum{%s} %f' % (metric, names,
+                                                summary['sum']))
+                lines.append('%s_count{%s} %d' % (metric, names,
+                                                  summary['count']))
+        with self.lock:
+            results = sorted(self.results.items())
+        lines.append('# HELP crawler_run_visits Visits by what became of them')
+        lines.append('# TYPE crawler_run_visits gauge')
+        for (result, number) in results:
+            lines.append('crawler_run_visits{%s} %d' %
+                         (labels(result=result), number))
+        for (metric, help, value) in \
+                [('crawler_run_duration_seconds',
+                  'Seconds from the start of the run', now - self.started),
+                 ('crawler_run_hosts_per_minute',
+                  'Hosts visited per minute', self.hosts_per_minute(now)),
+                 ('crawler_run_finished_timestamp_seconds',
+                  'When the run finished, in seconds past the epoch', now)]:
+            lines.append('# HELP %s %s' % (metric, help))
+            lines.append('# TYPE %s gauge' % metric)
+            lines.append('%s %f' % (metric, value))
+        return lines
+
+    def as_dict(self, now=None):
+        """The metrics as something json can write"""
+        if now is None:
+            now = time.time()
+        makes = {}
+        with self.lock:
+            for ((make, phase), seconds) in self.phases.items():
+                makes.setdefault(make, {}).setdefault('phases', {})[phase] = \
+                    summarize(seconds)
+            for ((make, kind, what), seconds) in self.steps.items():
+                makes.setdefault(make, {}).setdefault('steps', {}). \
+                    setdefault(kind, {})[what] = summarize(seconds)
+            for (make, seconds) in self.downtimes.items():
+                makes.setdefault(make, {})['reboot_downtime'] = \
+                    summarize(seconds)
+            results = dict(self.results)
+        return {'started'          : self.started,
+                'finished'         : now,
+                'duration'         : now - self.started,
+                'hosts_per_minute' : self.hosts_per_minute(now),
+                'visits'           : results,
+                'makes'            : makes,
+                'slowest'          : [{'seconds'  : seconds,
+                                       'make'     : make,
+                                       'hostname' : hostname,
+                                       'ip'       : ip}
+                                      for (seconds, make, hostname, ip)
+                                      in self.slowest()]}
+
+    def write(self, prefix):
+        """Write PREFIX.prom and PREFIX.json, each atomically (so that the
+        textfile collector never reads half a file)"""
+        now = time.time()
+        crawler_util.write_atomically('%s.prom' % prefix,
+                                      '\n'.join(self.prometheus(now)) + '\n')
+        crawler_util.write_atomically('%s.json' % prefix,
+                                      json.dumps(self.as_dict(now), indent=1,
+                                                 sort_keys=True) + '\n')
+
+    def summary_lines(self):
+        """A few lines for the end of the report: how fast the run went,
+        each make's phases at the median and 90th percentile, and the
+        slowest visits"""
+        lines = ['Visited %.1f units per minute' % self.hosts_per_minute()]
+        with self.lock:
+            phases = sorted(self.phases.items())
+        for ((make, phase), seconds) in phases:
+            lines.append('%-9s %-7s median %6.1f  90%% %6.1f  seconds '
+                         '(%d visits)' %
+                         (make, phase, crawler_util.percentile(seconds, 0.5),
+                          crawler_util.percentile(seconds, 0.9),
+                          len(seconds)))
+        for (seconds, make, hostname, ip) in self.slowest():
+            lines.append('Slow: %s %s %s took %s' %
+                         (make, hostname, ip,
+                          crawler_util.rough_timespan(seconds)))
+        return lines
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        sys.exit('usage: %s metrics.json' % sys.argv[0])
+
+    with open(sys.argv[1]) as infile:
+        metrics = json.load(infile)
+    print 'Visited %.1f units per minute,' % metrics['hosts_per_minute'],
+    print ', '.join(['%d %s' % (number, result)
+                     for (result, number) in sorted(metrics['visits'].items())])
+    for (make, timings) in sorted(metrics['makes'].items()):
+        for (phase, summary) in sorted(timings.get('phases', {}).items()):
+            print '%-9s %-7s median %6.1f  90%% %6.1f  seconds' % \
+                  (make, phase, summary['0.5'], summary['0.9'])
+    for visit in metrics['slowest']:
+        print 'Slow: %(make)s %(hostname)s %(ip)s %(seconds).1f seconds' % \
+              visit
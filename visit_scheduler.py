@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+# visit_scheduler.py
+
+"""Decides which hosts most need a visit, so a short night goes to them.
+
+Remembers a little about every host between runs (when it was last backed up,
+how many visits in a row have failed, its last known uptime, when it was first
+seen) in a small tab-separated state file, and walks the hosts most in need
+first:
+
+  * hosts never backed up (new ones) come first of all
+  * then the longer since the last good backup, the sooner
+  * hosts whose uptime should by now be near or past their maximum get a boost
+    (they are due a reboot)
+  * so does each failed visit in a row, up to a limit
+
+Given a network_topology.Topology, a router is held back until every host
+behind it has been walked, however needy it is, so that its reboot cannot
+strand them.
+"""
+
+from __future__ import with_statement
+import os
+import sys
+import time
+import heapq
+import tempfile
+import threading
+import crawler_util
+
+HOUR = 60 * 60
+DAY  = 24 * HOUR
+
+NEVER_BACKED_UP = 10 * 365 * DAY # staleness of a host never backed up
+UPTIME_BOOST    = 2 * DAY        # most boost for uptime reaching its maximum
+FAILURE_BOOST   = 6 * HOUR       # boost for each failed visit in a row
+MAX_FAILURES    = 4              # failed visits that can count toward boosts
+
+class HostState(object):
+    """What we remember of one host between runs (times in epoch seconds)"""
+    __slots__ = ('last_visit', 'last_backup', 'failures', 'uptime',
+                 'uptime_at', 'first_seen')
+    FIELDS = __slots__
+
+    def __init__(self, first_seen):
+        self.last_visit  = 0
+        self.last_backup = 0
+        self.failures    = 0
+        self.uptime      = 0
+        self.uptime_at   = 0
+        self.first_seen  = first_seen
+
+    def staleness(self, now):
+        """Seconds since the last good backup"""
+        if not self.last_backup:
+            return NEVER_BACKED_UP
+        return now - self.last_backup
+
+    def projected_uptime(self, now):
+        """What the uptime should be by now, if it hasn't rebooted"""
+        if not self.uptime_at:
+            return 0
+        return self.uptime + (now - self.uptime_at)
+
+    def priority(self, now, max_uptime):
+        """The bigger, the sooner this host should be visited"""
+        score = self.staleness(now)
+        if max_uptime:
+            ratio = min(1.0, float(self.projected_uptime(now)) / max_uptime)
+            score += int(ratio * UPTIME_BOOST)
+        score += min(self.failures, MAX_FAILURES) * FAILURE_BOOST
+        return score
+
+class VisitScheduler(object):
+    """Orders the walker's hosts by need, and keeps track of how visits go"""
+
+    def __init__(self, walker, state_file, topology=None):
+        self.walker     = walker
+        self.state_file = state_file
+        self.topology   = topology
+        self.hosts      = {} # IP as integer -> HostState
+        self.lock       = threading.Lock()
+        self._load()
+
+        # anyone not in the state file is new
+        now = int(time.time())
+        for host in walker:
+            if host.ip not in self.hosts:
+                self.hosts[host.ip] = HostState(now)
+
+    def _load(self):
+        if not os.path.exists(self.state_file):
+            return
+        with open(self.state_file) as infile:
+            for line in infile:
+                fields = line.split()
+                if len(fields) != len(HostState.FIELDS) + 1:
+                    continue # damaged line: that host just looks new
+                state = HostState(0)
+                for (name, value) in zip(HostState.FIELDS, fields[1:]):
+                    setattr(state, name, int(value))
+                self.hosts[crawler_util.ip_to_int(fields[0])] = state
+
+    def save(self):
+        """Write out what we know of the hosts still in the inventory"""
+        with self.lock:
+            lines = []
+            for ip in self.walker.sorted_ips:
+                state = self.hosts[ip]
+                lines.append('\t'.join([crawler_util.int_to_ip(ip)] +
+                                       [str(getattr(state, name))
+                                        for name in HostState.FIELDS]))
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(self.state_file))
+        with os.fdopen(fd, 'w') as outfile:
+            for line in lines:
+                outfile.write(line)
+                outfile.write('\n')
+        os.rename(tmp, self.state_file)
+
+    def __iter__(self):
+        """Yields hosts, neediest first (but each after the hosts behind
+        it, with a topology)"""
+        now = int(time.time())
+        parent_of = {}
+        waiting = {} # router IP as integer -> hosts directly behind it
+        heap = []
+        with self.lock:
+            for host in self.walker:
+                entry = (-self.hosts[host.ip].priority(now, host.max_uptime),
+                         host.ip)
+                parent = self._parent(host.ip)
+                if parent is not None:
+                    parent_of[host.ip] = parent
+                    waiting[parent] = waiting.get(parent, 0) + 1
+                heap.append(entry)
+            ready = [entry for entry in heap if entry[1] not in waiting]
+            held = dict([(entry[1], entry) for entry in heap
+                         if entry[1] in waiting])
+        heapq.heapify(ready)
+        while ready:
+            (priority, ip) = heapq.heappop(ready)
+            yield self.walker.unique_hosts[ip]
+            parent = parent_of.get(ip)
+            if parent is not None:
+                waiting[parent] -= 1
+                if not waiting[parent]:
+                    heapq.heappush(ready, held.pop(parent))
+
+    def _parent(self, ip):
+        """The router the host at an integer IP sits behind, if it is one
+        we walk"""
+        if self.topology is None:
+            return None
+        routers = self.topology.ancestors(ip)
+        if routers and routers[0] in self.walker.unique_hosts:
+            return routers[0]
+        return None
+
+    def visited(self, host, backed_up, uptime=None):
+        """Record how a visit went: backed_up is True if it pulled config,
+        uptime is what the host reported (if it got that far)"""
+        now = int(time.time())
+        with self.lock:
+            state = self.hosts[host.ip]
+            state.last_visit = now
+            if backed_up:
+                state.last_backup = now
+                state.failures = 0
+            else:
+                state.failures += 1
+            self._uptime(state, uptime, now)
+
+    def not_visited(self, host, uptime=None):
+        """Record that the host was left before its backup for lack of
+        time: no failure of its own, so only the uptime it reported (if
+        it got that far) is news"""
+        with self.lock:
+            self._uptime(self.hosts[host.ip], uptime, int(time.time()))
+
+    def _uptime(self, state, uptime, now):
+        if uptime is not None:
+            state.uptime = int(uptime)
+            state.uptime_at = now
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 3:
+        sys.exit('usage: %s state_file opennms_file ...' % sys.argv[0])
+
+    import host_walker
+    scheduler = VisitScheduler(host_walker.HostWalker(sys.argv[2:]),
+                               sys.argv[1])
+    now = int(time.time())
+    for host in scheduler:
+        state = scheduler.hosts[host.ip]
+        print host, 'priority', state.priority(now, host.max_uptime), \
+              'last backup', state.last_backup or 'never'